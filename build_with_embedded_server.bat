@@ -60,7 +60,7 @@ echo - Python должен быть доступен из командной с
 echo. >> "release\README.txt"
 echo УСТАНОВКА ЗАВИСИМОСТЕЙ PYTHON: >> "release\README.txt"
 echo 1. Откройте командную строку в папке с приложением >> "release\README.txt"
-echo 2. Выполните: pip install -r server\requirements.txt >> "release\README.txt"
+echo 2. Выполните: pip install -r data\flutter_assets\lib\backend\requirements.txt >> "release\README.txt"
 echo. >> "release\README.txt"
 echo ЗАПУСК: >> "release\README.txt"
 echo Просто запустите flutter_application_1.exe >> "release\README.txt"
@@ -74,7 +74,7 @@ echo.
 echo 8. Создание скрипта установки зависимостей Python...
 echo @echo off > "release\install_python_deps.bat"
 echo echo Установка зависимостей Python для DICOM Viewer... >> "release\install_python_deps.bat"
-echo pip install -r server\requirements.txt >> "release\install_python_deps.bat"
+echo pip install -r data\flutter_assets\lib\backend\requirements.txt >> "release\install_python_deps.bat"
 echo echo. >> "release\install_python_deps.bat"
 echo echo Готово! Теперь можно запускать приложение. >> "release\install_python_deps.bat"
 echo pause >> "release\install_python_deps.bat"
@@ -0,0 +1,142 @@
+import hashlib
+import os
+from contextlib import ExitStack
+
+from pydicom.datadict import dictionary_VR, keyword_for_tag
+from pydicom.errors import InvalidDicomError
+from pydicom.uid import generate_uid
+
+from dicom_io import open_dataset
+from export import apply_report, apply_tags
+
+
+# Профили обработки заголовков при пакетной перезаписи папки
+ANONYMIZATION_PROFILES = ('none', 'basic')
+
+# Упрощённый Basic Application Level Confidentiality Profile (PS3.15, прил. E):
+# удаляемые атрибуты (X) ...
+REMOVE_KEYWORDS = (
+    'PatientAddress', 'PatientTelephoneNumbers', 'PatientBirthTime', 'PatientBirthName',
+    'PatientMotherBirthName', 'OtherPatientIDs', 'OtherPatientNames', 'OtherPatientIDsSequence',
+    'MilitaryRank', 'BranchOfService', 'EthnicGroup', 'Occupation', 'MedicalRecordLocator',
+    'AdditionalPatientHistory', 'PatientComments', 'PatientInsurancePlanCodeSequence',
+    'InstitutionName', 'InstitutionAddress', 'InstitutionalDepartmentName', 'StationName',
+    'ReferringPhysicianAddress', 'ReferringPhysicianTelephoneNumbers', 'PhysiciansOfRecord',
+    'PerformingPhysicianName', 'NameOfPhysiciansReadingStudy', 'OperatorsName',
+    'RequestingPhysician', 'ScheduledPerformingPhysicianName', 'DeviceSerialNumber',
+    'RequestAttributesSequence', 'ReferencedPatientSequence', 'ImageComments',
+    'SeriesDate', 'AcquisitionDate', 'ContentTime', 'SeriesTime', 'AcquisitionTime',
+    'AcquisitionDateTime',
+    # Объекты без пикселей (SR, KO, PR): текст отчёта и наблюдатели
+    'ContentSequence', 'AuthorObserverSequence', 'ParticipantSequence', 'VerifyingObserverSequence',
+    'ContentCreatorName',
+)
+# ... и очищаемые (Z): атрибут обязателен в IOD, поэтому остаётся пустым
+EMPTY_KEYWORDS = (
+    'PatientBirthDate', 'PatientSex', 'PatientAge', 'AccessionNumber', 'StudyID',
+    'ReferringPhysicianName', 'StudyDate', 'StudyTime', 'ContentDate',
+)
+# UID экземпляров, которые заменяются (кроме *InstanceUID — они заменяются все)
+REMAP_UID_KEYWORDS = frozenset({
+    'FrameOfReferenceUID', 'ReferencedFrameOfReferenceUID', 'SynchronizationFrameOfReferenceUID',
+    'IrradiationEventUID', 'StorageMediaFileSetUID',
+})
+
+
+def pseudonym(salt, value):
+    """Псевдоним пациента: одинаков для одного PatientID в пределах задания (соли),
+    поэтому исследования пациента остаются сгруппированными."""
+    digest = hashlib.sha1(f"{salt}|{value}".encode('utf-8')).hexdigest()
+    return f"ANON-{digest[:10].upper()}"
+
+
+def remap_uid(salt, uid):
+    """Новый UID, детерминированный по (соль, исходный UID): файлы одной серии,
+    обработанные разными процессами, получают согласованные Study/Series/FoR UID."""
+    return generate_uid(entropy_srcs=[salt, str(uid)])
+
+
+def _remapped_uid_keyword(keyword):
+    return keyword.endswith('InstanceUID') or keyword in REMAP_UID_KEYWORDS
+
+
+def _scrub(dataset, salt, nested=False):
+    """Один проход по набору и вложенным последовательностям: удаляет приватные теги,
+    заменяет UID экземпляров (ссылки на другие экземпляры тоже) и очищает имена (PN)
+    внутри последовательностей. Элементы читаются по тегу только когда нужны, поэтому
+    PixelData и прочие большие значения не трогаются."""
+    for tag in list(dataset.keys()):
+        if tag.is_private:
+            del dataset[tag]
+            continue
+        raw_vr = dataset.get_item(tag).VR
+        try:
+            vr = raw_vr or dictionary_VR(tag)
+        except KeyError:
+            continue
+        if vr == 'SQ':
+            for item in dataset[tag].value:
+                _scrub(item, salt, nested=True)
+        elif vr == 'PN' and nested:
+            dataset[tag].value = ''
+        elif vr == 'UI' and _remapped_uid_keyword(keyword_for_tag(tag)):
+            elem = dataset[tag]
+            if isinstance(elem.value, (list, tuple)):
+                elem.value = [remap_uid(salt, uid) for uid in elem.value]
+            elif elem.value:
+                elem.value = remap_uid(salt, elem.value)
+
+
+def anonymize_dataset(ds, salt):
+    """Применяет профиль 'basic' к заголовку; PixelData не читается как изображение."""
+    patient_id = str(ds.get('PatientID', '') or '')
+    for keyword in REMOVE_KEYWORDS:
+        if keyword in ds:
+            delattr(ds, keyword)
+    for keyword in EMPTY_KEYWORDS:
+        if keyword in ds:
+            setattr(ds, keyword, '')
+    alias = pseudonym(salt, patient_id)
+    ds.PatientName = alias
+    ds.PatientID = alias
+    _scrub(ds, salt)
+    file_meta = getattr(ds, 'file_meta', None)
+    if file_meta is not None and 'MediaStorageSOPInstanceUID' in file_meta:
+        file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.PatientIdentityRemoved = 'YES'
+    ds.DeidentificationMethod = 'Basic Application Level Confidentiality Profile (subset)'
+
+
+def rewrite_file(source, destination, profile='none', tags=None, report=None, salt=''):
+    """Перезаписывает заголовок одного файла (выполняется в процессе пула).
+
+    Пиксели не декодируются: PixelData читается отложенно из отображённого файла как
+    байты и записывается обратно без изменений, в том же синтаксисе передачи. Запись
+    атомарна (временный файл + os.replace). Объекты без пикселей (SR, KO, PR, планы RT)
+    проходят тот же профиль и тоже записываются. Возвращает (прочитано, записано) байт
+    или None, если файл не DICOM-объект (такие файлы задание перечисляет как пропущенные).
+    """
+    with ExitStack() as stack:
+        try:
+            ds, _ = stack.enter_context(open_dataset(source))
+        except (InvalidDicomError, ValueError, EOFError, AttributeError, KeyError, TypeError):
+            # force=True разбирает что угодно; ошибка разбора — не DICOM, как в series_index
+            return None
+        if 'SOPInstanceUID' not in ds:
+            return None
+        if profile == 'basic':
+            anonymize_dataset(ds, salt)
+        apply_tags(ds, tags or {})
+        apply_report(ds, report)
+        os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+        tmp = f"{destination}.{os.getpid()}.tmp"
+        try:
+            ds.save_as(tmp, write_like_original=False)
+            os.replace(tmp, destination)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+    return os.path.getsize(source), os.path.getsize(destination)
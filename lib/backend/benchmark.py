@@ -0,0 +1,1102 @@
+"""Бенчмарки backend'а DICOM Viewer.
+
+Запуск:
+    python benchmark.py wl          # W/L: LUT-движок против прежнего float64-пути
+    python benchmark.py transport   # /update_wl/ end-to-end для каждого формата ответа
+    python benchmark.py load        # задержка /update_wl/ во время загрузки большого файла
+    python benchmark.py ingest      # конвейер /process_dicom/ против прежних (FastAPI и встроенного Flask)
+    python benchmark.py memory      # резидентная память на изображение и пик при загрузке
+    python benchmark.py cine        # multi-frame: ленивое декодирование кадров и prefetch
+    python benchmark.py index       # индексирование папки серии: последовательно против пула
+    python benchmark.py viewport    # рендер вьюпорта по тайлам пирамиды против полного кадра
+    python benchmark.py mpr         # сборка объёма серии CT и прокрутка реформатов по плоскостям
+    python benchmark.py roi         # /roi_stats/ по таблицам накопленных сумм против прохода по области
+    python benchmark.py export      # пакетный экспорт серии из 500 срезов с аннотациями
+    python benchmark.py thumbnails  # миниатюры с уменьшенным декодированием против полного /process_dicom/-пути
+    python benchmark.py decode      # параллельное декодирование кадров сжатого multi-frame по числу воркеров
+    python benchmark.py rewrite     # обезличивание папки: задание /rewrite_folder/ против копирования файлов
+    python benchmark.py ws          # перетаскивание W/L 60 Гц: HTTP с пропуском шагов против /ws/render/
+    python benchmark.py suite --json out.json [--baseline old.json]
+                                    # все эндпоинты на CT/MR/CR/US/multi-frame/RLE/deflate:
+                                    # перцентили, пропускная способность, пик памяти, JSON
+"""
+import argparse
+import base64
+import io
+import json
+import statistics
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from wl_engine import WindowLevelEngine, wl_gamma
+
+
+# Типовые размеры изображений: (название, rows, cols, dtype, bits stored, slope, intercept)
+IMAGE_SIZES = [
+    ("CT 512x512", 512, 512, np.int16, 12, 1.0, -1024.0),
+    ("MR 256x256", 256, 256, np.uint16, 12, 1.0, 0.0),
+    ("CR 4096x4096", 4096, 4096, np.uint16, 12, 1.0, 0.0),
+]
+
+
+def synthetic_pixels(rows, cols, dtype, bits_stored, seed=0):
+    """Фантом: плавный радиальный градиент с шумом (сжимается примерно как реальный снимок)."""
+    rng = np.random.default_rng(seed)
+    top = 2 ** bits_stored - 1
+    y, x = np.ogrid[-1.0:1.0:rows * 1j, -1.0:1.0:cols * 1j]
+    phantom = np.clip(1.0 - np.sqrt(x * x + y * y), 0.0, 1.0) * 0.9 * top
+    noise = rng.normal(0.0, 0.01 * top, size=(rows, cols))
+    return np.clip(phantom + noise, 0, top).astype(dtype)
+
+
+def synthetic_dicom(rows=512, cols=512, dtype=np.int16, bits_stored=12, slope=1.0, intercept=-1024.0,
+                    modality='CT', photometric='MONOCHROME2', seed=0, transfer_syntax=None, frames=1,
+                    window=(40, 400)):
+    """Синтетический DICOM Part-10 файл (bytes) с шумовыми пикселями (frames > 1 — multi-frame).
+
+    photometric='RGB' — цветное изображение (3 канала uint8, как УЗИ); transfer_syntax —
+    сжатие пикселей (RLE и др.) или Deflated Explicit VR (сжимается весь набор данных);
+    window=None — без окна в заголовке.
+    """
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, DeflatedExplicitVRLittleEndian, generate_uid
+
+    pixels = synthetic_pixels(rows, cols, dtype, bits_stored, seed)
+    samples = 3 if photometric == 'RGB' else 1
+    if samples == 3:
+        # Каналы различаются сдвигом, чтобы изображение не было серым
+        pixels = np.stack([pixels, np.roll(pixels, cols // 8, axis=1), np.roll(pixels, rows // 8, axis=0)], axis=-1)
+    if frames > 1:
+        # Кадры cine: тот же фантом, сдвинутый по кадрам, чтобы они различались
+        pixels = np.stack([np.roll(pixels, 4 * i, axis=1) for i in range(frames)])
+    file_meta = FileMetaDataset()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'  # Secondary Capture
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.PatientName = 'Benchmark^Synthetic'
+    ds.PatientID = 'BENCH'
+    ds.Modality = modality
+    ds.Rows, ds.Columns = rows, cols
+    ds.SamplesPerPixel = samples
+    if samples == 3:
+        ds.PlanarConfiguration = 0
+    ds.PhotometricInterpretation = photometric
+    ds.BitsAllocated = pixels.dtype.itemsize * 8
+    ds.BitsStored = bits_stored
+    ds.HighBit = bits_stored - 1
+    ds.PixelRepresentation = 1 if np.issubdtype(pixels.dtype, np.signedinteger) else 0
+    ds.RescaleSlope = slope
+    ds.RescaleIntercept = intercept
+    if window is not None:
+        ds.WindowCenter, ds.WindowWidth = window
+    ds.PixelSpacing = [0.5, 0.5]
+    if frames > 1:
+        ds.NumberOfFrames = frames
+        ds.FrameTime = 33.3
+    ds.PixelData = pixels.tobytes()
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    if transfer_syntax == DeflatedExplicitVRLittleEndian:
+        file_meta.TransferSyntaxUID = transfer_syntax
+    elif transfer_syntax is not None:
+        ds.compress(transfer_syntax)
+    buf = io.BytesIO()
+    ds.save_as(buf, write_like_original=False)
+    return buf.getvalue()
+
+
+def write_synthetic_series(directory, count, rows=512, cols=512, seed=0, transfer_syntax=None):
+    """Папка с серией CT из count срезов; имена файлов перемешаны относительно порядка срезов."""
+    import os
+    import pydicom
+    from pydicom.uid import generate_uid
+
+    template = pydicom.dcmread(io.BytesIO(synthetic_dicom(rows, cols, seed=seed, transfer_syntax=transfer_syntax)))
+    template.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    order = np.random.default_rng(seed).permutation(count)
+    for i in range(count):
+        uid = generate_uid()
+        template.SOPInstanceUID = uid
+        template.file_meta.MediaStorageSOPInstanceUID = uid
+        template.InstanceNumber = i + 1
+        template.ImagePositionPatient = [0.0, 0.0, -1.25 * i]
+        template.save_as(os.path.join(directory, f"IM{order[i]:05d}"), write_like_original=False)
+    return template.SeriesInstanceUID
+
+
+def load_into_backend(client, dicom_bytes):
+    """Загружает файл через /process_dicom/ и возвращает image_id."""
+    response = client.post('/process_dicom/', files={'file': ('bench.dcm', dicom_bytes, 'application/dicom')})
+    response.raise_for_status()
+    return response.json()['image_id']
+
+
+def time_call(fn, repeat):
+    """Медиана и p95 времени вызова fn в миллисекундах (после одного прогрева)."""
+    fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    samples.sort()
+    return statistics.median(samples), samples[int(0.95 * (len(samples) - 1))]
+
+
+def legacy_window_level(raw_pixels, wc, ww, brightness, photometric):
+    """Прежний путь /update_wl/ над кэшированным (float64 после Rescale) массивом."""
+    min_val, max_val = wc - ww / 2, wc + ww / 2
+    pixels_clipped = np.clip(raw_pixels, min_val, max_val)
+    if max_val > min_val:
+        pixels_normalized = (pixels_clipped - min_val) / (max_val - min_val)
+    else:
+        pixels_normalized = np.zeros_like(pixels_clipped)
+    if brightness != 1.0:
+        if brightness < 1.0:
+            pixels_normalized = np.power(pixels_normalized, 1.0 / (2.0 - brightness))
+        else:
+            pixels_normalized = np.power(pixels_normalized, 1.0 / brightness)
+    pixels_normalized = np.clip(pixels_normalized, 0, 1)
+    pixels_8bit = (pixels_normalized * 255).astype(np.uint8)
+    if photometric == "MONOCHROME1":
+        pixels_8bit = 255 - pixels_8bit
+    return pixels_8bit
+
+
+def bench_wl(repeat):
+    print(f"{'image':<16}{'path':<10}{'median ms':>12}{'p95 ms':>10}")
+    for name, rows, cols, dtype, bits, slope, intercept in IMAGE_SIZES:
+        stored = synthetic_pixels(rows, cols, dtype, bits)
+        raw = stored
+        if slope != 1.0 or intercept != 0.0:
+            raw = stored.astype(np.float64) * slope + intercept
+        engine = WindowLevelEngine(stored, slope, intercept)
+        wc, ww, brightness = 40.0, 400.0, 1.2
+
+        # Каждый вызов меняет окно, как при перетаскивании мышью: LUT строится заново
+        step = iter(range(10 ** 9))
+        legacy = time_call(lambda: legacy_window_level(raw, wc + next(step), ww, brightness, "MONOCHROME2"), repeat)
+        lut = time_call(lambda: engine.render(wc + next(step), ww, wl_gamma(brightness)), repeat)
+        print(f"{name:<16}{'legacy':<10}{legacy[0]:>12.2f}{legacy[1]:>10.2f}")
+        print(f"{'':<16}{'lut':<10}{lut[0]:>12.2f}{lut[1]:>10.2f}   x{legacy[0] / lut[0]:.1f}")
+
+
+def decode_wl_response(response, fmt):
+    """Повторяет работу клиента: достаёт пиксели из ответа /update_wl/."""
+    if fmt == 'json':
+        png = base64.b64decode(json.loads(response.content)['image_base64'])
+        return np.asarray(Image.open(io.BytesIO(png)))
+    if fmt == 'raw':
+        shape = (int(response.headers['X-Image-Height']), int(response.headers['X-Image-Width']))
+        return np.frombuffer(response.content, dtype=np.uint8).reshape(shape)
+    return np.asarray(Image.open(io.BytesIO(response.content)))
+
+
+def bench_transport(repeat):
+    from fastapi.testclient import TestClient
+    import main as backend
+
+    client = TestClient(backend.app)
+    cases = [
+        ("CT 512x512", synthetic_dicom(512, 512)),
+        ("CR 2048x2048", synthetic_dicom(2048, 2048, np.uint16, 12, 1.0, 0.0, modality='CR')),
+    ]
+    formats = [('json', 90), ('png', 90), ('raw', 90), ('jpeg', 90), ('webp', 90), ('jpeg', 75)]
+    print(f"{'image':<16}{'format':<12}{'median ms':>12}{'p95 ms':>10}{'bytes':>12}")
+    for name, dicom_bytes in cases:
+        image_id = load_into_backend(client, dicom_bytes)
+        for fmt, quality in formats:
+            step = iter(range(10 ** 9))
+            sizes = []
+
+            def round_trip():
+                response = client.post('/update_wl/', json={
+                    'window_center': 40 + next(step), 'window_width': 400,
+                    'image_id': image_id, 'format': fmt, 'quality': quality,
+                })
+                response.raise_for_status()
+                sizes.append(len(response.content))
+                decode_wl_response(response, fmt)
+
+            median, p95 = time_call(round_trip, repeat)
+            label = fmt if fmt in ('json', 'png', 'raw') else f"{fmt} q{quality}"
+            print(f"{name:<16}{label:<12}{median:>12.2f}{p95:>10.2f}{int(statistics.median(sizes)):>12}")
+
+
+def legacy_ingest(dicom_bytes):
+    """Прежний конвейер /process_dicom/: float64 Rescale, apply_voi_lut по всему массиву."""
+    import pydicom
+    from pydicom.pixel_data_handlers.util import apply_voi_lut
+
+    ds = pydicom.dcmread(io.BytesIO(dicom_bytes), force=True)
+    raw = ds.pixel_array
+    slope, intercept = float(ds.RescaleSlope), float(ds.RescaleIntercept)
+    if slope != 1.0 or intercept != 0.0:
+        raw = raw.astype(np.float64) * slope + intercept
+    np.min(raw), np.max(raw)
+    pixels = apply_voi_lut(ds.pixel_array, ds)
+    pixels = pixels - np.min(pixels)
+    pixels = (pixels / max(np.max(pixels), 1) * 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format="PNG")
+    base64.b64encode(buf.getvalue())
+    # Прежний кэш хранил именно этот массив
+    return raw
+
+
+def embedded_ingest(dicom_bytes):
+    """Прежний /process_dicom/ встроенного Flask-сервера: временный файл на диске,
+    float-окно по всему массиву и RGB PNG (теперь встроенная сборка запускает этот backend)."""
+    import os
+    import tempfile
+    import pydicom
+
+    fd, temp_path = tempfile.mkstemp(suffix='.dcm')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(dicom_bytes)
+    try:
+        ds = pydicom.dcmread(temp_path)
+        pixels = ds.pixel_array
+        wc, ww = float(ds.WindowCenter), float(ds.WindowWidth)
+        low, high = wc - ww / 2, wc + ww / 2
+        pixels = ((np.clip(pixels, low, high) - low) / (high - low) * 255).astype(np.uint8)
+        buf = io.BytesIO()
+        Image.fromarray(pixels, mode='L').convert('RGB').save(buf, format='PNG')
+        base64.b64encode(buf.getvalue())
+    finally:
+        os.remove(temp_path)
+
+
+def bench_ingest(repeat):
+    from pydicom.uid import RLELossless
+    import main as backend
+
+    # Оба конвейера вызываются в процессе, без HTTP, чтобы сравнивать только обработку
+    cases = [
+        ("CT 512x512", synthetic_dicom(512, 512)),
+        ("CT 512x512 RLE", synthetic_dicom(512, 512, transfer_syntax=RLELossless)),
+        ("CR 4096x4096", synthetic_dicom(4096, 4096, np.uint16, 12, 1.0, 0.0, modality='CR')),
+    ]
+    print(f"{'image':<18}{'path':<10}{'median ms':>12}{'p95 ms':>10}")
+    for name, dicom_bytes in cases:
+        embedded = time_call(lambda: embedded_ingest(dicom_bytes), repeat)
+        legacy = time_call(lambda: legacy_ingest(dicom_bytes), repeat)
+        current = time_call(lambda: backend.ingest_dicom(dicom_bytes), repeat)
+        print(f"{name:<18}{'embedded':<10}{embedded[0]:>12.2f}{embedded[1]:>10.2f}")
+        print(f"{'':<18}{'legacy':<10}{legacy[0]:>12.2f}{legacy[1]:>10.2f}")
+        print(f"{'':<18}{'current':<10}{current[0]:>12.2f}{current[1]:>10.2f}   x{legacy[0] / current[0]:.1f}")
+
+
+def traced_peak(fn):
+    """Результат fn и пик памяти (байт), выделенной во время вызова (NumPy учитывается tracemalloc)."""
+    tracemalloc.start()
+    try:
+        result = fn()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(repeat):
+    import os
+    import tempfile
+    import main as backend
+
+    cases = [
+        ("CT 512x512 (HU rescale)", synthetic_dicom(512, 512)),
+        ("MR 256x256", synthetic_dicom(256, 256, np.uint16, 12, 1.0, 0.0, modality='MR')),
+        ("CR 4096x4096 (slope 0.5)", synthetic_dicom(4096, 4096, np.uint16, 12, 0.5, 0.0, modality='CR')),
+    ]
+    mb = 1024.0 * 1024.0
+    print(f"{'image':<26}{'legacy MB':>11}{'current MB':>12}{'legacy peak':>13}{'bytes peak':>12}{'path peak':>11}")
+    for name, dicom_bytes in cases:
+        legacy_raw, legacy_peak = traced_peak(lambda: legacy_ingest(dicom_bytes))
+        result, current_peak = traced_peak(lambda: backend.ingest_dicom(dicom_bytes))
+        # Локальный путь: файл отображается в память, PixelData копируется один раз
+        with tempfile.NamedTemporaryFile(suffix='.dcm', delete=False) as f:
+            f.write(dicom_bytes)
+        try:
+            _, path_peak = traced_peak(lambda: backend.ingest_dicom(f.name))
+        finally:
+            os.unlink(f.name)
+        print(f"{name:<26}{legacy_raw.nbytes / mb:>11.1f}{result['resident_bytes'] / mb:>12.1f}"
+              f"{legacy_peak / mb:>13.1f}{current_peak / mb:>12.1f}{path_peak / mb:>11.1f}")
+
+
+def _cine_playback(client, image_id, frames, frame_interval):
+    """Проигрывает cine через /frame/{index} с заданным интервалом; задержки кадров (мс)."""
+    latencies = []
+    for index in range(frames):
+        start = time.perf_counter()
+        response = client.get(f'/frame/{index}', params={'image_id': image_id, 'format': 'raw'})
+        response.raise_for_status()
+        elapsed = time.perf_counter() - start
+        latencies.append(elapsed * 1000.0)
+        time.sleep(max(0.0, frame_interval - elapsed))
+    return sorted(latencies)
+
+
+def eager_cine_ingest(dicom_bytes):
+    """Наивная поддержка cine: декодировать весь pixel_array и показать кадр 0
+    (прежний /process_dicom/ на multi-frame просто падает)."""
+    import pydicom
+    from pydicom.pixel_data_handlers.util import apply_voi_lut
+
+    ds = pydicom.dcmread(io.BytesIO(dicom_bytes), force=True)
+    raw = ds.pixel_array
+    pixels = apply_voi_lut(raw[0], ds).astype(np.float64)
+    pixels = pixels - np.min(pixels)
+    pixels = (pixels / max(np.max(pixels), 1) * 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format="PNG")
+    return raw
+
+
+def bench_cine(repeat):
+    from fastapi.testclient import TestClient
+    from pydicom.uid import RLELossless
+    import main as backend
+
+    frames = max(repeat, 2) * 3
+    cases = [
+        (f"XA 512x512x{frames}", synthetic_dicom(512, 512, np.uint16, 10, 1.0, 0.0, modality='XA', frames=frames)),
+        (f"XA 512x512x{frames} RLE", synthetic_dicom(512, 512, np.uint16, 10, 1.0, 0.0, modality='XA',
+                                                     frames=frames, transfer_syntax=RLELossless)),
+    ]
+    mb = 1024.0 * 1024.0
+    print(f"{'image':<22}{'path':<10}{'ingest ms':>11}{'peak MB':>9}{'resident MB':>13}")
+    for name, dicom_bytes in cases:
+        start = time.perf_counter()
+        legacy_raw, legacy_peak = traced_peak(lambda: eager_cine_ingest(dicom_bytes))
+        legacy_ms = (time.perf_counter() - start) * 1000.0
+        start = time.perf_counter()
+        result, current_peak = traced_peak(lambda: backend.ingest_dicom(dicom_bytes))
+        current_ms = (time.perf_counter() - start) * 1000.0
+        print(f"{name:<22}{'eager':<10}{legacy_ms:>11.1f}{legacy_peak / mb:>9.1f}{legacy_raw.nbytes / mb:>13.1f}")
+        print(f"{'':<22}{'lazy':<10}{current_ms:>11.1f}{current_peak / mb:>9.1f}{result['resident_bytes'] / mb:>13.1f}")
+
+    # Проигрывание с частотой 30 кадров/с: с prefetch следующий кадр уже декодирован
+    print(f"\n{'image':<22}{'prefetch':<10}{'median ms':>11}{'p95 ms':>9}{'max ms':>9}")
+    client = TestClient(backend.app)
+    default_executor = backend.prefetch_executor
+    for name, dicom_bytes in cases:
+        for label, executor in [("off", None), ("on", default_executor)]:
+            backend.prefetch_executor = executor
+            image_id = load_into_backend(client, dicom_bytes)
+            latencies = _cine_playback(client, image_id, frames, 1.0 / 30.0)
+            p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            print(f"{name:<22}{label:<10}{statistics.median(latencies):>11.2f}{p95:>9.2f}{latencies[-1]:>9.2f}")
+            backend.dicom_cache.clear()
+    backend.prefetch_executor = default_executor
+
+
+def bench_index(repeat):
+    import tempfile
+    from series_index import SeriesIndex
+    import main as backend
+
+    count = max(repeat, 1) * 25
+    with tempfile.TemporaryDirectory() as directory:
+        write_synthetic_series(directory, count)
+        print(f"{'series':<22}{'path':<12}{'median ms':>11}{'p95 ms':>9}{'files/s':>10}")
+        for label, executor in [("serial", None), ("pool", backend.index_executor)]:
+            timing = time_call(lambda: SeriesIndex().index_directory(directory, executor), 5)
+            print(f"{f'CT {count} slices':<22}{label:<12}{timing[0]:>11.1f}{timing[1]:>9.1f}"
+                  f"{count / timing[0] * 1000.0:>10.0f}")
+
+
+def bench_mpr(repeat):
+    import tempfile
+    from fastapi.testclient import TestClient
+    import main as backend
+
+    client = TestClient(backend.app)
+    count = 200
+    with tempfile.TemporaryDirectory() as directory:
+        series_uid = write_synthetic_series(directory, count)
+        client.post('/index_folder/', json={'path': directory}).raise_for_status()
+        start = time.perf_counter()
+        info = client.post(f'/volume/{series_uid}').json()
+        print(f"Объём {info['shape']} {info['dtype']}, шаг {info['spacing']} мм: "
+              f"сборка {(time.perf_counter() - start) * 1000.0:.0f} мс")
+        print(f"{'plane':<12}{'format':<8}{'size':>10}{'median ms':>11}{'p95 ms':>9}")
+        for plane in ('axial', 'coronal', 'sagittal'):
+            for fmt in ('raw', 'png'):
+                # Прокрутка: каждый запрос — следующее положение среза
+                step = iter(range(10 ** 9))
+                sizes = []
+
+                def scroll():
+                    response = client.post('/render_mpr/', json={
+                        'series_uid': series_uid, 'plane': plane, 'index': next(step) % count, 'format': fmt,
+                    })
+                    response.raise_for_status()
+                    sizes.append(f"{response.headers['X-Image-Width']}x{response.headers['X-Image-Height']}")
+
+                median, p95 = time_call(scroll, repeat)
+                print(f"{plane:<12}{fmt:<8}{sizes[-1]:>10}{median:>11.2f}{p95:>9.2f}")
+
+
+def bench_roi(repeat):
+    from roi import SummedAreaTable, ellipse_mask
+    from fastapi.testclient import TestClient
+    import main as backend
+
+    client = TestClient(backend.app)
+    rows, cols = 3000, 3000
+    dicom_bytes = synthetic_dicom(rows, cols, np.uint16, 12, 1.0, 0.0, modality='CR')
+    image_id = load_into_backend(client, dicom_bytes)
+    pixels = backend.dicom_cache.get(image_id).pixels
+    start = time.perf_counter()
+    table = SummedAreaTable(pixels)
+    print(f"Таблицы {rows}x{cols}: {table.values.dtype}/{table.squares.dtype}, "
+          f"{table.nbytes / 1e6:.0f} MB, сборка {(time.perf_counter() - start) * 1000.0:.0f} мс")
+
+    def naive(shape, side):
+        # Прежний способ: копия области во float64 и полный проход при каждом запросе
+        box = pixels[100:100 + side, 100:100 + side].astype(np.float64)
+        if shape == 'ellipse':
+            box = box[ellipse_mask(100, 100, side, side, 100, 100, 100 + side, 100 + side)]
+        return box.mean(), box.std(), box.min(), box.max()
+
+    print(f"{'shape':<11}{'side':>6}{'naive ms':>10}{'endpoint ms':>13}")
+    for shape in ('rectangle', 'ellipse'):
+        for side in (64, 512, 2048):
+            request = {'image_id': image_id, 'shape': shape, 'x': 100, 'y': 100, 'width': side, 'height': side}
+            naive_ms, _ = time_call(lambda: naive(shape, side), repeat)
+            endpoint_ms, _ = time_call(lambda: client.post('/roi_stats/', json=request).raise_for_status(), repeat)
+            print(f"{shape:<11}{side:>6}{naive_ms:>10.2f}{endpoint_ms:>13.2f}")
+
+
+# Аннотации, как их присылает клиент при экспорте серии в PACS
+EXPORT_ANNOTATIONS = {
+    "texts": [{"x": 40, "y": 40, "text": "L"}, {"x": 300, "y": 60, "text": "Lesion 1"}],
+    "arrows": [{"x1": 200, "y1": 200, "x2": 260, "y2": 240, "strokeWidth": 3}],
+    "rulers": [{"x1": 100, "y1": 400, "x2": 300, "y2": 400, "label": "48.2 mm"}],
+}
+
+
+def bench_export(repeat):
+    import os
+    import tempfile
+    from fastapi.testclient import TestClient
+    import main as backend
+
+    client = TestClient(backend.app)
+    count = 500
+    metadata = {"tags": {"PatientName": "Anonymous", "PatientID": "000000"}, "report": "Exported"}
+    with tempfile.TemporaryDirectory() as directory:
+        write_synthetic_series(directory, count)
+        paths = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+        total_bytes = sum(os.path.getsize(path) for path in paths)
+
+        def one_by_one():
+            # Прежний способ: отдельный /export_dicom/ с загрузкой файла на каждый срез
+            for path in paths:
+                with open(path, 'rb') as f:
+                    client.post('/export_dicom/', files={'file': ('slice.dcm', f, 'application/dicom')}, data={
+                        'metadata': json.dumps(metadata), 'annotations': json.dumps(EXPORT_ANNOTATIONS),
+                    }).raise_for_status()
+
+        def batch(fmt):
+            items = [{'path': path, 'metadata': metadata, 'annotations': EXPORT_ANNOTATIONS} for path in paths]
+            response = client.post('/export_batch/', json={'items': items, 'format': fmt})
+            response.raise_for_status()
+
+        pool, workers = backend.export_pool, backend.EXPORT_WORKERS
+        print(f"Серия CT 512x512, {count} срезов, {total_bytes / 1e6:.0f} MB; процессов в пуле: {workers}")
+        print(f"{'mode':<28}{'total s':>9}{'images/s':>10}{'MB/s':>8}")
+        modes = [("/export_dicom/ x500", one_by_one, None),
+                 ("/export_batch/ zip, threads", lambda: batch('zip'), (None, 0)),
+                 ("/export_batch/ zip, procs", lambda: batch('zip'), (pool, workers)),
+                 ("/export_batch/ multipart", lambda: batch('multipart'), (pool, workers))]
+        for name, fn, executor in modes:
+            if executor is not None:
+                backend.export_pool, backend.EXPORT_WORKERS = executor
+            try:
+                # Первый прогон запускает процессы пула — в замер не входит
+                median, _ = time_call(fn, max(1, repeat // 10))
+            finally:
+                backend.export_pool, backend.EXPORT_WORKERS = pool, workers
+            seconds = median / 1000.0
+            print(f"{name:<28}{seconds:>9.2f}{count / seconds:>10.0f}{total_bytes / 1e6 / seconds:>8.0f}")
+
+
+def _decode_rewrite(source, destination):
+    """Прежний способ: полный разбор с декодированием пикселей и запись обратно."""
+    import pydicom
+    from anonymize import anonymize_dataset
+
+    ds = pydicom.dcmread(source)
+    ds.decompress()
+    anonymize_dataset(ds, 'bench')
+    ds.save_as(destination, write_like_original=False)
+
+
+def bench_rewrite(repeat):
+    import os
+    import shutil
+    import tempfile
+    from fastapi.testclient import TestClient
+    import main as backend
+
+    from pydicom.uid import RLELossless
+
+    count = 500
+    pool, workers = backend.export_pool, backend.EXPORT_WORKERS
+    print(f"Серия CT 512x512, {count} срезов; процессов в пуле: {workers}")
+    print(f"{'series':<10}{'mode':<32}{'total s':>9}{'files/s':>9}{'MB/s':>8}")
+    for label, transfer_syntax in (("native", None), ("RLE", RLELossless)):
+        with tempfile.TemporaryDirectory() as directory, TestClient(backend.app) as client:
+            source = os.path.join(directory, 'series')
+            os.makedirs(source)
+            write_synthetic_series(source, count, transfer_syntax=transfer_syntax)
+            files = sorted(os.listdir(source))
+            total_bytes = sum(os.path.getsize(os.path.join(source, name)) for name in files)
+
+            def copy_files(target):
+                # Нижняя граница: только ввод-вывод
+                os.makedirs(target, exist_ok=True)
+                for name in files:
+                    shutil.copyfile(os.path.join(source, name), os.path.join(target, name))
+
+            def decode_files(target):
+                os.makedirs(target, exist_ok=True)
+                for name in files:
+                    _decode_rewrite(os.path.join(source, name), os.path.join(target, name))
+
+            def job(target):
+                response = client.post('/rewrite_folder/', json={'path': source, 'output_path': target})
+                job_id = response.json()['job_id']
+                while True:
+                    report = client.get(f'/jobs/{job_id}').json()
+                    if report['state'] != 'running':
+                        return report
+                    time.sleep(0.02)
+
+            run = iter(range(10 ** 6))
+            modes = [("copy files (I/O floor)", copy_files, None),
+                     ("decode + anonymize + save", decode_files, None),
+                     ("/rewrite_folder/, threads", job, (None, 0)),
+                     ("/rewrite_folder/, procs", job, (pool, workers))]
+            for name, fn, executor in modes:
+                if executor is not None:
+                    backend.export_pool, backend.EXPORT_WORKERS = executor
+                try:
+                    median, _ = time_call(lambda: fn(os.path.join(directory, f'out{next(run)}')), max(1, repeat // 10))
+                finally:
+                    backend.export_pool, backend.EXPORT_WORKERS = pool, workers
+                seconds = median / 1000.0
+                print(f"{label:<10}{name:<32}{seconds:>9.2f}{count / seconds:>9.0f}{total_bytes / 1e6 / seconds:>8.0f}")
+
+
+def _pillow_encapsulated(dicom_bytes, fmt):
+    """Тот же файл со сжатием кадров через Pillow: JPEG (8 бит) или JPEG 2000 lossless."""
+    import pydicom
+    from pydicom.encaps import encapsulate
+    from pydicom.uid import JPEGBaseline8Bit, JPEG2000Lossless
+
+    ds = pydicom.dcmread(io.BytesIO(dicom_bytes))
+    pixels = ds.pixel_array
+    if int(getattr(ds, 'NumberOfFrames', 1) or 1) == 1:
+        pixels = pixels[np.newaxis]
+    fragments = []
+    for frame in pixels:
+        out = io.BytesIO()
+        if fmt == 'jpeg':
+            Image.fromarray((frame >> 4).astype(np.uint8)).save(out, 'JPEG', quality=90)
+        else:
+            Image.fromarray(frame.astype(np.uint16)).save(out, 'JPEG2000', irreversible=False, no_jp2=True)
+        fragments.append(out.getvalue())
+    if fmt == 'jpeg':
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 8, 8, 7
+        ds.file_meta.TransferSyntaxUID = JPEGBaseline8Bit
+    else:
+        ds.BitsStored, ds.HighBit = 16, 15
+        ds.file_meta.TransferSyntaxUID = JPEG2000Lossless
+    ds.PixelData = encapsulate(fragments)
+    ds['PixelData'].VR = 'OB'
+    result = io.BytesIO()
+    ds.save_as(result, write_like_original=False)
+    return result.getvalue()
+
+
+def bench_thumbnails(repeat):
+    import os
+    import tempfile
+    import pydicom
+    from pydicom.uid import RLELossless
+    from thumbnails import make_thumbnail
+
+    def legacy_preview(path):
+        # Сегодняшний предпросмотр: полное декодирование и PNG полного разрешения
+        ds = pydicom.dcmread(path)
+        pixels = WindowLevelEngine(ds.pixel_array).render(2048, 4096)
+        Image.fromarray(pixels).save(io.BytesIO(), format='PNG')
+
+    cr = synthetic_dicom(2048, 2048, np.uint16, 12, 1.0, 0.0, modality='CR')
+    datasets = [
+        ("CT 512 native", synthetic_dicom(512, 512)),
+        ("CR 2048 native", cr),
+        ("CR 2048 RLE", synthetic_dicom(2048, 2048, np.uint16, 12, 1.0, 0.0, modality='CR', transfer_syntax=RLELossless)),
+        ("CR 2048 JPEG", _pillow_encapsulated(cr, 'jpeg')),
+        ("CR 2048 J2K", _pillow_encapsulated(cr, 'j2k')),
+    ]
+    print(f"{'dataset':<16}{'method':<13}{'thumb ms':>9}{'bytes':>7}{'full preview ms':>17}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, dicom_bytes in datasets:
+            path = os.path.join(directory, 'image.dcm')
+            with open(path, 'wb') as f:
+                f.write(dicom_bytes)
+            data, method = make_thumbnail(path, 128)
+            thumb_ms, _ = time_call(lambda: make_thumbnail(path, 128), repeat)
+            full_ms, _ = time_call(lambda: legacy_preview(path), max(1, repeat // 4))
+            print(f"{name:<16}{method:<13}{thumb_ms:>9.2f}{len(data):>7}{full_ms:>17.1f}")
+
+
+def bench_decode(repeat):
+    import os
+    import pydicom
+    from pydicom.uid import RLELossless
+    from frames import FrameSource
+    from workers import create_executor, create_process_pool
+
+    frames = max(repeat, 4) * 2
+    xa = synthetic_dicom(512, 512, np.uint16, 10, 1.0, 0.0, modality='XA', frames=frames)
+    datasets = [
+        (f"XA 512x{frames} RLE", synthetic_dicom(512, 512, np.uint16, 10, 1.0, 0.0, modality='XA',
+                                                  frames=frames, transfer_syntax=RLELossless)),
+        (f"XA 512x{frames} JPEG", _pillow_encapsulated(xa, 'jpeg')),
+        (f"XA 512x{frames} J2K", _pillow_encapsulated(xa, 'j2k')),
+    ]
+    cores = os.cpu_count() or 1
+    counts = sorted({1, 2, 4, cores, 2 * cores})
+    print(f"cores: {cores}")
+    print(f"{'dataset':<18}{'path':<18}{'ms':>9}{'speedup':>9}")
+    for name, dicom_bytes in datasets:
+        ds = pydicom.dcmread(io.BytesIO(dicom_bytes))
+
+        def decode_with(executor):
+            # Разбиение на фрагменты кадров входит в замер, как при загрузке
+            FrameSource(ds).decode_all(executor)
+
+        baseline_ms, _ = time_call(lambda: pydicom.dcmread(io.BytesIO(dicom_bytes)).pixel_array, 1)
+        print(f"{name:<18}{'pixel_array':<18}{baseline_ms:>9.1f}{1.0:>9.2f}")
+        for count in counts:
+            for kind, factory in (("threads", create_executor), ("processes", create_process_pool)):
+                pool = factory(count)
+                # Прогрев в time_call: процессы spawn стартуют и импортируют pydicom при первой задаче
+                elapsed_ms, _ = time_call(lambda: decode_with(pool), 1)
+                pool.shutdown()
+                label = f"{kind} x{count}"
+                print(f"{'':<18}{label:<18}{elapsed_ms:>9.1f}{baseline_ms / elapsed_ms:>9.2f}")
+
+
+def bench_viewport(repeat):
+    from fastapi.testclient import TestClient
+    import main as backend
+
+    client = TestClient(backend.app)
+    dicom_bytes = synthetic_dicom(5120, 4096, np.uint16, 12, 1.0, 0.0, modality='MG')
+    image_id = load_into_backend(client, dicom_bytes)
+    backend.dicom_cache.get(image_id).pyramid  # пирамида строится в фоне; дожидаемся её
+    step = iter(range(10 ** 6))
+
+    def full_frame(fmt):
+        client.post('/update_wl/', json={'window_center': 2000 + next(step), 'window_width': 3000,
+                                         'image_id': image_id, 'format': fmt}).raise_for_status()
+
+    def viewport(level, x, y, fmt, wc_step=True):
+        wc = 2000 + next(step) if wc_step else 2000
+        client.post('/render_viewport/', json={
+            'image_id': image_id, 'level': level, 'x': x, 'y': y, 'width': 1024, 'height': 1024,
+            'window_center': wc, 'window_width': 3000, 'format': fmt,
+        }).raise_for_status()
+
+    pan = iter(range(10 ** 6))
+    cases = [
+        ("full frame 4096x5120", full_frame),
+        ("fit to screen (level 2)", lambda fmt: viewport(2, 0, 0, fmt)),
+        ("zoom 1:1 region, new W/L", lambda fmt: viewport(0, 1024, 2048, fmt)),
+        ("zoom 1:1, panning", lambda fmt: viewport(0, 1024 + 16 * (next(pan) % 32), 2048, fmt, wc_step=False)),
+    ]
+    # raw показывает стоимость рендера, png — вместе с кодированием ответа
+    print(f"{'MG 4096x5120':<36}{'format':<8}{'median ms':>11}{'p95 ms':>9}")
+    for name, fn in cases:
+        for fmt in ('raw', 'png'):
+            timing = time_call(lambda: fn(fmt), repeat)
+            print(f"{name if fmt == 'raw' else '':<36}{fmt:<8}{timing[0]:>11.2f}{timing[1]:>9.2f}")
+
+
+class LiveServer:
+    """uvicorn с приложением backend'а в фоновом потоке на свободном порту.
+
+    Нагрузочный тест должен идти через настоящие сокеты: in-process транспорт
+    не отдаёт управление event loop'у и не показывает реальную конкуренцию запросов.
+    """
+
+    def __init__(self, app):
+        import socket
+        import uvicorn
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        self._thread.join()
+
+
+def _wl_latencies_during_upload(url, upload_bytes, image_id, count):
+    """Последовательные /update_wl/ параллельно с одной большой загрузкой."""
+    import httpx
+
+    upload_done = threading.Event()
+
+    def upload():
+        try:
+            if upload_bytes is not None:
+                with httpx.Client(base_url=url, timeout=120) as client:
+                    response = client.post('/process_dicom/', files={'file': ('big.dcm', upload_bytes, 'application/dicom')})
+                    response.raise_for_status()
+        finally:
+            upload_done.set()
+
+    uploader = threading.Thread(target=upload)
+    uploader.start()
+    latencies = []
+    with httpx.Client(base_url=url, timeout=120) as client:
+        # Перетаскивание продолжается, пока идёт загрузка (и не меньше count шагов)
+        i = 0
+        while i < count or not upload_done.is_set():
+            start = time.perf_counter()
+            response = client.post('/update_wl/', json={
+                'window_center': 40 + i, 'window_width': 400, 'image_id': image_id,
+                'format': 'png', 'session_id': f'bench-{i}',
+            })
+            response.raise_for_status()
+            latencies.append((time.perf_counter() - start) * 1000.0)
+            i += 1
+    uploader.join()
+    return sorted(latencies)
+
+
+def _drag_http(url, image_id, steps, interval):
+    """Прежний клиент: POST /update_wl/ на шаг, шаги во время запроса отбрасываются (_isUpdatingWL)."""
+    import httpx
+
+    in_flight = threading.Event()
+    sent_at, shown = {}, []
+
+    def request(client, i):
+        try:
+            client.post('/update_wl/', json={'window_center': 40 + i, 'window_width': 400,
+                                             'image_id': image_id, 'format': 'png'}).raise_for_status()
+            shown.append((i, time.perf_counter()))
+        finally:
+            in_flight.clear()
+
+    with httpx.Client(base_url=url, timeout=60) as client:
+        start = time.perf_counter()
+        for i in range(steps):
+            time.sleep(max(0.0, start + i * interval - time.perf_counter()))
+            if in_flight.is_set():
+                continue
+            in_flight.set()
+            sent_at[i] = time.perf_counter()
+            threading.Thread(target=request, args=(client, i)).start()
+        while in_flight.is_set():
+            time.sleep(0.001)
+    return sent_at, shown, time.perf_counter() - start
+
+
+def _drag_ws(url, image_id, steps, interval):
+    """Канал /ws/render/: каждый шаг отправляется, сервер рендерит только самый свежий."""
+    from websockets.sync.client import connect
+
+    sent_at, shown = {}, []
+    with connect(url.replace('http://', 'ws://') + '/ws/render/', max_size=None) as ws:
+        def send():
+            for i in range(steps):
+                time.sleep(max(0.0, start + i * interval - time.perf_counter()))
+                sent_at[i] = time.perf_counter()
+                ws.send(json.dumps({'window_center': 40 + i, 'window_width': 400, 'image_id': image_id,
+                                    'format': 'png', 'seq': i}))
+
+        start = time.perf_counter()
+        sender = threading.Thread(target=send)
+        sender.start()
+        while True:
+            header = json.loads(ws.recv())
+            ws.recv()
+            shown.append((header['seq'], time.perf_counter()))
+            if header['seq'] == steps - 1:
+                break
+        sender.join()
+    return sent_at, shown, time.perf_counter() - start
+
+
+def bench_ws(repeat):
+    from fastapi.testclient import TestClient
+    import main as backend
+
+    steps = max(repeat, 1) * 6
+    interval = 1.0 / 60.0
+    cases = [
+        ("CT 512x512", synthetic_dicom(512, 512)),
+        ("CR 1024x1024", synthetic_dicom(1024, 1024, np.uint16, 12, 1.0, 0.0, modality='CR')),
+        ("CR 2048x2048", synthetic_dicom(2048, 2048, np.uint16, 12, 1.0, 0.0, modality='CR')),
+    ]
+    print(f"{steps} шагов перетаскивания с частотой 60 Гц, ответ PNG")
+    print(f"{'image':<16}{'channel':<10}{'frames':>8}{'fps':>7}{'median ms':>11}{'p95 ms':>9}{'last step':>11}")
+    with LiveServer(backend.app) as server:
+        for name, dicom_bytes in cases:
+            image_id = load_into_backend(TestClient(backend.app), dicom_bytes)
+            for label, drag in [("http", _drag_http), ("ws", _drag_ws)]:
+                sent_at, shown, elapsed = drag(server.url, image_id, steps, interval)
+                # Задержка: от отправки шага до получения его кадра
+                latencies = sorted((at - sent_at[i]) * 1000.0 for i, at in shown)
+                p95 = latencies[int(0.95 * (len(latencies) - 1))]
+                last = "yes" if shown and shown[-1][0] == steps - 1 else "lost"
+                print(f"{name if label == 'http' else '':<16}{label:<10}{len(shown):>8}{len(shown) / elapsed:>7.1f}"
+                      f"{statistics.median(latencies):>11.2f}{p95:>9.2f}{last:>11}")
+
+
+def bench_load(repeat):
+    from fastapi.testclient import TestClient
+    import main as backend
+
+    ct_bytes = synthetic_dicom(512, 512)
+    upload_bytes = synthetic_dicom(4096, 4096, np.uint16, 12, 1.0, 0.0, modality='CR', seed=1)
+    image_id = load_into_backend(TestClient(backend.app), ct_bytes)
+
+    print(f"{'mode':<24}{'upload':<8}{'requests':>10}{'median ms':>12}{'p95 ms':>10}{'max ms':>10}")
+    default_executor = backend.render_executor
+    with LiveServer(backend.app) as server:
+        for mode, executor in [("event loop (0 workers)", None), ("thread pool", default_executor)]:
+            backend.render_executor = executor
+            for label, payload in [("no", None), ("yes", upload_bytes)]:
+                latencies = _wl_latencies_during_upload(server.url, payload, image_id, repeat)
+                p95 = latencies[int(0.95 * (len(latencies) - 1))]
+                print(f"{mode:<24}{label:<8}{len(latencies):>10}{statistics.median(latencies):>12.2f}"
+                      f"{p95:>10.2f}{latencies[-1]:>10.2f}")
+    backend.render_executor = default_executor
+
+
+def suite_datasets():
+    """Наборы данных набора бенчмарков: (имя, bytes). Пиксели и сиды фиксированы."""
+    from pydicom.uid import RLELossless, DeflatedExplicitVRLittleEndian
+
+    return [
+        ("CT 512x512", synthetic_dicom(512, 512)),
+        ("MR 256x256", synthetic_dicom(256, 256, np.uint16, 12, 1.0, 0.0, modality='MR', window=None)),
+        ("CR 3000x3000", synthetic_dicom(3000, 3000, np.uint16, 12, 1.0, 0.0, modality='CR', window=None)),
+        ("US RGB 640x480", synthetic_dicom(480, 640, np.uint8, 8, 1.0, 0.0, modality='US', photometric='RGB',
+                                           window=None)),
+        ("XA 30x512x512", synthetic_dicom(512, 512, np.uint16, 10, 1.0, 0.0, modality='XA', frames=30)),
+        ("CT 512x512 RLE", synthetic_dicom(512, 512, transfer_syntax=RLELossless)),
+        ("CT 512x512 deflate", synthetic_dicom(512, 512, transfer_syntax=DeflatedExplicitVRLittleEndian)),
+    ]
+
+
+def latency_summary(samples_ms, total_bytes=0):
+    """Перцентили задержки (мс), пропускная способность (запросов/с и MB/с входных данных)."""
+    ordered = sorted(samples_ms)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+    seconds = sum(ordered) / 1000.0
+    summary = {
+        "n": len(ordered),
+        "p50_ms": round(percentile(50), 3),
+        "p90_ms": round(percentile(90), 3),
+        "p99_ms": round(percentile(99), 3),
+        "mean_ms": round(statistics.fmean(ordered), 3),
+        "max_ms": round(ordered[-1], 3),
+        "throughput_rps": round(len(ordered) / seconds, 2) if seconds else None,
+    }
+    if total_bytes:
+        summary["throughput_mb_s"] = round(total_bytes / (1024.0 * 1024.0) / seconds, 2) if seconds else None
+    return summary
+
+
+def _suite_environment():
+    import os
+    import platform
+    import subprocess
+    import pydicom
+    import PIL
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pydicom": pydicom.__version__,
+        "pillow": PIL.__version__,
+    }
+
+
+def _max_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS отдаёт байты, Linux — килобайты
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def bench_suite(repeat, output=None, baseline=None):
+    """Все основные эндпоинты на всех наборах данных, в процессе через TestClient.
+
+    Дисковый кэш пикселей выключен, чтобы повторные загрузки каждый раз декодировали.
+    """
+    from fastapi.testclient import TestClient
+    import main as backend
+
+    backend.pixel_cache.max_bytes = 0
+    client = TestClient(backend.app)
+    results = []
+    print(f"{'dataset':<20}{'endpoint':<22}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'req/s':>9}{'peak MB':>9}")
+    for name, dicom_bytes in suite_datasets():
+        image_id = load_into_backend(client, dicom_bytes)
+        # Пик выделенной памяти на одну загрузку (отдельным вызовом: tracemalloc замедляет замеры)
+        _, ingest_peak = traced_peak(lambda: backend.ingest_dicom(dicom_bytes))
+        step = iter(range(10 ** 9))
+
+        def process():
+            client.post('/process_dicom/', files={'file': ('bench.dcm', dicom_bytes, 'application/dicom')}) \
+                .raise_for_status()
+
+        def update_wl(fmt):
+            return lambda: client.post('/update_wl/', json={
+                'window_center': 40 + next(step) % 200, 'window_width': 400, 'image_id': image_id, 'format': fmt,
+            }).raise_for_status()
+
+        def update_brightness():
+            client.post('/update_brightness/', params={
+                'brightness': 0.5 + (next(step) % 100) / 100.0, 'image_id': image_id,
+            }).raise_for_status()
+
+        def export():
+            client.post('/export_dicom/', data={
+                'image_id': image_id, 'metadata': json.dumps({'report': 'benchmark', 'tags': {}}),
+            }).raise_for_status()
+
+        cases = [
+            ("process_dicom", process, len(dicom_bytes)),
+            ("update_wl json", update_wl('json'), 0),
+            ("update_wl png", update_wl('png'), 0),
+            ("update_brightness", update_brightness, 0),
+            ("export_dicom", export, len(dicom_bytes)),
+        ]
+        for endpoint, fn, request_bytes in cases:
+            fn()
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                fn()
+                samples.append((time.perf_counter() - start) * 1000.0)
+            summary = latency_summary(samples, request_bytes * len(samples))
+            result = {"dataset": name, "endpoint": endpoint, **summary}
+            if endpoint == "process_dicom":
+                result["input_bytes"] = len(dicom_bytes)
+                result["peak_alloc_bytes"] = ingest_peak
+            results.append(result)
+            peak = f"{ingest_peak / (1024.0 * 1024.0):>9.1f}" if endpoint == "process_dicom" else f"{'':>9}"
+            print(f"{name if endpoint == 'process_dicom' else '':<20}{endpoint:<22}{summary['p50_ms']:>9.2f}"
+                  f"{summary['p90_ms']:>9.2f}{summary['p99_ms']:>9.2f}{summary['throughput_rps']:>9.1f}{peak}")
+
+    report = {"environment": _suite_environment(), "repeat": repeat, "max_rss_bytes": _max_rss_bytes(),
+              "results": results}
+    if baseline:
+        _compare_with_baseline(results, baseline)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Результаты записаны в {output}")
+    return report
+
+
+def _compare_with_baseline(results, baseline_path):
+    """Сравнение p50 с сохранённым прогоном: >1 — медленнее базового."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    base = {(r["dataset"], r["endpoint"]): r for r in baseline.get("results", [])}
+    commit = baseline.get("environment", {}).get("commit")
+    print(f"\nСравнение с {baseline_path} (commit {commit}): p50 текущий / базовый")
+    print(f"{'dataset':<20}{'endpoint':<22}{'base ms':>9}{'now ms':>9}{'ratio':>8}")
+    for result in results:
+        previous = base.get((result["dataset"], result["endpoint"]))
+        if previous is None:
+            continue
+        ratio = result["p50_ms"] / previous["p50_ms"] if previous["p50_ms"] else float('nan')
+        flag = "  <- регрессия" if ratio > 1.2 else ""
+        print(f"{result['dataset']:<20}{result['endpoint']:<22}{previous['p50_ms']:>9.2f}"
+              f"{result['p50_ms']:>9.2f}{ratio:>8.2f}{flag}")
+
+
+BENCHMARKS = {
+    "wl": bench_wl,
+    "transport": bench_transport,
+    "load": bench_load,
+    "ingest": bench_ingest,
+    "memory": bench_memory,
+    "cine": bench_cine,
+    "index": bench_index,
+    "viewport": bench_viewport,
+    "mpr": bench_mpr,
+    "roi": bench_roi,
+    "export": bench_export,
+    "rewrite": bench_rewrite,
+    "thumbnails": bench_thumbnails,
+    "decode": bench_decode,
+    "ws": bench_ws,
+    "suite": bench_suite,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", help="suite: записать результаты в JSON-файл")
+    parser.add_argument("--baseline", help="suite: JSON предыдущего прогона для сравнения")
+    args = parser.parse_args()
+    if args.benchmark == "suite":
+        bench_suite(args.repeat, args.json, args.baseline)
+    else:
+        BENCHMARKS[args.benchmark](args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import copy
+import io
+import mmap
+import os
+from contextlib import contextmanager
+
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.multival import MultiValue
+
+
+# Элементы крупнее этого размера (PixelData, большие оверлеи) при разборе не читаются,
+# а подгружаются из отображённого файла при первом обращении
+DEFER_SIZE = 64 * 1024
+
+
+def _is_on_disk(fileobj):
+    # SpooledTemporaryFile держит небольшие загрузки в памяти (_rolled=False):
+    # у такого объекта нет дескриптора, а fileno() заставил бы его сброситься на диск
+    return getattr(fileobj, '_rolled', True) and hasattr(fileobj, 'fileno')
+
+
+def first_float(value, default):
+    """Число из тега, который может быть многозначным (WindowCenter/WindowWidth);
+    default, если тега нет или значение не число."""
+    try:
+        if isinstance(value, (list, tuple, MultiValue)):
+            value = value[0]
+        return float(value)
+    except (TypeError, ValueError, IndexError):
+        return default
+
+
+@contextmanager
+def open_dataset(source):
+    """Открывает DICOM из bytes, локального пути или бинарного файлового объекта.
+
+    Файлы на диске (путь или загрузка, уже сброшенная во временный файл) отображаются
+    в память через mmap и читаются отложенно: в процесс копируется только то, к чему
+    обращается код, без промежуточных bytes всего файла. Возвращает (dataset, buffer),
+    где buffer — содержимое файла (bytes или mmap) для хэширования.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield pydicom.dcmread(io.BytesIO(source), force=True), source
+        return
+
+    owned = None
+    if isinstance(source, (str, os.PathLike)):
+        owned = source = open(source, 'rb')
+    try:
+        source.seek(0)
+        if not _is_on_disk(source):
+            # Байты читаются до разбора: dcmread сдвигает позицию, и read() после него
+            # вернул бы пустой остаток — handle и ключ дискового кэша считаются по ним
+            contents = source.read()
+            yield pydicom.dcmread(io.BytesIO(contents), force=True), contents
+            return
+        try:
+            mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError, io.UnsupportedOperation):
+            # Пустой файл или объект без настоящего дескриптора
+            contents = source.read()
+            yield pydicom.dcmread(io.BytesIO(contents), force=True), contents
+            return
+        try:
+            yield pydicom.dcmread(mapped, force=True, defer_size=DEFER_SIZE), mapped
+        finally:
+            mapped.close()
+    finally:
+        if owned is not None:
+            owned.close()
+
+
+def load_deferred(ds):
+    """Дочитывает отложенные элементы, пока исходный файл (mmap) ещё открыт."""
+    for _ in ds.iterall():
+        pass
+
+
+def copy_dataset(ds):
+    """Копия для изменения (экспорт) без копирования значений.
+
+    Элементы копируются поверхностно: изменения тегов в копии заменяют элементы
+    целиком и не затрагивают исходный набор, а байты PixelData остаются общими.
+    Последовательности копируются глубоко, так как их элементы изменяемы.
+    """
+    out = FileDataset('', Dataset(),
+                      file_meta=copy.deepcopy(getattr(ds, 'file_meta', None) or FileMetaDataset()),
+                      preamble=getattr(ds, 'preamble', None) or b"\0" * 128)
+    for elem in ds:
+        out.add(copy.deepcopy(elem) if elem.VR == 'SQ' else copy.copy(elem))
+    out.is_little_endian = ds.is_little_endian
+    out.is_implicit_VR = ds.is_implicit_VR
+    return out
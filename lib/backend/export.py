@@ -0,0 +1,432 @@
+import io
+import json
+import math
+import posixpath
+import re
+import uuid
+import zipfile
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from pydicom.datadict import tag_for_keyword, dictionary_VR
+from pydicom.uid import ExplicitVRLittleEndian
+
+from dicom_io import open_dataset
+
+
+# Модуль без зависимостей от main.py: его функции выполняются в процессах пула пакетного
+# экспорта, которые импортируют только то, что нужно для экспорта одного файла
+
+# Символы, которые не должны попасть в имя записи ZIP и в заголовок части multipart:
+# управляющие (CR/LF подменили бы заголовки), кавычки и разделители путей
+_UNSAFE_NAME_CHARS = re.compile(r'[\x00-\x1f\x7f"\\/:*?<>|]')
+
+# Длина и угол (рад) наконечника стрелки, половина длины засечек линейки
+ARROW_HEAD_LENGTH = 15.0
+ARROW_HEAD_ANGLE = 0.5
+RULER_TICK = 10.0
+
+
+@lru_cache(maxsize=1)
+def _default_font():
+    # Один шрифт на процесс, а не на каждую подпись
+    try:
+        return ImageFont.load_default()
+    except Exception:
+        return None
+
+
+def _text_size(draw, text, font):
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    return right - left, bottom - top
+
+
+def parse_color(c, fallback=(255, 255, 0)):
+    if isinstance(c, str):
+        # Формат #RRGGBB
+        c = c.strip()
+        if c.startswith('#') and len(c) == 7:
+            try:
+                return (int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16))
+            except ValueError:
+                return fallback
+    return fallback
+
+
+def rotation_transform(rotation_deg, width, height):
+    """Преобразование экранных координат (после поворота изображения по часовой стрелке,
+    как в UI) обратно в координаты исходного изображения — поворот вокруг центра на
+    противоположный угол."""
+    if abs(rotation_deg) % 360 == 0:
+        return lambda x, y: (x, y)
+    cx, cy = width / 2.0, height / 2.0
+    theta = math.radians(rotation_deg)
+    cos_t, sin_t = math.cos(theta), math.sin(theta)
+
+    def rot(x, y):
+        dx, dy = x - cx, y - cy
+        return cos_t * dx - sin_t * dy + cx, sin_t * dx + cos_t * dy + cy
+    return rot
+
+
+def _draw_label(draw, x, y, text, color, bg, font):
+    w, h = _text_size(draw, text, font)
+    draw.rectangle([x - 5, y - 2, x - 5 + w + 10, y - 2 + h + 4], fill=bg)
+    draw.text((x, y), text, fill=color, font=font)
+
+
+def _draw_arrow(draw, x1, y1, x2, y2, color, width):
+    draw.line([(x1, y1), (x2, y2)], fill=color, width=width)
+    dx, dy = x2 - x1, y2 - y1
+    length = math.hypot(dx, dy) or 1.0
+    ux, uy = dx / length, dy / length
+    for angle in (ARROW_HEAD_ANGLE, -ARROW_HEAD_ANGLE):
+        cos_a, sin_a = math.cos(angle), math.sin(angle)
+        px = x2 - ARROW_HEAD_LENGTH * (ux * cos_a + uy * sin_a)
+        py = y2 - ARROW_HEAD_LENGTH * (uy * cos_a - ux * sin_a)
+        draw.line([(x2, y2), (px, py)], fill=color, width=width)
+
+
+def _draw_ruler(draw, x1, y1, x2, y2, color):
+    draw.line([(x1, y1), (x2, y2)], fill=color, width=3)
+    # Перпендикулярные засечки на концах
+    dx, dy = x2 - x1, y2 - y1
+    length = math.hypot(dx, dy) or 1.0
+    px, py = -dy / length * RULER_TICK, dx / length * RULER_TICK
+    draw.line([(x1 - px, y1 - py), (x1 + px, y1 + py)], fill=color, width=2)
+    draw.line([(x2 - px, y2 - py), (x2 + px, y2 + py)], fill=color, width=2)
+
+
+def draw_annotations(img, ann, rgb):
+    """Рисует тексты, стрелки и линейки ann (координаты экрана UI) на img: для RGB —
+    цветом аннотации, для монохромных изображений — маской (255 на чёрном)."""
+    draw = ImageDraw.Draw(img)
+    try:
+        rotation_deg = float(ann.get('rotation_deg', 0.0))
+    except Exception:
+        rotation_deg = 0.0
+    rot = rotation_transform(rotation_deg, img.width, img.height)
+    font = _default_font()
+    bg = (0, 0, 0) if rgb else 0
+
+    for t in ann.get('texts', []) or []:
+        try:
+            x, y = rot(float(t.get('x', 0)), float(t.get('y', 0)))
+            color = parse_color(t.get('color')) if rgb else 255
+            _draw_label(draw, x, y, str(t.get('text', '')), color, bg, font)
+        except Exception:
+            pass
+
+    for a in ann.get('arrows', []) or []:
+        try:
+            x1, y1 = rot(float(a.get('x1', 0)), float(a.get('y1', 0)))
+            x2, y2 = rot(float(a.get('x2', 0)), float(a.get('y2', 0)))
+            width = int(max(1, round(float(a.get('strokeWidth', 3)))))
+            color = parse_color(a.get('color')) if rgb else 255
+            _draw_arrow(draw, x1, y1, x2, y2, color, width)
+        except Exception:
+            pass
+
+    for r in ann.get('rulers', []) or []:
+        try:
+            x1, y1 = rot(float(r.get('x1', 0)), float(r.get('y1', 0)))
+            x2, y2 = rot(float(r.get('x2', 0)), float(r.get('y2', 0)))
+            color = (255, 255, 0) if rgb else 255
+            _draw_ruler(draw, x1, y1, x2, y2, color)
+            label = str(r.get('label', ''))
+            if label:
+                _, h = _text_size(draw, label, font)
+                _draw_label(draw, (x1 + x2) / 2 + 15, (y1 + y2) / 2 - h / 2, label, color, bg, font)
+        except Exception:
+            pass
+
+
+def _set_native_pixel_data(ds, data):
+    """Записывает несжатые пиксели; сжатый синтаксис передачи заменяется на Explicit VR LE,
+    иначе файл содержал бы несжатые байты с заголовком JPEG/RLE."""
+    file_meta = getattr(ds, 'file_meta', None)
+    transfer_syntax = getattr(file_meta, 'TransferSyntaxUID', None) if file_meta is not None else None
+    if transfer_syntax is not None and transfer_syntax.is_compressed:
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+    ds.PixelData = data
+
+
+def burn_annotations(ds, ann):
+    """Сжигает аннотации непосредственно в исходные пиксели без изменения размеров/битности:
+    RGB — поканальный максимум с оверлеем, монохромные — пиксели маски получают
+    максимальное значение типа (минимальное для MONOCHROME1)."""
+    src_pixels = ds.pixel_array
+    photometric = str(getattr(ds, 'PhotometricInterpretation', 'MONOCHROME2')).upper()
+    height, width = (src_pixels.shape[0], src_pixels.shape[1]) if src_pixels.ndim >= 2 else (ds.Rows, ds.Columns)
+    rgb = photometric == 'RGB' and src_pixels.ndim == 3 and src_pixels.dtype == np.uint8
+    # Оверлей RGB рисуется поверх копии изображения, маска — на пустом 8-битном холсте
+    img = Image.fromarray(src_pixels, mode='RGB') if rgb else Image.new('L', (width, height), 0)
+    draw_annotations(img, ann, photometric == 'RGB')
+
+    if rgb:
+        _set_native_pixel_data(ds, np.maximum(src_pixels, np.asarray(img)).tobytes())
+        return
+    mask = np.asarray(img if img.mode == 'L' else img.convert('L')) > 0
+    arr = np.array(src_pixels)  # сохранить dtype
+    if np.issubdtype(arr.dtype, np.integer):
+        info = np.iinfo(arr.dtype)
+        maxv, minv = info.max, info.min
+    else:
+        maxv, minv = 255, 0
+    arr[mask] = maxv if photometric != 'MONOCHROME1' else minv
+    _set_native_pixel_data(ds, arr.tobytes())
+
+
+# Безопасность: структурные пиксельные поля не изменяются правкой тегов
+FORBIDDEN_KEYWORDS = frozenset({
+    'Rows', 'Columns', 'BitsAllocated', 'BitsStored', 'HighBit',
+    'SamplesPerPixel', 'PhotometricInterpretation', 'PixelRepresentation',
+    'NumberOfFrames', 'PixelData'
+})
+
+
+def _split_multi(x):
+    # Разбираем множественные значения: "a\\b" или "a,b"
+    if isinstance(x, str):
+        if '\\' in x:
+            return [i for i in x.split('\\') if i != '']
+        if ',' in x:
+            return [i for i in x.split(',') if i != '']
+    return x
+
+
+def _convert_one(x, vr):
+    if vr in ('US', 'UL', 'SS', 'SL'):  # целые
+        return int(x)
+    if vr in ('FL', 'FD'):  # float
+        return float(x)
+    if vr == 'IS':  # Integer String
+        return str(int(x))
+    if vr == 'DS':  # Decimal String
+        return str(float(x))
+    # Остальные VR — оставляем как есть (строки и т.п.)
+    return x
+
+
+def coerce_value_to_vr(v, vr):
+    """Значение из JSON клиента в тип, подходящий для VR тега (в т.ч. многозначное)."""
+    v = _split_multi(v)
+    if isinstance(v, (list, tuple)):
+        return [_convert_one(x, vr) for x in v]
+    return _convert_one(v, vr)
+
+
+def apply_report(ds, report):
+    """Текст отчёта — в ImageComments."""
+    if report is None:
+        return
+    try:
+        ds.ImageComments = str(report)
+    except Exception:
+        pass
+
+
+def apply_tags(ds, tags):
+    """Теги по словарю {keyword: value}; структурные поля, неизвестные ключи и
+    некорректные значения пропускаются."""
+    if not isinstance(tags, dict):
+        return
+    for key, value in tags.items():
+        if key in FORBIDDEN_KEYWORDS:
+            continue
+        try:
+            tag = tag_for_keyword(key)
+            if tag is None:
+                continue
+            vr = dictionary_VR(tag) or ''
+            setattr(ds, key, coerce_value_to_vr(value, vr))
+        except Exception:
+            # Игнорируем неподдерживаемые/некорректные ключи или значения
+            pass
+
+
+class ExportError(ValueError):
+    """Экспорт невозможен (например, не читается присланный клиентом рендер).
+
+    Модуль выполняется и в процессах пула экспорта, поэтому не зависит от FastAPI:
+    в HTTP-ответ ошибку превращает main.
+    """
+
+
+def apply_export(ds, metadata, annotations, png_bytes):
+    """Применяет metadata/аннотации к набору данных и возвращает его (ExportError при ошибке).
+
+    metadata и annotations — JSON-строки из формы /export_dicom/ или уже разобранные dict.
+    """
+
+    meta = {}
+    if isinstance(metadata, dict):
+        meta = metadata
+    elif metadata:
+        try:
+            meta = json.loads(metadata)
+        except Exception:
+            meta = {}
+
+    apply_report(ds, meta.get('report') if isinstance(meta, dict) else None)
+    apply_tags(ds, meta.get('tags', {}) if isinstance(meta, dict) else {})
+
+    # Ветка 1: если клиент прислал готовый рендер (PNG) — используем его БЕЗ доп. конвертаций
+    if png_bytes is not None:
+        try:
+            img = Image.open(io.BytesIO(png_bytes)).convert('RGB')
+            arr = np.array(img, dtype=np.uint8)
+            # Записываем RGB 8-bit как PixelData, чтобы картинка совпадала 1:1
+            ds.Rows = int(arr.shape[0])
+            ds.Columns = int(arr.shape[1])
+            ds.PhotometricInterpretation = 'RGB'
+            ds.SamplesPerPixel = 3
+            ds.PlanarConfiguration = 0
+            ds.BitsAllocated = 8
+            ds.BitsStored = 8
+            ds.HighBit = 7
+            ds.PixelRepresentation = 0
+            # Чистим потенциальные конфликтующие поля
+            for k in [
+                'PaletteColorLookupTableUID', 'RedPaletteColorLookupTableData',
+                'GreenPaletteColorLookupTableData', 'BluePaletteColorLookupTableData',
+                'SmallestImagePixelValue', 'LargestImagePixelValue',
+                'VOILUTSequence', 'ModalityLUTSequence',
+            ]:
+                if hasattr(ds, k):
+                    try:
+                        delattr(ds, k)
+                    except Exception:
+                        pass
+            # Meta + флаги
+            try:
+                if not hasattr(ds, 'file_meta') or ds.file_meta is None:
+                    from pydicom.dataset import Dataset
+                    ds.file_meta = Dataset()
+                ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            except Exception:
+                pass
+            ds.is_little_endian = True
+            ds.is_implicit_VR = False
+            ds.PixelData = arr.tobytes()
+        except Exception as e:
+            raise ExportError(f"Failed to use client render: {str(e)}") from e
+
+    # Ветка 2: если рендера нет — пробуем сжечь аннотации на сервере (как раньше)
+    elif annotations:
+        if isinstance(annotations, dict):
+            ann = annotations
+        else:
+            try:
+                ann = json.loads(annotations)
+            except Exception:
+                ann = None
+        if isinstance(ann, dict):
+            try:
+                burn_annotations(ds, ann)
+            except Exception:
+                # Не фейлим экспорт, просто пропускаем аннотации
+                pass
+
+    return ds
+
+
+def export_file(source, metadata=None, annotations=None):
+    """Экспорт одного файла в пакетном режиме (выполняется в процессе пула): теги,
+    отчёт и аннотации применяются к файлу source (путь или bytes Part-10).
+
+    Возвращает (SOPInstanceUID, bytes Part-10).
+    """
+    with open_dataset(source) as (ds, _):
+        apply_export(ds, metadata, annotations, None)
+        out = io.BytesIO()
+        ds.save_as(out, write_like_original=False)
+        return str(getattr(ds, 'SOPInstanceUID', '')), out.getvalue()
+
+
+def safe_filename(name, default='export.dcm'):
+    """Имя файла из запроса клиента без каталогов (../../x.dcm — запись вне папки
+    распаковки), управляющих символов и кавычек; default, если от имени ничего не осталось."""
+    name = posixpath.basename(str(name or '').replace('\\', '/'))
+    name = _UNSAFE_NAME_CHARS.sub('_', name).strip(' .')
+    return name or default
+
+
+class UniqueNames:
+    """Имена файлов пакета без повторов (без учёта регистра, как в файловых системах
+    Windows): повтор получает суффикс _1, _2, ... перед расширением."""
+
+    def __init__(self, reserved=()):
+        self._used = {name.lower() for name in reserved}
+
+    def take(self, name):
+        stem, ext = posixpath.splitext(name)
+        candidate, suffix = name, 1
+        while candidate.lower() in self._used:
+            candidate = f"{stem}_{suffix}{ext}"
+            suffix += 1
+        self._used.add(candidate.lower())
+        return candidate
+
+
+async def _safe_names(results, reserved=()):
+    names = UniqueNames(reserved)
+    async for name, data, error in results:
+        yield names.take(safe_filename(name)), data, error
+
+
+class _ChunkSink:
+    """Файлоподобный приёмник без seek: zipfile пишет в него архив потоково
+    (с data descriptor после каждой записи), а записанное забирается кусками."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def zip_stream(results):
+    """ZIP (без сжатия — пиксели DICOM почти не сжимаются deflate) из асинхронного потока
+    (имя, bytes или None, ошибка); в конце — manifest.json с итогом по каждому файлу."""
+    sink = _ChunkSink()
+    manifest = []
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+        async for name, data, error in _safe_names(results, reserved=('manifest.json',)):
+            if data is None:
+                manifest.append({"name": name, "error": error})
+                continue
+            archive.writestr(name, data)
+            manifest.append({"name": name, "bytes": len(data)})
+            yield sink.drain()
+        archive.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=1))
+    yield sink.drain()
+
+
+def multipart_boundary():
+    return f"dicom-export-{uuid.uuid4().hex}"
+
+
+async def multipart_stream(results, boundary):
+    """multipart/mixed: часть application/dicom на каждый файл (ошибки — application/json)."""
+    async for name, data, error in _safe_names(results):
+        if data is None:
+            content_type, data = 'application/json', json.dumps({"name": name, "error": error}).encode('utf-8')
+        else:
+            content_type = 'application/dicom'
+        yield (f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+               f"Content-Disposition: attachment; filename=\"{name}\"\r\n"
+               f"Content-Length: {len(data)}\r\n\r\n").encode('utf-8') + data + b"\r\n"
+    yield f"--{boundary}--\r\n".encode('utf-8')
@@ -0,0 +1,280 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate, generate_pixel_data_frame
+from pydicom.pixel_data_handlers.util import pixel_dtype
+from pydicom.uid import RLELossless
+
+from settings import int_from_env
+
+
+# Бюджет памяти на декодированные кадры одного изображения (сжатые multi-frame объекты)
+DEFAULT_FRAME_CACHE_BYTES = 256 * 1024 * 1024
+
+# Сколько следующих кадров декодировать заранее при запросе /frame/{index}
+DEFAULT_PREFETCH_FRAMES = 8
+
+# Атрибуты модуля Image Pixel, нужные декодеру для одного кадра
+_PIXEL_MODULE_KEYWORDS = (
+    'Rows', 'Columns', 'SamplesPerPixel', 'PhotometricInterpretation',
+    'PlanarConfiguration', 'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation',
+)
+
+# Синтаксисы, декодер которых в pydicom написан на Python и держит GIL: кадры таких
+# объектов параллельно декодируются только в пуле процессов
+GIL_BOUND_TRANSFER_SYNTAXES = frozenset({RLELossless})
+
+
+def prefetch_frames_from_env():
+    return int_from_env('DICOM_PREFETCH_FRAMES', DEFAULT_PREFETCH_FRAMES, minimum=0)
+
+
+def decode_workers_from_env():
+    return int_from_env('DICOM_DECODE_WORKERS', os.cpu_count() or 1, minimum=0)
+
+
+def number_of_frames(ds):
+    try:
+        return max(1, int(getattr(ds, 'NumberOfFrames', 1) or 1))
+    except (TypeError, ValueError):
+        return 1
+
+
+def decode_frame(transfer_syntax, pixel_module, fragment):
+    """Декодирует один сжатый кадр через обработчики pydicom (как однокадровый объект).
+    Функция модульного уровня: вызывается и в пуле процессов."""
+    frame_ds = Dataset()
+    frame_ds.file_meta = FileMetaDataset()
+    frame_ds.file_meta.TransferSyntaxUID = transfer_syntax
+    for keyword, value in pixel_module.items():
+        setattr(frame_ds, keyword, value)
+    frame_ds.NumberOfFrames = 1
+    frame_ds.PixelData = encapsulate([fragment])
+    frame_ds['PixelData'].is_undefined_length = True
+    frame_ds.is_little_endian = True
+    frame_ds.is_implicit_VR = False
+    return frame_ds.pixel_array
+
+
+def _decode_into(out, index, transfer_syntax, pixel_module, fragment):
+    out[index] = decode_frame(transfer_syntax, pixel_module, fragment)
+
+
+def decode_frames(transfer_syntax, pixel_module, fragments, executor=None, known=None):
+    """Декодирует все кадры в один заранее выделенный массив (кадры, строки, столбцы[, каналы]).
+
+    Форма и тип берутся из первого кадра; остальные кадры декодируются в executor
+    независимо друг от друга. В пуле потоков каждый воркер пишет кадр прямо в свой
+    срез выходного массива — без списка кадров и np.stack; из пула процессов кадр
+    возвращается сериализованным и копируется в срез в этом процессе.
+    known — уже декодированные кадры {индекс: массив}, они не декодируются повторно.
+    Без executor кадры декодируются по очереди в текущем потоке.
+    """
+    known = known or {}
+    first = known.get(0)
+    if first is None:
+        first = decode_frame(transfer_syntax, pixel_module, fragments[0])
+    out = np.empty((len(fragments),) + first.shape, dtype=first.dtype)
+    out[0] = first
+    pending = []
+    for index in range(1, len(fragments)):
+        if index in known:
+            out[index] = known[index]
+        else:
+            pending.append(index)
+
+    if executor is None:
+        for index in pending:
+            _decode_into(out, index, transfer_syntax, pixel_module, fragments[index])
+    elif isinstance(executor, ProcessPoolExecutor):
+        # Кадры отправляются пачками: накладные расходы на задачу меньше, чем на кадр
+        chunksize = max(1, len(pending) // 32)
+        decoded = executor.map(decode_frame, [transfer_syntax] * len(pending), [pixel_module] * len(pending),
+                               [fragments[index] for index in pending], chunksize=chunksize)
+        for index, frame in zip(pending, decoded):
+            out[index] = frame
+    else:
+        futures = [executor.submit(_decode_into, out, index, transfer_syntax, pixel_module, fragments[index])
+                   for index in pending]
+        for future in futures:
+            future.result()
+    return out
+
+
+class FrameSource:
+    """Доступ к кадрам изображения без декодирования всего cine сразу.
+
+    - несжатые данные: кадр — представление (view) байтов PixelData, без копирования;
+    - сжатые (encapsulated): каждый кадр декодируется отдельно по запросу и кладётся
+      в LRU декодированных кадров с ограничением по объёму; если весь cine помещается
+      в бюджет, decode_all декодирует его параллельно в один массив;
+    - прочие случаи и одиночное изображение: кадры берутся из уже декодированного массива.
+    """
+
+    def __init__(self, ds=None, array=None, max_cached_bytes=None):
+        self._native = None
+        self._encoded = None
+        self._array = None
+        self._transfer_syntax = None
+        self._decoded = OrderedDict()
+        self._decoded_bytes = 0
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        if max_cached_bytes is None:
+            max_cached_bytes = int_from_env('DICOM_FRAME_CACHE_BYTES', DEFAULT_FRAME_CACHE_BYTES)
+        self.max_cached_bytes = max_cached_bytes
+
+        if array is not None:
+            self._array = array[np.newaxis]
+            self.number_of_frames = 1
+            self.frame_shape = array.shape
+            self.dtype = array.dtype
+            return
+
+        frames = number_of_frames(ds)
+        self.number_of_frames = frames
+        samples = int(getattr(ds, 'SamplesPerPixel', 1) or 1)
+        self.frame_shape = (int(ds.Rows), int(ds.Columns)) + ((samples,) if samples > 1 else ())
+        self._planar = int(getattr(ds, 'PlanarConfiguration', 0) or 0) == 1 and samples > 1
+        transfer_syntax = getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', None)
+
+        # Ссылку на сам Dataset не храним: нужны только байты PixelData и модуль Image Pixel
+        if transfer_syntax is not None and transfer_syntax.is_compressed and 'PixelData' in ds:
+            self._encoded = list(generate_pixel_data_frame(ds.PixelData, frames))
+            self._transfer_syntax = transfer_syntax
+            self._pixel_module = {k: ds[k].value for k in _PIXEL_MODULE_KEYWORDS if k in ds}
+            self._bits_allocated = int(getattr(ds, 'BitsAllocated', 8) or 8)
+            self.dtype = None  # станет известен после первого декодирования
+        elif self.can_view_native(ds):
+            self.dtype = pixel_dtype(ds)
+            self._native = np.frombuffer(ds.PixelData, dtype=self.dtype,
+                                         count=frames * int(np.prod(self.frame_shape)))
+        else:
+            # Редкие варианты (1 бит, YBR_FULL_422, float-данные) — через обычный pixel_array
+            array = ds.pixel_array
+            self._array = array if frames > 1 else array[np.newaxis]
+            self.dtype = self._array.dtype
+
+    @staticmethod
+    def can_view_native(ds):
+        """Несжатые little-endian данные, которые можно отдавать как view без копирования."""
+        transfer_syntax = getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', None)
+        return (
+            'PixelData' in ds
+            and not (transfer_syntax is not None and transfer_syntax.is_compressed)
+            and getattr(ds, 'is_little_endian', True) is not False
+            and int(getattr(ds, 'BitsAllocated', 0)) in (8, 16, 32)
+            and getattr(ds, 'PhotometricInterpretation', '') != 'YBR_FULL_422'
+            and len(ds.PixelData) >= number_of_frames(ds) * int(ds.Rows) * int(ds.Columns)
+            * int(getattr(ds, 'SamplesPerPixel', 1) or 1) * int(ds.BitsAllocated) // 8
+        )
+
+    @property
+    def is_multiframe(self):
+        return self.number_of_frames > 1
+
+    @property
+    def is_encapsulated(self):
+        """Кадры ещё хранятся сжатыми и декодируются по одному."""
+        return self._encoded is not None
+
+    @property
+    def transfer_syntax(self):
+        return self._transfer_syntax
+
+    @property
+    def decoded_nbytes(self):
+        """Объём всех кадров после декодирования (оценка по BitsAllocated)."""
+        return self.number_of_frames * int(np.prod(self.frame_shape)) * max(1, self._bits_allocated // 8)
+
+    @property
+    def nbytes(self):
+        """Оценка резидентного объёма: исходные (сжатые) байты плюс декодированные кадры,
+        для сжатых данных — не больше бюджета кэша кадров."""
+        if self._native is not None:
+            return int(self._native.nbytes)
+        if self._array is not None:
+            return int(self._array.nbytes)
+        encoded = sum(len(frame) for frame in self._encoded)
+        return encoded + min(self.decoded_nbytes, self.max_cached_bytes)
+
+    def _check_index(self, index):
+        if not 0 <= index < self.number_of_frames:
+            raise IndexError(f"Frame {index} out of range (0..{self.number_of_frames - 1})")
+
+    def frame(self, index):
+        """Пиксели кадра index (хранимые значения, без Rescale)."""
+        self._check_index(index)
+        if self._native is not None:
+            size = int(np.prod(self.frame_shape))
+            flat = self._native[index * size:(index + 1) * size]
+            if self._planar:
+                samples, rows, cols = self.frame_shape[2], self.frame_shape[0], self.frame_shape[1]
+                return flat.reshape(samples, rows, cols).transpose(1, 2, 0)
+            return flat.reshape(self.frame_shape)
+        if self._array is not None:
+            return self._array[index]
+
+        with self._lock:
+            # decode_all мог заменить сжатые кадры массивом, пока мы сюда шли
+            if self._array is not None:
+                return self._array[index]
+            cached = self._decoded.get(index)
+            if cached is not None:
+                self._decoded.move_to_end(index)
+                return cached
+            fragment = self._encoded[index]
+        decoded = decode_frame(self._transfer_syntax, self._pixel_module, fragment)
+        with self._lock:
+            self.dtype = decoded.dtype
+            if index not in self._decoded:
+                self._decoded[index] = decoded
+                self._decoded_bytes += decoded.nbytes
+                while self._decoded_bytes > self.max_cached_bytes and len(self._decoded) > 1:
+                    _, evicted = self._decoded.popitem(last=False)
+                    self._decoded_bytes -= evicted.nbytes
+        return decoded
+
+    def decode_all(self, executor=None):
+        """Декодирует все сжатые кадры в один массив (параллельно в executor) и дальше
+        отдаёт кадры из него как view; сжатые фрагменты и LRU освобождаются.
+        Возвращает False, если декодировать нечего."""
+        with self._lock:
+            if self._encoded is None:
+                return False
+            fragments = self._encoded
+            known = dict(self._decoded)
+        array = decode_frames(self._transfer_syntax, self._pixel_module, fragments, executor, known)
+        with self._lock:
+            self._array = array
+            self.dtype = array.dtype
+            self._encoded = None
+            self._decoded.clear()
+            self._decoded_bytes = 0
+        return True
+
+    def prefetch(self, indices, executor):
+        """Фоновое декодирование кадров (для плавного cine). Несжатые кадры не нуждаются в этом."""
+        if self._encoded is None or executor is None:
+            return
+        for index in indices:
+            if not 0 <= index < self.number_of_frames:
+                continue
+            with self._lock:
+                if index in self._decoded or index in self._in_flight:
+                    continue
+                self._in_flight.add(index)
+            executor.submit(self._prefetch_one, index)
+
+    def _prefetch_one(self, index):
+        try:
+            self.frame(index)
+        except Exception as e:
+            print(f"Не удалось предварительно декодировать кадр {index}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(index)
@@ -0,0 +1,196 @@
+import threading
+from collections import OrderedDict
+
+from wl_engine import WindowLevelEngine
+from pyramid import build_pyramid, pyramid_extra_bytes
+from roi import SummedAreaTable
+from settings import int_from_env
+
+
+# Бюджет памяти кэша по умолчанию (можно переопределить переменной окружения)
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1 GB
+
+
+class CachedImage:
+    """Запись кэша: хранимые (не пересчитанные) пиксели одного изображения,
+    параметры Rescale и данные для перерисовки.
+
+    Для multi-frame объектов pixels — первый кадр, а остальные кадры выдаёт
+    frames (FrameSource) по требованию. dataset — разобранный исходный файл
+    (для экспорта без повторной загрузки); dataset_bytes — его объём сверх пикселей.
+    stats — гистограмма хранимых значений (ImageStats), presets — готовые окна W/L.
+    Таблицы накопленных сумм для ROI строятся лениво (для последнего запрошенного кадра).
+    """
+
+    def __init__(self, image_id, pixels, photometric_interpretation, initial_wc, initial_ww,
+                 slope=1.0, intercept=0.0, value_range=None, frames=None, dataset=None, dataset_bytes=0,
+                 stats=None, presets=None):
+        self.image_id = image_id
+        self.pixels = pixels
+        self.frames = frames
+        self.dataset = dataset
+        self.dataset_bytes = dataset_bytes
+        self.stats = stats
+        self.presets = presets or []
+        self._pyramid = None
+        self._pyramid_lock = threading.Lock()
+        self._summed_area = None  # (кадр, SummedAreaTable)
+        self._summed_area_lock = threading.Lock()
+        self.photometric_interpretation = photometric_interpretation
+        self.initial_wc = initial_wc
+        self.initial_ww = initial_ww
+        self.slope = slope
+        self.intercept = intercept
+        self.wl_engine = WindowLevelEngine(
+            pixels, slope, intercept,
+            invert=photometric_interpretation == "MONOCHROME1",
+            value_range=value_range,
+        )
+
+    @property
+    def number_of_frames(self):
+        return self.frames.number_of_frames if self.frames is not None else 1
+
+    def frame_pixels(self, index):
+        """Хранимые пиксели кадра index (для одиночного изображения допустим только 0)."""
+        if self.frames is not None:
+            return self.frames.frame(index)
+        if index != 0:
+            raise IndexError(f"Frame {index} out of range (0..0)")
+        return self.pixels
+
+    @property
+    def pyramid(self):
+        """Уровни разрешения хранимых пикселей (кадр 0); строятся один раз при первом обращении."""
+        with self._pyramid_lock:
+            if self._pyramid is None:
+                self._pyramid = build_pyramid(self.pixels)
+            return self._pyramid
+
+    def summed_area(self, index=0):
+        """Таблицы накопленных сумм кадра index; (SummedAreaTable, построены ли сейчас)."""
+        with self._summed_area_lock:
+            if self._summed_area is not None and self._summed_area[0] == index:
+                return self._summed_area[1], False
+            # Таблицы предыдущего кадра освобождаются до построения новых
+            self._summed_area = None
+            table = SummedAreaTable(self.frame_pixels(index))
+            self._summed_area = (index, table)
+            return table, True
+
+    @property
+    def nbytes(self):
+        """Резидентный объём записи: хранимые пиксели (или кадры), уровни пирамиды
+        (учитываются заранее, даже если ещё не построены), исходный набор данных,
+        таблицы движка W/L и таблицы ROI (только если построены)."""
+        pixels_bytes = self.frames.nbytes if self.frames is not None else int(getattr(self.pixels, 'nbytes', 0))
+        summed_area = self._summed_area
+        return (pixels_bytes + pyramid_extra_bytes(self.pixels) + self.dataset_bytes + self.wl_engine.nbytes
+                + (self.stats.nbytes if self.stats is not None else 0)
+                + (summed_area[1].nbytes if summed_area is not None else 0))
+
+
+class ImageCache:
+    """LRU-кэш изображений по handle с ограничением по объёму памяти.
+
+    Изображение, превышающее бюджет целиком, всё равно сохраняется (как
+    единственная запись) — иначе с ним нельзя было бы работать через /update_wl/.
+    on_evict(image_id) вызывается для вытесненных записей вне блокировки кэша.
+    """
+
+    def __init__(self, max_bytes=None, on_evict=None):
+        self.max_bytes = int_from_env('DICOM_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES) if max_bytes is None else int(max_bytes)
+        self.on_evict = on_evict
+        # image_id -> (запись, учтённый объём в байтах на момент добавления)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, entry):
+        with self._lock:
+            old = self._entries.pop(entry.image_id, None)
+            if old is not None:
+                self._bytes -= old[1]
+            size = entry.nbytes
+            self._entries[entry.image_id] = (entry, size)
+            self._bytes += size
+            evicted = self._evict_locked()
+        self._notify(evicted)
+
+    def refresh(self, image_id):
+        """Пересчитывает учтённый объём записи после ленивого построения её данных
+        (таблицы ROI) и вытесняет старые записи, если бюджет превышен."""
+        with self._lock:
+            item = self._entries.get(image_id)
+            if item is None:
+                return
+            entry, old_size = item
+            size = entry.nbytes
+            self._entries[image_id] = (entry, size)
+            self._bytes += size - old_size
+            evicted = self._evict_locked()
+        self._notify(evicted)
+
+    def get(self, image_id=None):
+        """Возвращает запись по handle; без handle — последнюю использованную."""
+        with self._lock:
+            if image_id is None:
+                if not self._entries:
+                    self.misses += 1
+                    return None
+                image_id = next(reversed(self._entries))
+            item = self._entries.get(image_id)
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(image_id)
+            self.hits += 1
+            return item[0]
+
+    def __contains__(self, image_id):
+        with self._lock:
+            return image_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            removed = list(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+        self._notify(removed)
+
+    def _evict_locked(self):
+        """Вытесняет старые записи сверх бюджета; возвращает их handle."""
+        evicted = []
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            image_id, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            evicted.append(image_id)
+        return evicted
+
+    def _notify(self, image_ids):
+        if self.on_evict is not None:
+            for image_id in image_ids:
+                self.on_evict(image_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "images": [
+                    {"image_id": image_id, "bytes": size}
+                    for image_id, (_, size) in self._entries.items()
+                ],
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,48 @@
+import io
+
+from PIL import Image
+
+
+# Форматы ответа рендер-эндпоинтов. 'json' — прежний вариант (PNG в base64 внутри JSON),
+# остальные отдаются бинарным телом ответа без base64.
+RESPONSE_FORMATS = ('json', 'raw', 'png', 'jpeg', 'webp')
+
+MEDIA_TYPES = {
+    'raw': 'application/octet-stream',
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+# Для интерактивного W/L важна скорость, а не размер: zlib уровня 1 в разы быстрее
+# уровня по умолчанию (6) при небольшом проигрыше в размере
+FAST_PNG_COMPRESS_LEVEL = 1
+
+
+def encode_image(pixels_8bit, fmt, quality=90):
+    """Кодирует 8-битное изображение (H, W) или (H, W, 3) в байты заданного формата."""
+    if fmt == 'raw':
+        return pixels_8bit.tobytes()
+    image = Image.fromarray(pixels_8bit)
+    img_buffer = io.BytesIO()
+    if fmt == 'png':
+        image.save(img_buffer, format="PNG", compress_level=FAST_PNG_COMPRESS_LEVEL)
+    elif fmt == 'jpeg':
+        image.save(img_buffer, format="JPEG", quality=quality)
+    elif fmt == 'webp':
+        # method=0 — самый быстрый режим кодировщика WebP
+        image.save(img_buffer, format="WEBP", quality=quality, method=0)
+    else:
+        raise ValueError(f"Unsupported image format: {fmt}")
+    return img_buffer.getvalue()
+
+
+def image_headers(pixels_8bit):
+    """Размеры изображения для бинарного ответа (обязательны для 'raw')."""
+    height, width = pixels_8bit.shape[0], pixels_8bit.shape[1]
+    channels = pixels_8bit.shape[2] if pixels_8bit.ndim == 3 else 1
+    return {
+        "X-Image-Width": str(width),
+        "X-Image-Height": str(height),
+        "X-Image-Channels": str(channels),
+    }
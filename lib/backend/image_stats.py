@@ -0,0 +1,159 @@
+import numpy as np
+
+from wl_engine import _LUT_INDEX_DTYPES
+
+
+# Сколько пикселей считать за один вызов bincount: временный intp-массив ~8 MB
+STATS_CHUNK_PIXELS = 1024 * 1024
+
+# Разрешение гистограммы для float- и 32-битных данных, где нельзя посчитать каждое значение
+FINE_HISTOGRAM_BINS = 4096
+
+# Верхний предел числа бинов гистограммы в ответе /image_stats/
+MAX_HISTOGRAM_BINS = 4096
+
+PERCENTILES = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5)
+
+# Стандартные окна КТ (единицы HU): (id, название, центр, ширина)
+CT_PRESETS = (
+    ("ct_soft_tissue", "Soft tissue", 40.0, 400.0),
+    ("ct_lung", "Lung", -600.0, 1500.0),
+    ("ct_bone", "Bone", 400.0, 1800.0),
+    ("ct_brain", "Brain", 40.0, 80.0),
+    ("ct_mediastinum", "Mediastinum", 50.0, 350.0),
+)
+
+
+class ImageStats:
+    """Распределение значений изображения (в единицах модальности, после Rescale).
+
+    values — возрастающие значения (для целочисленных данных — каждое встречающееся
+    хранимое значение, для float — центры мелких бинов), counts — число пикселей.
+    Из этой пары без повторного прохода по пикселям считаются перцентили, среднее
+    и гистограмма с любым числом бинов.
+    """
+
+    def __init__(self, values, counts, stored_range=None):
+        self.values = values
+        self.counts = counts
+        self.total = int(counts.sum())
+        self._cumulative = np.cumsum(counts)
+        # Диапазон хранимых значений (для LUT движка W/L) — побочный результат подсчёта
+        self.stored_range = stored_range
+
+    @property
+    def nbytes(self):
+        return int(self.values.nbytes + self.counts.nbytes + self._cumulative.nbytes)
+
+    @property
+    def min(self):
+        return float(self.values[0]) if self.total else 0.0
+
+    @property
+    def max(self):
+        return float(self.values[-1]) if self.total else 0.0
+
+    def percentile(self, p):
+        if not self.total:
+            return 0.0
+        rank = min(self.total - 1, int(p / 100.0 * self.total))
+        return float(self.values[np.searchsorted(self._cumulative, rank, side='right')])
+
+    def summary(self):
+        if not self.total:
+            return {"min": 0.0, "max": 0.0, "mean": 0.0, "std": 0.0, "count": 0, "percentiles": {}}
+        weights = self.counts / self.total
+        mean = float(np.dot(self.values, weights))
+        std = float(np.sqrt(max(0.0, np.dot((self.values - mean) ** 2, weights))))
+        return {
+            "min": self.min,
+            "max": self.max,
+            "mean": mean,
+            "std": std,
+            "count": self.total,
+            "percentiles": {str(p): self.percentile(p) for p in PERCENTILES},
+        }
+
+    def histogram(self, bins=256):
+        """Гистограмма с равными бинами на [min, max] (пересчёт из values/counts)."""
+        counts, edges = np.histogram(self.values, bins=bins, range=(self.min, self.max or self.min + 1.0),
+                                     weights=self.counts)
+        return {"bins": int(bins), "min": float(edges[0]), "max": float(edges[-1]),
+                "counts": counts.astype(np.int64).tolist()}
+
+
+def compute_stats(pixels, slope=1.0, intercept=0.0):
+    """Один векторизованный проход по пикселям: счётчики хранимых значений.
+
+    Для 8/16-битных данных — точный подсчёт каждого значения (bincount по
+    беззнаковому представлению, кусками), для остальных — мелкая гистограмма.
+    """
+    index_dtype = _LUT_INDEX_DTYPES.get(pixels.dtype)
+    if index_dtype is None or not pixels.size:
+        return _compute_fine_stats(pixels, slope, intercept)
+
+    size = np.iinfo(index_dtype).max + 1
+    flat = pixels.view(index_dtype).reshape(-1)
+    counts = np.zeros(size, dtype=np.int64)
+    for start in range(0, flat.size, STATS_CHUNK_PIXELS):
+        counts += np.bincount(flat[start:start + STATS_CHUNK_PIXELS], minlength=size)
+
+    stored = np.arange(size, dtype=np.int64)
+    if np.issubdtype(pixels.dtype, np.signedinteger):
+        # Индексы от size/2 — отрицательные значения: переставляем в порядке возрастания
+        half = size // 2
+        counts = np.concatenate([counts[half:], counts[:half]])
+        stored = stored - half
+    present = np.flatnonzero(counts)
+    first, last = present[0], present[-1]
+    counts, stored = counts[first:last + 1], stored[first:last + 1]
+    return ImageStats(*_rescaled(stored, counts, slope, intercept), stored_range=(int(stored[0]), int(stored[-1])))
+
+
+def _compute_fine_stats(pixels, slope, intercept):
+    if not pixels.size:
+        return ImageStats(np.zeros(1), np.zeros(1, dtype=np.int64))
+    vmin, vmax = float(np.min(pixels)), float(np.max(pixels))
+    counts, edges = np.histogram(pixels, bins=FINE_HISTOGRAM_BINS, range=(vmin, vmax if vmax > vmin else vmin + 1.0))
+    centers = (edges[:-1] + edges[1:]) / 2.0
+    centers[0], centers[-1] = vmin, max(vmin, vmax)
+    keep = counts > 0
+    return ImageStats(*_rescaled(centers[keep], counts[keep].astype(np.int64), slope, intercept))
+
+
+def _rescaled(stored, counts, slope, intercept):
+    values = stored.astype(np.float64) * slope + intercept
+    if slope < 0:
+        return values[::-1].copy(), counts[::-1].copy()
+    return values, counts
+
+
+def _preset(preset_id, name, center, width):
+    return {"id": preset_id, "name": name, "window_center": float(center), "window_width": float(max(width, 1.0))}
+
+
+def full_range_window(stats):
+    return (stats.min + stats.max) / 2.0, max(stats.max - stats.min, 1.0)
+
+
+def percentile_window(stats, low=1, high=99):
+    low, high = stats.percentile(low), stats.percentile(high)
+    return (low + high) / 2.0, max(high - low, 1.0)
+
+
+def auto_window(stats):
+    """Окно по умолчанию для изображений без окна в заголовке: 1–99 перцентиль."""
+    return percentile_window(stats, 1, 99)
+
+
+def window_presets(stats, modality='', header_window=None):
+    """Автоматические окна: из заголовка, весь диапазон, 1–99 перцентиль и окна модальности."""
+    presets = []
+    if header_window is not None:
+        presets.append(_preset("header", "Header", *header_window))
+    presets.append(_preset("full_range", "Full range", *full_range_window(stats)))
+    presets.append(_preset("p1_p99", "1-99 percentile", *percentile_window(stats, 1, 99)))
+    presets.append(_preset("p5_p95", "5-95 percentile", *percentile_window(stats, 5, 95)))
+    if (modality or '').upper() == 'CT':
+        presets.extend(_preset(*preset) for preset in CT_PRESETS)
+    return presets
@@ -0,0 +1,104 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+# Сколько завершённых заданий хранится для опроса прогресса
+MAX_FINISHED_JOBS = 32
+# Сколько ошибок (и пропущенных файлов) по отдельным файлам попадает в отчёт задания
+MAX_JOB_ERRORS = 20
+
+
+class BatchJob:
+    """Прогресс фонового пакетного задания над файлами: счётчики, объёмы и пропускная
+    способность. Обновляется из event loop по мере завершения файлов, читается /jobs/."""
+
+    def __init__(self, kind, total, **details):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.total = total
+        self.details = details
+        self.state = 'running'
+        self.processed = 0
+        self.written = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.errors = []
+        self.skipped_files = []
+        self.started = time.perf_counter()
+        self.finished = None
+        # asyncio-задача, выполняющая задание (ссылка не даёт сборщику мусора её удалить)
+        self.task = None
+        self._lock = threading.Lock()
+
+    def record(self, path, result=None, error=None):
+        """Итог одного файла: (прочитано, записано) байт, None — не DICOM, либо ошибка."""
+        with self._lock:
+            self.processed += 1
+            if error is not None:
+                self.failed += 1
+                if len(self.errors) < MAX_JOB_ERRORS:
+                    self.errors.append({"path": path, "error": error})
+            elif result is None:
+                self.skipped += 1
+                if len(self.skipped_files) < MAX_JOB_ERRORS:
+                    self.skipped_files.append(path)
+            else:
+                self.written += 1
+                self.bytes_read += result[0]
+                self.bytes_written += result[1]
+
+    def finish(self, state='done'):
+        with self._lock:
+            self.state = state
+            self.finished = time.perf_counter()
+
+    def report(self):
+        with self._lock:
+            elapsed = (self.finished or time.perf_counter()) - self.started
+            rate = elapsed if elapsed > 0 else float('inf')
+            return dict(self.details, **{
+                "job_id": self.job_id,
+                "kind": self.kind,
+                "state": self.state,
+                "total": self.total,
+                "processed": self.processed,
+                "written": self.written,
+                "skipped": self.skipped,
+                "failed": self.failed,
+                "progress": round(self.processed / self.total, 4) if self.total else 1.0,
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+                "elapsed_s": round(elapsed, 3),
+                "files_per_s": round(self.processed / rate, 1),
+                "mb_per_s": round((self.bytes_read + self.bytes_written) / 1e6 / rate, 1),
+                "errors": list(self.errors),
+                "skipped_files": list(self.skipped_files),
+            })
+
+
+class JobRegistry:
+    """Задания по job_id; завершённые сверх MAX_FINISHED_JOBS забываются (старые первыми)."""
+
+    def __init__(self):
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._jobs[job.job_id] = job
+            finished = [job_id for job_id, j in self._jobs.items() if j.state != 'running']
+            for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self._jobs[job_id]
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
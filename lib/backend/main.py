@@ -1,32 +1,290 @@
-from fastapi import FastAPI, UploadFile, File, Form
-from typing import Optional
-from fastapi.responses import JSONResponse
+import sys
+
+if __name__ == "__main__":
+    # `python main.py` запускает `python -m uvicorn main:app` дочерним процессом, не строя
+    # приложение здесь: процессы пулов (spawn) заново импортируют главный модуль, и если бы
+    # им был main.py, каждый поднимал бы собственные пулы, кэши и фоновые потоки
+    import subprocess
+    print("Запуск сервера на http://127.0.0.1:8000")
+    sys.exit(subprocess.call([sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', '8000']))
+
+from startup import StartupTimer
+# Засекаем до тяжёлых импортов (FastAPI, pydicom, NumPy, Pillow), чтобы видеть их долю в запуске
+startup_timer = StartupTimer()
+from fastapi import FastAPI, UploadFile, File, Form, WebSocket, WebSocketDisconnect
+from typing import List, Optional
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import pydicom
 import json
 import numpy as np
 import io
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image
 from pydicom.uid import ExplicitVRLittleEndian
 import base64
 from pydicom.pixel_data_handlers.util import apply_voi_lut
-from pydicom.datadict import tag_for_keyword, dictionary_VR
+import hashlib
+from contextlib import ExitStack
+import os
+import tempfile
+import time
+import uuid
+import asyncio
+from image_cache import CachedImage, ImageCache
+from wl_engine import WindowLevelEngine, wl_gamma, brightness_gamma
+from image_encoding import RESPONSE_FORMATS, MEDIA_TYPES, FAST_PNG_COMPRESS_LEVEL, encode_image, image_headers
+from workers import create_executor, create_process_pool, export_workers_from_env, run_blocking, LatestRequestTracker, SupersededError, LatestSlot
+from frames import FrameSource, GIL_BOUND_TRANSFER_SYNTAXES, decode_workers_from_env, number_of_frames, prefetch_frames_from_env
+from series_index import SeriesIndex, index_workers_from_env, list_files
+from dicom_io import open_dataset, load_deferred, copy_dataset, first_float
+from pyramid import TILE_SIZE, TileCache, pyramid_shapes, tile_range
+from pixel_cache import DiskPixelCache, content_hash
+from metrics import TimingMiddleware, registry, server_timing_from_env, stage, stage_since_request_start, count_bytes, not_recorded
+from image_stats import MAX_HISTOGRAM_BINS, compute_stats, auto_window, window_presets
+from roi import ROI_SHAPES, roi_stats
+from jobs import BatchJob, JobRegistry
+from thumbnails import ThumbnailCache, ThumbnailWorker, PRIORITY_REQUESTED, PRIORITY_SERIES, PRIORITY_INSTANCE
+from collections import deque
+import threading
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import RLELossless, generate_uid
+startup_timer.mark('imports')
 
 app = FastAPI()
+# Тайминги этапов каждого запроса: /metrics и (DICOM_SERVER_TIMING=1) заголовок Server-Timing
+app.add_middleware(TimingMiddleware, server_timing=server_timing_from_env())
+
+# --- Пул воркеров для декодирования/рендера (DICOM_RENDER_WORKERS, 0 — в event loop) ---
+render_executor = create_executor()
+# Отдельный поток для упреждающего декодирования кадров cine, чтобы оно не занимало
+# воркеры интерактивного рендера (DICOM_PREFETCH_FRAMES=0 — выключено)
+PREFETCH_FRAMES = prefetch_frames_from_env()
+prefetch_executor = create_executor(1) if PREFETCH_FRAMES else None
+# Параллельное декодирование кадров сжатого multi-frame (DICOM_DECODE_WORKERS, 0 — по очереди)
+decode_executor = create_executor(decode_workers_from_env())
+# Последний W/L-запрос по сессии/изображению: устаревшие запросы отбрасываются
+wl_requests = LatestRequestTracker()
+
+# --- Кэш сырых данных изображений по handle (SOPInstanceUID или хэш содержимого) ---
+dicom_cache = ImageCache(on_evict=wl_requests.discard)
+
+# --- Отрендеренные тайлы пирамиды для /render_viewport/ ---
+tile_cache = TileCache()
+
+# --- Декодированные пиксели сжатых изображений на диске: повторное открытие без декодирования ---
+pixel_cache = DiskPixelCache()
+
+# --- Пул процессов пакетного экспорта (DICOM_EXPORT_WORKERS; процессы стартуют при первой задаче) ---
+EXPORT_WORKERS = export_workers_from_env()
+export_pool = create_process_pool(EXPORT_WORKERS)
+
+# --- Миниатюры срезов: дисковый кэш и фоновый поток с пониженным приоритетом ---
+thumbnail_cache = ThumbnailCache()
+thumbnail_worker = ThumbnailWorker(thumbnail_cache)
+
+# --- Фоновые пакетные задания (перезапись папок) и их прогресс ---
+batch_jobs = JobRegistry()
+
+# --- Индекс серий, открытых из папки: только заголовки, пиксели — по требованию ---
+series_index = SeriesIndex()
+# Собранные объёмы серий для MPR (DICOM_VOLUME_CACHE_BYTES) — создаются при первом обращении
+_volume_cache = None
+_volume_cache_lock = threading.Lock()
+# Отдельный пул для чтения заголовков: индексирование тысяч файлов не занимает воркеры рендера
+index_executor = create_executor(index_workers_from_env())
+
+def get_volume_cache():
+    """Кэш объёмов серий. Модули MPR, экспорта и обезличивания (volume, export с
+    PIL.ImageDraw/ImageFont и zipfile, anonymize) импортируются при первом использовании,
+    а не при запуске: в сеансе просмотра одного снимка они не нужны."""
+    global _volume_cache
+    with _volume_cache_lock:
+        if _volume_cache is None:
+            from volume import VolumeCache
+            _volume_cache = VolumeCache(on_evict=wl_requests.discard)
+        return _volume_cache
 
-# --- Кэш для хранения сырых данных последнего файла ---
-dicom_cache = {}
 
 @app.get("/")
 async def health_check():
-    """Простая проверка доступности сервера."""
-    return {"status": "ok", "message": "DICOM Viewer Backend is running"}
+    """Проверка доступности сервера. state: warming — запросы уже принимаются, но первый
+    может быть медленнее (идёт прогрев), ready — прогрев завершён."""
+    return {
+        "status": "ok",
+        "message": "DICOM Viewer Backend is running",
+        "state": startup_timer.state,
+        "startup": startup_timer.report(),
+    }
+
+
+def warm_up():
+    """Прогрев в фоне после старта: проходит путь первой загрузки (dcmread, декодер RLE,
+    статистика, LUT W/L, кодеки PNG/JPEG/WebP) на маленьком синтетическом изображении,
+    чтобы ленивые импорты и первичная инициализация не доставались первому запросу.
+    Кэши не затрагиваются."""
+    file_meta = FileMetaDataset()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.Rows, ds.Columns = 64, 64
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 1
+    ds.PixelData = (np.arange(64 * 64, dtype=np.int16) % 4096).tobytes()
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.compress(RLELossless)
+    buffer = io.BytesIO()
+    ds.save_as(buffer, write_like_original=False)
+    with open_dataset(buffer.getvalue()) as (dataset, _):
+        pixels = dataset.pixel_array
+    stats = compute_stats(pixels, 1.0, -1024.0)
+    engine = WindowLevelEngine(pixels, 1.0, -1024.0, value_range=stats.stored_range)
+    image = engine.render(*auto_window(stats))
+    encode_png_base64(image)
+    for fmt in ('jpeg', 'webp'):
+        try:
+            encode_image(image, fmt)
+        except Exception as e:
+            print(f"Прогрев: формат {fmt} недоступен: {e}")
+
+
+def _run_warm_up():
+    try:
+        with not_recorded():
+            warm_up()
+    except Exception as e:
+        print(f"Прогрев не удался: {e}")
+    startup_timer.mark('warm_up')
+    startup_timer.set_state('ready')
+    print(startup_timer.summary())
+
+
+@app.on_event("startup")
+async def start_warm_up():
+    # Сервер уже принимает соединения: прогрев не задерживает ответ health-check
+    startup_timer.mark('server_start')
+    startup_timer.set_state('warming')
+    threading.Thread(target=_run_warm_up, name='dicom-warm-up', daemon=True).start()
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в формате Prometheus: гистограммы этапов и запросов, объёмы данных,
+    состояние кэшей и запуска."""
+    gauges = {}
+    for prefix, stats in (('dicom_image_cache', dicom_cache.stats()), ('dicom_tile_cache', tile_cache.stats()),
+                          ('dicom_disk_cache', pixel_cache.stats()), ('dicom_thumbnail_cache', thumbnail_cache.stats())):
+        for key in ('entries', 'tiles', 'bytes', 'max_bytes'):
+            if key in stats:
+                gauges[f"{prefix}_{key}"] = stats[key]
+        for key in ('hits', 'misses', 'evictions', 'writes', 'corrupt'):
+            if key in stats:
+                gauges[f"{prefix}_{key}_total"] = stats[key]
+    report = startup_timer.report()
+    for phase, ms in report["phases_ms"].items():
+        gauges[f"dicom_startup_{phase}_seconds"] = ms / 1000.0
+    if report["time_to_first_image_ms"] is not None:
+        gauges["dicom_time_to_first_image_seconds"] = report["time_to_first_image_ms"] / 1000.0
+    gauges["dicom_ready"] = 1 if report["state"] == 'ready' else 0
+    return Response(content=registry.render(gauges), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache_stats/")
+async def cache_stats():
+    """Счётчики кэша изображений (hits/misses/evictions) для подбора бюджета памяти."""
+    stats = dicom_cache.stats()
+    stats["tiles"] = tile_cache.stats()
+    stats["disk"] = pixel_cache.stats()
+    stats["volumes"] = get_volume_cache().stats()
+    stats["thumbnails"] = dict(thumbnail_worker.stats(), cache=thumbnail_cache.stats())
+    return stats
 
 # --- Модель для получения данных от Flutter ---
 class WindowLevelRequest(BaseModel):
     window_center: float
     window_width: float
     brightness: float = 1.0
+    # Handle изображения из ответа /process_dicom/; без него — последнее открытое
+    image_id: Optional[str] = None
+    # Формат ответа: json (PNG base64 в JSON) | raw | png | jpeg | webp
+    format: str = 'json'
+    quality: int = 90
+    # Идентификатор окна/клиента: более новый запрос той же сессии отменяет старый
+    session_id: Optional[str] = None
+    # Номер кадра multi-frame объекта (для одиночного изображения — 0)
+    frame: int = 0
+
+
+class RenderChannelRequest(WindowLevelRequest):
+    # Сообщение канала /ws/render/: по умолчанию бинарный PNG, seq возвращается в ответе
+    format: str = 'png'
+    seq: Optional[int] = None
+
+class ViewportRequest(BaseModel):
+    # Уровень пирамиды (0 — полное разрешение) и область в пикселях этого уровня
+    level: int = 0
+    x: int = 0
+    y: int = 0
+    width: int
+    height: int
+    window_center: float
+    window_width: float
+    brightness: float = 1.0
+    image_id: Optional[str] = None
+    format: str = 'png'
+    quality: int = 90
+    session_id: Optional[str] = None
+
+class MprRequest(BaseModel):
+    # Серия из /index_folder/, плоскость (axial | coronal | sagittal) и номер среза в ней
+    series_uid: str
+    plane: str = 'axial'
+    index: Optional[int] = None  # по умолчанию — середина
+    window_center: Optional[float] = None
+    window_width: Optional[float] = None
+    brightness: float = 1.0
+    format: str = 'png'
+    quality: int = 90
+    session_id: Optional[str] = None
+
+class RoiRequest(BaseModel):
+    # Прямоугольник (или описанный вокруг эллипса) в пикселях изображения полного разрешения
+    shape: str = 'rectangle'  # rectangle | ellipse
+    x: float
+    y: float
+    width: float
+    height: float
+    image_id: Optional[str] = None
+    frame: int = 0
+
+class ExportItem(BaseModel):
+    # Изображение из кэша (image_id) или локальный файл (path) и его изменения
+    image_id: Optional[str] = None
+    path: Optional[str] = None
+    metadata: Optional[dict] = None  # {"tags": {keyword: value}, "report": ...}
+    annotations: Optional[dict] = None  # {"texts": [...], "arrows": [...], "rulers": [...]}
+    filename: Optional[str] = None
+
+class ExportBatchRequest(BaseModel):
+    items: List[ExportItem]
+    format: str = 'zip'  # zip | multipart
+
+class RewriteFolderRequest(BaseModel):
+    # Папка-источник и папка результата (структура подпапок сохраняется)
+    path: str
+    output_path: str
+    recursive: bool = True
+    profile: str = 'basic'  # basic — обезличивание, none — только правка тегов
+    tags: dict = {}
+    report: Optional[str] = None
+    # Соль псевдонимов и новых UID: одна соль — одинаковые замены в разных заданиях
+    salt: Optional[str] = None
+
+class FolderRequest(BaseModel):
+    # Локальный путь к папке с исследованием/серией
+    path: str
+    recursive: bool = True
+
 def _safe_str(value):
     try:
         return str(value)
@@ -100,8 +358,16 @@ def extract_report(ds):
     return ''
 
 
-def render_pixels_to_base64(pixels, photometric_interpretation):
-    """Вспомогательная функция, которая рендерит 8-битную картинку."""
+def make_image_id(ds, contents):
+    """Handle изображения: SOPInstanceUID, а если его нет — хэш содержимого файла."""
+    sop_uid = _safe_str(getattr(ds, 'SOPInstanceUID', '')).strip()
+    if sop_uid:
+        return sop_uid
+    return hashlib.sha1(contents).hexdigest()
+
+
+def to_display_uint8(pixels, photometric_interpretation):
+    """Нормализует пиксели после VOI LUT к 0-255 по их min/max."""
     if photometric_interpretation == "MONOCHROME1":
         pixels = np.amax(pixels) - pixels
     
@@ -110,87 +376,279 @@ def render_pixels_to_base64(pixels, photometric_interpretation):
     if max_val > 0:
         pixels_8bit = pixels_8bit / max_val
     
-    pixels_8bit = (pixels_8bit * 255).astype(np.uint8)
+    return (pixels_8bit * 255).astype(np.uint8)
 
-    image = Image.fromarray(pixels_8bit)
-    img_buffer = io.BytesIO()
-    image.save(img_buffer, format="PNG")
-    return base64.b64encode(img_buffer.getvalue()).decode('utf-8')
 
-@app.post("/process_dicom/")
-async def process_dicom_file(file: UploadFile = File(...)):
-    """Первоначальная загрузка файла."""
-    try:
-        print(f"Получен файл: {file.filename}, размер: {file.size} байт")
-        contents = await file.read()
-        print(f"Файл прочитан, размер содержимого: {len(contents)} байт")
-        
-        # Проверяем размер файла
-        if len(contents) > 100 * 1024 * 1024:  # 100MB
-            return JSONResponse(status_code=400, content={"message": f"Файл слишком большой: {len(contents) / 1024 / 1024:.1f} MB. Максимальный размер: 100 MB"})
-        
+def encode_png_base64(pixels_8bit):
+    # Быстрое сжатие: для первого показа время кодирования важнее размера PNG
+    with stage('png_encode'):
+        image = Image.fromarray(pixels_8bit)
+        img_buffer = io.BytesIO()
+        image.save(img_buffer, format="PNG", compress_level=FAST_PNG_COMPRESS_LEVEL)
+    count_bytes('png', img_buffer.tell())
+    with stage('base64'):
+        return base64.b64encode(img_buffer.getvalue()).decode('utf-8')
+
+
+def json_response(content):
+    """JSON-ответ с сериализацией как отдельным замеряемым этапом (вместо неявной в FastAPI).
+    Ответы-ошибки (JSONResponse) проходят без изменений."""
+    if not isinstance(content, dict):
+        return content
+    with stage('json'):
+        response = JSONResponse(content=content)
+    count_bytes('response', len(response.body))
+    return response
+
+
+def render_initial_voi(ds, pixels, engine):
+    """Первый рендер со стандартным VOI LUT (окно из заголовка или VOI LUT Sequence).
+
+    VOI-преобразование и нормализация монотонны, поэтому min/max результата
+    достигаются на min/max хранимых значений, и весь конвейер можно посчитать
+    на значениях LUT движка, а к изображению применить одним np.take — без
+    float64-копий полного массива.
+    """
+    photometric = ds.PhotometricInterpretation
+    stored = engine.stored_values
+    if stored is None:
+        return to_display_uint8(apply_voi_lut(pixels, ds), photometric)
+    return engine.render_mapped(to_display_uint8(apply_voi_lut(stored, ds), photometric))
+
+
+def header_value(ds, sequence_keyword, keyword, default=None):
+    """Атрибут с верхнего уровня, а для enhanced multi-frame — из функциональных групп
+    (общих, затем первого кадра), например Rescale в PixelValueTransformationSequence."""
+    if keyword in ds:
+        return ds[keyword].value
+    for group_keyword in ('SharedFunctionalGroupsSequence', 'PerFrameFunctionalGroupsSequence'):
+        try:
+            item = getattr(ds, group_keyword)[0]
+            value = getattr(item, sequence_keyword)[0].get(keyword)
+        except (AttributeError, IndexError, TypeError):
+            continue
+        if value is not None:
+            return value
+    return default
+
+
+def render_response(pixels_8bit, fmt='json', quality=90):
+    """Ответ рендер-эндпоинта: JSON с PNG в base64 или бинарное тело в выбранном формате."""
+    if fmt == 'json':
+        return json_response({"image_base64": encode_png_base64(pixels_8bit)})
+    with stage(f'{fmt}_encode'):
+        content = encode_image(pixels_8bit, fmt, quality)
+    count_bytes('response', len(content))
+    return Response(content=content, media_type=MEDIA_TYPES[fmt], headers=image_headers(pixels_8bit))
+
+
+def unsupported_format_response(fmt):
+    return JSONResponse(
+        status_code=400,
+        content={"message": f"Unsupported format '{fmt}'. Expected one of: {', '.join(RESPONSE_FORMATS)}"},
+    )
+
+
+def ingest_dicom(source):
+    """Разбор файла, кэширование пикселей и первый рендер (выполняется в пуле воркеров).
+
+    source — bytes, локальный путь или загруженный файл; файлы на диске отображаются
+    в память и читаются отложенно (см. dicom_io.open_dataset), ограничения размера нет.
+    """
+    with ExitStack() as stack:
         # Пытаемся прочитать как DICOM файл
         try:
-            print("Пытаемся прочитать файл как DICOM...")
             # Принудительно читаем как DICOM файл, игнорируя расширение
-            dicom_file = pydicom.dcmread(io.BytesIO(contents), force=True)
-            print(f"DICOM файл успешно прочитан. SOP Class: {getattr(dicom_file, 'SOPClassUID', 'Unknown')}")
-            
-            # Проверяем, что файл содержит пиксельные данные
-            if not hasattr(dicom_file, 'pixel_array'):
-                raise Exception("Файл не содержит пиксельных данных")
-                
-            print(f"Размер пиксельного массива: {dicom_file.pixel_array.shape}")
-            
+            with stage('dcmread'):
+                dicom_file, contents = stack.enter_context(open_dataset(source))
         except Exception as dicom_error:
             print(f"Ошибка при чтении DICOM файла: {dicom_error}")
             return JSONResponse(status_code=400, content={"message": f"Не удалось прочитать DICOM файл: {str(dicom_error)}"})
+        return ingest_dataset(dicom_file, contents)
+
+
+def decode_pixels(dicom_file, contents):
+    """pixel_array сжатого/нестандартного изображения через дисковый кэш декодированных пикселей.
+
+    При попадании массив отображается из .npy без декодирования; при промахе
+    декодированные пиксели записываются в кэш в фоне.
+    """
+    sop_uid = _safe_str(getattr(dicom_file, 'SOPInstanceUID', '')).strip()
+    # Без байтов файла ключ свёлся бы к одному SOPInstanceUID — кэш не используется
+    if not pixel_cache.enabled or not sop_uid or not len(contents):
+        return dicom_file.pixel_array
+    key = pixel_cache.key(sop_uid, content_hash(contents))
+    cached = pixel_cache.get(key)
+    if cached is not None:
+        return cached
+    pixels = dicom_file.pixel_array
+    metadata = {
+        "sop_instance_uid": sop_uid,
+        "transfer_syntax_uid": str(getattr(getattr(dicom_file, 'file_meta', None), 'TransferSyntaxUID', '')),
+        "photometric_interpretation": str(getattr(dicom_file, 'PhotometricInterpretation', '')),
+    }
+    if prefetch_executor is not None:
+        prefetch_executor.submit(pixel_cache.put, key, pixels, metadata)
+    else:
+        pixel_cache.put(key, pixels, metadata)
+    return pixels
+
+
+def ingest_dataset(dicom_file, contents):
+    """Кэширование и первый рендер уже открытого набора данных (contents — для хэша handle)."""
+    try:
+        # Проверяем наличие пиксельных данных по заголовку, не декодируя их
+        if not any(k in dicom_file for k in ('PixelData', 'FloatPixelData', 'DoubleFloatPixelData')):
+            raise Exception("Файл не содержит пиксельных данных")
         
-        print("Обрабатываем пиксельные данные...")
-        
-        # Применяем Rescale Slope/Intercept
-        slope = float(getattr(dicom_file, 'RescaleSlope', 1.0))
-        intercept = float(getattr(dicom_file, 'RescaleIntercept', 0.0))
-        print(f"Rescale Slope: {slope}, Intercept: {intercept}")
-        
-        raw_pixels = dicom_file.pixel_array
-        if slope != 1.0 or intercept != 0.0:
-            print("Применяем Rescale Slope/Intercept...")
-            raw_pixels = raw_pixels.astype(np.float64) * slope + intercept
-            
-        print(f"Обработанные пиксели: min={np.min(raw_pixels)}, max={np.max(raw_pixels)}")
-            
-        # Сохраняем СЫРЫЕ пиксели и метаданные в кэш
-        dicom_cache['raw_pixels'] = raw_pixels
-        dicom_cache['photometric_interpretation'] = dicom_file.PhotometricInterpretation
-        dicom_cache['initial_wc'] = float(getattr(dicom_file, 'WindowCenter', 50))
-        dicom_cache['initial_ww'] = float(getattr(dicom_file, 'WindowWidth', 400))
-        
-        print("Применяем VOI LUT...")
-        # Применяем стандартный VOI LUT для первого отображения
-        pixels_to_render = apply_voi_lut(dicom_file.pixel_array, dicom_file)
-        
-        print("Рендерим изображение...")
-        img_base64 = render_pixels_to_base64(pixels_to_render, dicom_file.PhotometricInterpretation)
-        
-        pixel_spacing = getattr(dicom_file, 'PixelSpacing', [1.0, 1.0])
+        with stage('decode'):
+            if number_of_frames(dicom_file) > 1:
+                # Multi-frame: кадры декодируются по требованию, весь cine не материализуется
+                frames = FrameSource(dicom_file)
+                raw_pixels = frames.frame(0)
+            else:
+                # Единственное декодирование пикселей: дальше везде используется этот массив.
+                # Несжатые данные не копируются — массив смотрит прямо в байты PixelData
+                frames = None
+                if FrameSource.can_view_native(dicom_file):
+                    raw_pixels = FrameSource(dicom_file).frame(0)
+                else:
+                    raw_pixels = decode_pixels(dicom_file, contents)
+        count_bytes('decoded_pixels', raw_pixels.nbytes)
         
-        print("Подготавливаем ответ...")
-        tags = extract_basic_tags(dicom_file)
-        report = extract_report(dicom_file)
-        result = {
-            "patient_name": str(getattr(dicom_file, 'PatientName', 'N/A')),
-            "image_base64": img_base64,
-            "window_center": float(getattr(dicom_file, 'WindowCenter', 50)),
-            "window_width": float(getattr(dicom_file, 'WindowWidth', 400)),
-            "pixel_spacing_row": float(pixel_spacing[0]),
-            "pixel_spacing_col": float(pixel_spacing[1]),
-            "tags": tags,
-            "report": report,
-        }
+    except Exception as dicom_error:
+        print(f"Ошибка при чтении DICOM файла: {dicom_error}")
+        return JSONResponse(status_code=400, content={"message": f"Не удалось прочитать DICOM файл: {str(dicom_error)}"})
+    
+    # Rescale Slope/Intercept не применяем к массиву: он учитывается в LUT при рендере
+    slope = first_float(header_value(dicom_file, 'PixelValueTransformationSequence', 'RescaleSlope'), 1.0)
+    intercept = first_float(header_value(dicom_file, 'PixelValueTransformationSequence', 'RescaleIntercept'), 0.0)
+    header_wc = header_value(dicom_file, 'FrameVOILUTSequence', 'WindowCenter')
+    header_ww = header_value(dicom_file, 'FrameVOILUTSequence', 'WindowWidth')
+    
+    # Гистограмма хранимых значений (для multi-frame — первого кадра) считается один
+    # раз за проход и кэшируется с изображением; min/max из неё переиспользует движок W/L
+    with stage('histogram'):
+        stats = compute_stats(raw_pixels, slope, intercept)
+    has_header_window = first_float(header_wc, None) is not None and first_float(header_ww, None) is not None
+    if has_header_window:
+        window_center, window_width = first_float(header_wc, None), first_float(header_ww, None)
+    else:
+        # Окна в заголовке нет: вместо фиксированных 50/400 — окно по 1–99 перцентилям
+        window_center, window_width = auto_window(stats)
+    presets = window_presets(stats, getattr(dicom_file, 'Modality', ''),
+                             (window_center, window_width) if has_header_window else None)
+    
+    # Для multi-frame LUT строится на весь диапазон типа: значения остальных кадров ещё неизвестны
+    if frames is not None:
+        value_range = None
+        if raw_pixels.dtype.kind in 'iu' and raw_pixels.dtype.itemsize <= 2:
+            info = np.iinfo(raw_pixels.dtype)
+            value_range = (info.min, info.max)
+    else:
+        value_range = stats.stored_range
         
-        print(f"Ответ подготовлен. Размер base64: {len(img_base64)} символов")
-        return result
+    # Исходный набор данных остаётся в кэше для экспорта: дочитываем отложенные
+    # элементы, пока файл открыт. Несжатые пиксели смотрят в те же байты PixelData,
+    # поэтому отдельно учитываются только сжатые/float-данные
+    with stage('dcmread'):
+        load_deferred(dicom_file)
+    if FrameSource.can_view_native(dicom_file):
+        dataset_bytes = 0
+    else:
+        dataset_bytes = sum(len(dicom_file[k].value) for k in ('PixelData', 'FloatPixelData', 'DoubleFloatPixelData')
+                            if k in dicom_file)
+
+    # Сохраняем СЫРЫЕ пиксели и метаданные в кэш под handle изображения
+    image_id = make_image_id(dicom_file, contents)
+    # Rescale и инверсия MONOCHROME1 сворачиваются в LUT движка W/L при создании записи
+    with stage('rescale'):
+        entry = CachedImage(
+            image_id=image_id,
+            pixels=raw_pixels,
+            photometric_interpretation=dicom_file.PhotometricInterpretation,
+            initial_wc=window_center,
+            initial_ww=window_width,
+            slope=slope,
+            intercept=intercept,
+            value_range=value_range,
+            frames=frames,
+            dataset=dicom_file,
+            dataset_bytes=dataset_bytes,
+            stats=stats,
+            presets=presets,
+        )
+    dicom_cache.put(entry)
+    tile_cache.discard(image_id)
+    levels = pyramid_shapes(raw_pixels.shape)
+    if len(levels) > 1 and prefetch_executor is not None:
+        # Пирамида для крупных снимков строится в фоне, не задерживая первый показ
+        prefetch_executor.submit(lambda: entry.pyramid)
+    schedule_decode_all(entry)
+    
+    with stage('voi'):
+        monochrome = str(dicom_file.PhotometricInterpretation).startswith('MONOCHROME')
+        if not has_header_window and monochrome and 'VOILUTSequence' not in dicom_file:
+            # Первый кадр показывается с тем же автоматическим окном, что уходит клиенту
+            first_image = entry.wl_engine.render(window_center, window_width)
+        elif frames is None:
+            first_image = render_initial_voi(dicom_file, raw_pixels, entry.wl_engine)
+        elif 'WindowCenter' not in dicom_file and has_header_window:
+            # Окно enhanced-объекта из функциональных групп: apply_voi_lut его не видит
+            first_image = entry.wl_engine.render(window_center, window_width)
+        else:
+            first_image = to_display_uint8(apply_voi_lut(raw_pixels, dicom_file), dicom_file.PhotometricInterpretation)
+    img_base64 = encode_png_base64(first_image)
+    
+    pixel_spacing = getattr(dicom_file, 'PixelSpacing', [1.0, 1.0])
+    
+    tags = extract_basic_tags(dicom_file)
+    report = extract_report(dicom_file)
+    result = {
+        "image_id": image_id,
+        "patient_name": str(getattr(dicom_file, 'PatientName', 'N/A')),
+        "image_base64": img_base64,
+        "window_center": window_center,
+        "window_width": window_width,
+        # Готовые окна (из заголовка, по гистограмме, стандартные для модальности)
+        "window_presets": presets,
+        "pixel_spacing_row": float(pixel_spacing[0]),
+        "pixel_spacing_col": float(pixel_spacing[1]),
+        "tags": tags,
+        "report": report,
+        "resident_bytes": entry.nbytes,
+        "number_of_frames": entry.number_of_frames,
+        # Размеры уровней пирамиды [rows, cols] для /render_viewport/ и сторона тайла
+        "pyramid_levels": [list(shape) for shape in levels],
+        "tile_size": TILE_SIZE,
+        # Интервал между кадрами cine в мс (Frame Time), если указан
+        "frame_time": first_float(getattr(dicom_file, 'FrameTime', None), None),
+    }
+    
+    if startup_timer.first_image():
+        print(f"Первое изображение через {startup_timer.first_image_ms} мс после запуска сервера")
+    return result
+
+@app.post("/process_dicom/")
+async def process_dicom_file(file: Optional[UploadFile] = File(None), path: Optional[str] = Form(None)):
+    """Первоначальная загрузка файла: загрузкой (multipart) или локальным путём (поле path).
+
+    Загрузка не читается в память целиком: Starlette уже сохранил её во временный
+    файл (SpooledTemporaryFile), и воркер разбирает этот файл напрямую.
+    """
+    # Приём и разбор multipart (со сбросом загрузки во временный файл) FastAPI
+    # выполняет до вызова эндпоинта
+    stage_since_request_start('upload_read')
+    try:
+        if path is not None:
+            if not os.path.isfile(path):
+                return JSONResponse(status_code=400, content={"message": f"File not found: {path}"})
+            count_bytes('input', os.path.getsize(path))
+            return json_response(await run_blocking(render_executor, ingest_dicom, path))
+        if file is None:
+            return JSONResponse(status_code=400, content={"message": "Either 'file' or 'path' is required."})
+        count_bytes('upload', file.size or 0)
+        return json_response(await run_blocking(render_executor, ingest_dicom, file.file))
         
     except Exception as e:
         print(f"PYTHON ERROR on initial processing: {e}")
@@ -199,396 +657,855 @@ async def process_dicom_file(file: UploadFile = File(...)):
         print(f"Полная трассировка: {traceback.format_exc()}")
         return JSONResponse(status_code=500, content={"message": f"An error occurred: {str(e)}"})
 
+@app.post("/index_folder/")
+async def index_folder(request: FolderRequest):
+    """Индексирует папку: исследования/серии/срезы по заголовкам, без чтения PixelData."""
+    if not os.path.isdir(request.path):
+        return JSONResponse(status_code=400, content={"message": f"Not a directory: {request.path}"})
+    try:
+        start = time.perf_counter()
+        result = await run_blocking(
+            render_executor, series_index.index_directory, request.path, index_executor, request.recursive,
+        )
+        result["elapsed_ms"] = round((time.perf_counter() - start) * 1000.0, 1)
+        schedule_thumbnails([series["series_instance_uid"] for study in result["studies"] for series in study["series"]])
+        print(f"Папка проиндексирована: {result['dicom_files']} DICOM из {result['files_scanned']} файлов "
+              f"за {result['elapsed_ms']} мс")
+        return result
+    except Exception as e:
+        print(f"PYTHON ERROR on folder indexing: {e}")
+        return JSONResponse(status_code=500, content={"message": f"An error occurred: {str(e)}"})
+
+
+def schedule_thumbnails(series_uids):
+    """Миниатюры новых серий в фоне: сначала по одной (средний срез) на серию для обзора
+    серий, затем остальные срезы."""
+    series = [series_index.instances(uid) for uid in series_uids]
+    thumbnail_worker.schedule([instances[len(instances) // 2] for instances in series if instances], PRIORITY_SERIES)
+    for instances in series:
+        thumbnail_worker.schedule(instances, PRIORITY_INSTANCE)
+
+
+def thumbnail_entry(record, data, **extra):
+    return dict(extra, sop_instance_uid=record["sop_instance_uid"], instance_number=record["instance_number"],
+                image_base64=base64.b64encode(data).decode('ascii') if data is not None else None)
+
+
+def series_thumbnails(instances, wait):
+    """Миниатюры срезов серии из кэша; недостающие строятся сейчас (wait) или ставятся
+    в начало фоновой очереди, а в ответе остаются null до следующего запроса."""
+    with stage('thumbnails'):
+        thumbnails, missing = [], []
+        for index, record in enumerate(instances):
+            data = thumbnail_worker.cached(record)
+            if data is None and wait:
+                data = thumbnail_worker.thumbnail(record)
+            if data is None:
+                missing.append(record)
+            thumbnails.append(thumbnail_entry(record, data, index=index))
+    thumbnail_worker.schedule(missing, PRIORITY_REQUESTED)
+    return thumbnails, len(missing)
+
+
+@app.get("/series/{series_uid}/thumbnails")
+async def get_series_thumbnails(series_uid: str, wait: bool = False):
+    """Миниатюры всех срезов серии одним ответом (JPEG base64) для ленты предпросмотра."""
+    instances = series_index.instances(series_uid)
+    if not instances:
+        return JSONResponse(status_code=404, content={"message": "Series not indexed."})
+    thumbnails, pending = await run_blocking(render_executor, series_thumbnails, instances, wait)
+    return json_response({
+        "series_instance_uid": series_uid,
+        "size": thumbnail_worker.size,
+        "count": len(thumbnails),
+        "pending": pending,
+        "thumbnails": thumbnails,
+    })
+
+
+@app.get("/thumbnails/")
+async def get_series_overview(wait: bool = False):
+    """Обзор серий: одна миниатюра (средний срез) на каждую проиндексированную серию."""
+    representatives = {}
+    for uid in series_index.series_uids():
+        instances = series_index.instances(uid)
+        if instances:
+            representatives[uid] = instances[len(instances) // 2]
+    thumbnails, pending = await run_blocking(render_executor, series_thumbnails, list(representatives.values()), wait)
+    for uid, thumbnail in zip(representatives, thumbnails):
+        thumbnail["series_instance_uid"] = uid
+        thumbnail["number_of_instances"] = series_index.series_length(uid)
+        del thumbnail["index"]
+    return json_response({"size": thumbnail_worker.size, "pending": pending, "series": thumbnails})
+
+
+@app.get("/series/{series_uid}/{index}")
+async def open_series_instance(series_uid: str, index: int):
+    """Открывает срез index отсортированной серии из /index_folder/ (декодирование по требованию)."""
+    instance = series_index.instance(series_uid, index)
+    if instance is None:
+        return JSONResponse(status_code=404, content={"message": "Series or instance not indexed."})
+    try:
+        result = await run_blocking(render_executor, ingest_dicom, instance["path"])
+        if isinstance(result, dict):
+            result["series_instance_uid"] = series_uid
+            result["index"] = index
+            result["series_length"] = series_index.series_length(series_uid)
+        return json_response(result)
+    except Exception as e:
+        print(f"PYTHON ERROR on series instance load: {e}")
+        return JSONResponse(status_code=500, content={"message": f"An error occurred: {str(e)}"})
+
+
+def volume_window(volume):
+    """Начальное окно объёма: из заголовка первого среза, иначе 1–99 перцентиль."""
+    wc, ww = (first_float(value, None) for value in volume.header_window)
+    if wc is None or ww is None:
+        return auto_window(volume.stats)
+    return wc, ww
+
+
+def volume_info(volume):
+    wc, ww = volume_window(volume)
+    info = volume.describe()
+    has_header_window = first_float(volume.header_window[0], None) is not None
+    info.update({
+        "window_center": wc,
+        "window_width": ww,
+        "window_presets": window_presets(volume.stats, volume.modality, (wc, ww) if has_header_window else None),
+    })
+    return info
+
+
+def load_volume(series_uid):
+    """Сборка (или объём из кэша) серии; срезы читаются в пуле индексирования."""
+    instances = series_index.instances(series_uid)
+    with stage('volume_build'):
+        return get_volume_cache().get_or_build(series_uid, instances, index_executor)
+
+
+def render_mpr(request, request_key, token):
+    """Реформат объёма в плоскости request.plane и кодирование (выполняется в пуле воркеров)."""
+    volume = load_volume(request.series_uid)
+    length = volume.plane_length(request.plane)
+    index = length // 2 if request.index is None else request.index
+    if not 0 <= index < length:
+        return JSONResponse(status_code=400, content={"message": f"Index {index} out of range (0..{length - 1})"})
+    wc, ww = volume_window(volume)
+    wc = wc if request.window_center is None else request.window_center
+    ww = ww if request.window_width is None else request.window_width
+    wl_requests.check(request_key, token)
+    with stage('voi'):
+        pixels_8bit = volume.render(request.plane, index, wc, ww, wl_gamma(request.brightness))
+    wl_requests.check(request_key, token)
+    mpr = {"plane": request.plane, "index": index, "count": length}
+    if request.format == 'json':
+        return json_response(dict(image_base64=encode_png_base64(pixels_8bit), **mpr))
+    response = render_response(pixels_8bit, request.format, request.quality)
+    response.headers.update({f"X-MPR-{k.capitalize()}": str(v) for k, v in mpr.items()})
+    return response
+
+
+@app.post("/volume/{series_uid}")
+async def build_volume(series_uid: str):
+    """Собирает срезы серии из /index_folder/ в объём для MPR; возвращает размеры, шаги (мм),
+    число положений в каждой плоскости и окна."""
+    if not series_index.series_length(series_uid):
+        return JSONResponse(status_code=404, content={"message": "Series not indexed."})
+    try:
+        volume = await run_blocking(render_executor, load_volume, series_uid)
+        return volume_info(volume)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+    except Exception as e:
+        print(f"PYTHON ERROR on volume build: {e}")
+        return JSONResponse(status_code=500, content={"message": f"An error occurred: {str(e)}"})
+
+
+@app.post("/render_mpr/")
+async def render_mpr_endpoint(request: MprRequest):
+    """Аксиальный/корональный/сагиттальный срез объёма серии через движок W/L.
+
+    Объём собирается при первом запросе (или заранее через /volume/{series_uid}).
+    Ответ в выбранном формате; для бинарных — заголовки X-MPR-Plane/Index/Count.
+    """
+    if request.format not in RESPONSE_FORMATS:
+        return unsupported_format_response(request.format)
+    from volume import PLANES
+    if request.plane not in PLANES:
+        return JSONResponse(status_code=400, content={"message": f"Unknown plane '{request.plane}'. "
+                                                                 f"Expected one of: {', '.join(PLANES)}"})
+    if not series_index.series_length(request.series_uid):
+        return JSONResponse(status_code=404, content={"message": "Series not indexed."})
+    request_key = wl_requests.key(request.session_id, request.series_uid)
+    token = wl_requests.begin(request_key)
+    try:
+        return await run_blocking(render_executor, render_mpr, request, request_key, token)
+    except SupersededError:
+        return superseded_response()
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+    except Exception as e:
+        print(f"PYTHON ERROR on MPR render: {e}")
+        return JSONResponse(status_code=500, content={"message": f"An error occurred: {str(e)}"})
+
+
+def render_window_level(entry, wc, ww, gamma, fmt, quality, request_key=None, token=None, frame=0):
+    """W/L-рендер и кодирование ответа (выполняется в пуле воркеров)."""
+    pixels_8bit = render_window_level_pixels(entry, wc, ww, gamma, request_key, token, frame)
+    return render_response(pixels_8bit, fmt, quality)
+
+
+def render_window_level_pixels(entry, wc, ww, gamma, request_key=None, token=None, frame=0):
+    """8-битный W/L-рендер кадра.
+
+    Если передан токен, перед каждым тяжёлым этапом проверяется, что запрос ещё
+    актуален, — устаревшие запросы не тратят время на рендер и кодирование.
+    """
+    if token is not None:
+        wl_requests.check(request_key, token)
+    # Кадр multi-frame объекта декодируется здесь же, в воркере (если ещё не в кэше кадров)
+    if frame:
+        with stage('decode'):
+            pixels = entry.frame_pixels(frame)
+        if token is not None:
+            wl_requests.check(request_key, token)
+    else:
+        pixels = None
+    # Window/Level, яркость и MONOCHROME1 — одним проходом по LUT
+    with stage('voi'):
+        pixels_8bit = entry.wl_engine.render(wc, ww, gamma, pixels=pixels)
+    if token is not None:
+        wl_requests.check(request_key, token)
+    return pixels_8bit
+
+
+def render_channel_frame(entry, request, request_key, token):
+    """Рендер и кодирование кадра для /ws/render/ (выполняется в пуле воркеров)."""
+    pixels_8bit = render_window_level_pixels(
+        entry, request.window_center, request.window_width, wl_gamma(request.brightness),
+        request_key, token, request.frame,
+    )
+    with stage(f'{request.format}_encode'):
+        content = encode_image(pixels_8bit, request.format, request.quality)
+    count_bytes('response', len(content))
+    wl_requests.check(request_key, token)
+    return pixels_8bit.shape, content
+
+
+def superseded_response():
+    return JSONResponse(status_code=409, content={"message": "Request superseded by a newer one."})
+
+
+def channel_error(message, seq=None, image_id=None):
+    return {"error": message, "seq": seq, "image_id": image_id}
+
+
+@app.websocket("/ws/render/")
+async def render_channel(websocket: WebSocket, session_id: Optional[str] = None):
+    """Постоянный канал W/L-рендера для перетаскивания.
+
+    Клиент шлёт JSON-сообщения с полями как у /update_wl/ (и seq), сервер хранит
+    только самое свежее ещё не начатое сообщение (промежуточные шаги отбрасываются
+    без рендера) и отвечает парой сообщений: JSON-заголовок (seq, размеры, формат,
+    сколько шагов пропущено) и бинарное изображение.
+
+    Уже начатый рендер новыми шагами не отменяется: при непрерывном перетаскивании
+    с частотой выше скорости рендера это означало бы ни одного кадра до конца жеста.
+    Его отменяет отключение клиента или более новый запрос той же сессии через HTTP.
+
+    Ошибки в очередь не попадают и не вытесняются: ответ на невалидное сообщение
+    уходит сразу, а у обработанного запроса всегда есть ответ со своим seq — кадр
+    или ошибка (в том числе superseded).
+    """
+    await websocket.accept()
+    session_id = session_id or uuid.uuid4().hex
+    pending = LatestSlot()
+    # Ключи (сессия, изображение) этого соединения: при закрытии они забываются,
+    # иначе каждое соединение без session_id оставляло бы свои ключи до вытеснения изображения
+    channel_keys = set()
+    # Заголовок и изображение уходят парой: ошибки из receive() не вклиниваются между ними
+    send_lock = asyncio.Lock()
+
+    async def send(*messages):
+        async with send_lock:
+            for message in messages:
+                if isinstance(message, bytes):
+                    await websocket.send_bytes(message)
+                else:
+                    await websocket.send_json(message)
+
+    async def receive():
+        try:
+            while True:
+                text = await websocket.receive_text()
+                try:
+                    data = json.loads(text)
+                except ValueError as e:
+                    await send(channel_error(f"Invalid request: {e}"))
+                    continue
+                seq = data.get('seq') if isinstance(data, dict) else None
+                try:
+                    request = RenderChannelRequest(**data)
+                except Exception as e:
+                    await send(channel_error(f"Invalid request: {e}", seq))
+                    continue
+                if request.format not in MEDIA_TYPES:
+                    await send(channel_error(f"Unsupported format '{request.format}'", request.seq, request.image_id))
+                    continue
+                entry = dicom_cache.get(request.image_id)
+                if entry is None:
+                    await send(channel_error("No DICOM data in cache.", request.seq, request.image_id))
+                    continue
+                pending.put((request, entry))
+        except (WebSocketDisconnect, RuntimeError):
+            # RuntimeError — отправка в уже закрытый сокет
+            pass
+        finally:
+            pending.close()
+            # Клиент ушёл — текущий рендер больше никому не нужен
+            for key in channel_keys:
+                wl_requests.release(key)
+
+    receiver = asyncio.create_task(receive())
+    try:
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            request, entry = item
+            if not 0 <= request.frame < entry.number_of_frames:
+                await send(channel_error(f"Frame {request.frame} out of range", request.seq, entry.image_id))
+                continue
+            coalesced, pending.coalesced = pending.coalesced, 0
+            request_key = wl_requests.key(session_id, entry.image_id)
+            token = wl_requests.begin(request_key)
+            channel_keys.add(request_key)
+            try:
+                shape, content = await run_blocking(render_executor, render_channel_frame, entry, request, request_key, token)
+            except SupersededError:
+                await send(channel_error("superseded", request.seq, entry.image_id))
+                continue
+            except Exception as e:
+                print(f"PYTHON ERROR on render channel: {e}")
+                await send(channel_error(f"An error occurred: {str(e)}", request.seq, entry.image_id))
+                continue
+            await send({
+                "seq": request.seq,
+                "image_id": entry.image_id,
+                "frame": request.frame,
+                "format": request.format,
+                "width": shape[1],
+                "height": shape[0],
+                "channels": shape[2] if len(shape) == 3 else 1,
+                "coalesced": coalesced,
+            }, content)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        for key in channel_keys:
+            wl_requests.release(key)
+
+
+def frame_out_of_range_response(entry, index):
+    return JSONResponse(
+        status_code=400,
+        content={"message": f"Frame {index} out of range (0..{entry.number_of_frames - 1})"},
+    )
+
+
+def decode_pool_for(transfer_syntax):
+    """Пул для параллельного декодирования кадров: кодеки Pillow/OpenJPEG отпускают GIL
+    и хорошо идут в потоках, RLE (декодер pydicom на Python) — только в процессах."""
+    if transfer_syntax in GIL_BOUND_TRANSFER_SYNTAXES and export_pool is not None:
+        return export_pool
+    return decode_executor
+
+
+def decode_all_frames(entry):
+    frames = entry.frames
+    try:
+        if frames.decode_all(decode_pool_for(frames.transfer_syntax)):
+            dicom_cache.refresh(entry.image_id)
+    except Exception as e:
+        print(f"Не удалось декодировать кадры {entry.image_id}: {e}")
+
+
+def schedule_decode_all(entry):
+    """Если весь сжатый cine помещается в бюджет кэша кадров, декодирует его целиком в фоне,
+    параллельно по кадрам, сразу после первого показа (кадр 0 уже декодирован)."""
+    frames = entry.frames
+    if frames is None or not frames.is_encapsulated or prefetch_executor is None:
+        return
+    if frames.decoded_nbytes > frames.max_cached_bytes:
+        return
+    prefetch_executor.submit(decode_all_frames, entry)
+
+
+def schedule_prefetch(entry, index):
+    """Ставит в очередь декодирование следующих кадров (по кругу — cine зациклен)."""
+    if entry.frames is None or prefetch_executor is None:
+        return
+    count = entry.number_of_frames
+    ahead = [(index + step) % count for step in range(1, min(PREFETCH_FRAMES, count - 1) + 1)]
+    entry.frames.prefetch(ahead, prefetch_executor)
+
 @app.post("/update_wl/")
 async def update_window_level(request: WindowLevelRequest):
     """Новый эндпоинт для перерисовки с новыми W/L и яркостью."""
-    if 'raw_pixels' not in dicom_cache:
+    if request.format not in RESPONSE_FORMATS:
+        return unsupported_format_response(request.format)
+    entry = dicom_cache.get(request.image_id)
+    if entry is None:
         return JSONResponse(status_code=404, content={"message": "No DICOM data in cache."})
+    if not 0 <= request.frame < entry.number_of_frames:
+        return frame_out_of_range_response(entry, request.frame)
+    request_key = wl_requests.key(request.session_id, entry.image_id)
+    token = wl_requests.begin(request_key)
     try:
-        raw_pixels = dicom_cache['raw_pixels']
-        wc, ww, brightness = request.window_center, request.window_width, request.brightness
-        
-        # Применяем Window/Level
-        min_val, max_val = wc - ww / 2, wc + ww / 2
-        pixels_clipped = np.clip(raw_pixels, min_val, max_val)
-        
-        # Нормализуем к 0-1 диапазону
-        if max_val > min_val:
-            pixels_normalized = (pixels_clipped - min_val) / (max_val - min_val)
-        else:
-            pixels_normalized = np.zeros_like(pixels_clipped)
-        
-        # Применяем яркость БЕЗОПАСНЫМ способом
-        if brightness != 1.0:
-            # Используем более мягкую корректировку яркости
-            if brightness < 1.0:
-                # Затемнение: применяем квадратный корень
-                pixels_normalized = np.power(pixels_normalized, 1.0 / (2.0 - brightness))
-            else:
-                # Осветление: применяем квадрат
-                pixels_normalized = np.power(pixels_normalized, 1.0 / brightness)
-        
-        pixels_normalized = np.clip(pixels_normalized, 0, 1)
-        
-        # Конвертируем в 8-битное изображение
-        pixels_8bit = (pixels_normalized * 255).astype(np.uint8)
-        
-        # Применяем photometric interpretation
-        if dicom_cache['photometric_interpretation'] == "MONOCHROME1":
-            pixels_8bit = 255 - pixels_8bit
-        
-        image = Image.fromarray(pixels_8bit)
-        img_buffer = io.BytesIO()
-        image.save(img_buffer, format="PNG")
-        img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-        
-        return {"image_base64": img_base64}
+        return await run_blocking(
+            render_executor, render_window_level, entry,
+            request.window_center, request.window_width, wl_gamma(request.brightness),
+            request.format, request.quality, request_key, token, request.frame,
+        )
+    except SupersededError:
+        return superseded_response()
     except Exception as e:
         print(f"PYTHON ERROR on W/L/Brightness update: {e}")
         return JSONResponse(status_code=500, content={"message": f"An error occurred: {str(e)}"})
 
 @app.post("/update_brightness/")
-async def update_brightness_only(brightness: float):
+async def update_brightness_only(brightness: float, image_id: Optional[str] = None,
+                                 format: str = 'json', quality: int = 90):
     """Простой эндпоинт только для яркости без W/L."""
-    if 'raw_pixels' not in dicom_cache:
+    if format not in RESPONSE_FORMATS:
+        return unsupported_format_response(format)
+    entry = dicom_cache.get(image_id)
+    if entry is None:
         return JSONResponse(status_code=404, content={"message": "No DICOM data in cache."})
     try:
-        raw_pixels = dicom_cache['raw_pixels']
-        
         # Используем начальные значения W/L
-        wc = dicom_cache.get('initial_wc', 50)
-        ww = dicom_cache.get('initial_ww', 400)
-        
-        # Применяем Window/Level
-        min_val, max_val = wc - ww / 2, wc + ww / 2
-        pixels_clipped = np.clip(raw_pixels, min_val, max_val)
-        
-        # Нормализуем к 0-1 диапазону
-        if max_val > min_val:
-            pixels_normalized = (pixels_clipped - min_val) / (max_val - min_val)
-        else:
-            pixels_normalized = np.zeros_like(pixels_clipped)
-        
-        # Применяем яркость очень осторожно
-        if brightness != 1.0:
-            pixels_normalized = np.power(pixels_normalized, 1.0 / brightness)
-        
-        pixels_normalized = np.clip(pixels_normalized, 0, 1)
-        
-        # Конвертируем в 8-битное изображение
-        pixels_8bit = (pixels_normalized * 255).astype(np.uint8)
-        
-        # Применяем photometric interpretation
-        if dicom_cache['photometric_interpretation'] == "MONOCHROME1":
-            pixels_8bit = 255 - pixels_8bit
-        
-        image = Image.fromarray(pixels_8bit)
-        img_buffer = io.BytesIO()
-        image.save(img_buffer, format="PNG")
-        img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-        
-        return {"image_base64": img_base64}
+        return await run_blocking(
+            render_executor, render_window_level, entry,
+            entry.initial_wc, entry.initial_ww, brightness_gamma(brightness), format, quality,
+        )
     except Exception as e:
         print(f"PYTHON ERROR on brightness update: {e}")
         return JSONResponse(status_code=500, content={"message": f"An error occurred: {str(e)}"})
 
+@app.get("/image_stats/")
+async def image_stats(image_id: Optional[str] = None, bins: int = 256):
+    """Гистограмма (в единицах модальности), перцентили и готовые окна W/L.
+
+    Всё считается из кэшированной при загрузке статистики, без прохода по пикселям.
+    """
+    entry = dicom_cache.get(image_id)
+    if entry is None or entry.stats is None:
+        return JSONResponse(status_code=404, content={"message": "No DICOM data in cache."})
+    if not 1 <= bins <= MAX_HISTOGRAM_BINS:
+        return JSONResponse(status_code=400, content={"message": f"bins must be in 1..{MAX_HISTOGRAM_BINS}"})
+    return {
+        "image_id": entry.image_id,
+        "modality": str(getattr(entry.dataset, 'Modality', '')),
+        "window_center": entry.initial_wc,
+        "window_width": entry.initial_ww,
+        "statistics": entry.stats.summary(),
+        "histogram": entry.stats.histogram(bins),
+        "presets": entry.presets,
+    }
+
+def roi_units(ds):
+    """Единицы значений после Rescale: RescaleType, для КТ — HU."""
+    rescale_type = header_value(ds, 'PixelValueTransformationSequence', 'RescaleType')
+    if rescale_type:
+        return str(rescale_type)
+    return 'HU' if str(getattr(ds, 'Modality', '')) == 'CT' else None
+
+
+def pixel_spacing_of(ds):
+    """PixelSpacing (строка, столбец) в мм, для enhanced-объектов — из функциональных групп."""
+    spacing = header_value(ds, 'PixelMeasuresSequence', 'PixelSpacing')
+    try:
+        return float(spacing[0]), float(spacing[1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def compute_roi_stats(entry, request):
+    with stage('roi_table'):
+        table, built = entry.summed_area(request.frame)
+    if built:
+        # Таблицы увеличили запись — учитываем их в бюджете кэша
+        dicom_cache.refresh(entry.image_id)
+    with stage('roi_stats'):
+        result = roi_stats(
+            entry.frame_pixels(request.frame), table, request.shape,
+            request.x, request.y, request.width, request.height,
+            slope=entry.slope, intercept=entry.intercept, spacing=pixel_spacing_of(entry.dataset),
+        )
+    result.update(image_id=entry.image_id, frame=request.frame, units=roi_units(entry.dataset))
+    return result
+
+@app.post("/roi_stats/")
+async def roi_statistics(request: RoiRequest):
+    """Статистика области (среднее, СКО, min/max в единицах модальности, площадь в мм²).
+
+    Среднее и СКО прямоугольника — O(1) по таблицам накопленных сумм, которые строятся
+    при первом запросе к кадру; повторные запросы при перетаскивании ROI их переиспользуют.
+    """
+    if request.shape not in ROI_SHAPES:
+        return JSONResponse(
+            status_code=400,
+            content={"message": f"Unknown ROI shape '{request.shape}'. Expected one of: {', '.join(ROI_SHAPES)}"},
+        )
+    entry = dicom_cache.get(request.image_id)
+    if entry is None:
+        return JSONResponse(status_code=404, content={"message": "No DICOM data in cache."})
+    if not 0 <= request.frame < entry.number_of_frames:
+        return frame_out_of_range_response(entry, request.frame)
+    try:
+        return await run_blocking(render_executor, compute_roi_stats, entry, request)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+    except Exception as e:
+        print(f"PYTHON ERROR on ROI statistics: {e}")
+        return JSONResponse(status_code=500, content={"message": f"An error occurred: {str(e)}"})
+
+@app.get("/frame/{index}")
+async def render_frame(index: int, image_id: Optional[str] = None,
+                       window_center: Optional[float] = None, window_width: Optional[float] = None,
+                       brightness: float = 1.0, format: str = 'json', quality: int = 90,
+                       session_id: Optional[str] = None):
+    """Рендер кадра multi-frame объекта (прокрутка и cine); без W/L — начальное окно.
+
+    Заодно в фоне декодируются следующие DICOM_PREFETCH_FRAMES кадров.
+    """
+    if format not in RESPONSE_FORMATS:
+        return unsupported_format_response(format)
+    entry = dicom_cache.get(image_id)
+    if entry is None:
+        return JSONResponse(status_code=404, content={"message": "No DICOM data in cache."})
+    if not 0 <= index < entry.number_of_frames:
+        return frame_out_of_range_response(entry, index)
+    schedule_prefetch(entry, index)
+    request_key = wl_requests.key(session_id, entry.image_id)
+    token = wl_requests.begin(request_key)
+    wc = entry.initial_wc if window_center is None else window_center
+    ww = entry.initial_ww if window_width is None else window_width
+    try:
+        return await run_blocking(
+            render_executor, render_window_level, entry,
+            wc, ww, wl_gamma(brightness), format, quality, request_key, token, index,
+        )
+    except SupersededError:
+        return superseded_response()
+    except Exception as e:
+        print(f"PYTHON ERROR on frame render: {e}")
+        return JSONResponse(status_code=500, content={"message": f"An error occurred: {str(e)}"})
+
+
+def render_viewport(entry, level, x, y, width, height, wc, ww, gamma, request_key=None, token=None):
+    """Собирает область уровня пирамиды из тайлов (готовых из кэша или отрендеренных)."""
+    pyramid = entry.pyramid
+    pixels = pyramid[level]
+    out = np.empty((height, width) + pixels.shape[2:], dtype=np.uint8)
+    wl_key = (float(wc), float(ww), float(gamma))
+    for ty in tile_range(y, height):
+        if token is not None:
+            wl_requests.check(request_key, token)
+        for tx in tile_range(x, width):
+            key = (entry.image_id, level, tx, ty) + wl_key
+            tile = tile_cache.get(key)
+            if tile is None:
+                source = pixels[ty * TILE_SIZE:(ty + 1) * TILE_SIZE, tx * TILE_SIZE:(tx + 1) * TILE_SIZE]
+                tile = entry.wl_engine.render(wc, ww, gamma, pixels=source)
+                tile_cache.put(key, tile)
+            # Пересечение тайла с вьюпортом в координатах уровня
+            top, left = max(y, ty * TILE_SIZE), max(x, tx * TILE_SIZE)
+            bottom = min(y + height, ty * TILE_SIZE + tile.shape[0])
+            right = min(x + width, tx * TILE_SIZE + tile.shape[1])
+            out[top - y:bottom - y, left - x:right - x] = \
+                tile[top - ty * TILE_SIZE:bottom - ty * TILE_SIZE, left - tx * TILE_SIZE:right - tx * TILE_SIZE]
+    return out
+
+
+def render_viewport_response(entry, request, gamma, request_key, token):
+    """Рендер вьюпорта и кодирование (выполняется в пуле воркеров)."""
+    shapes = pyramid_shapes(entry.pixels.shape)
+    level = min(max(request.level, 0), len(shapes) - 1)
+    rows, cols = shapes[level]
+    # Область обрезается по границам уровня
+    x, y = min(max(request.x, 0), cols), min(max(request.y, 0), rows)
+    width, height = min(request.width, cols - x), min(request.height, rows - y)
+    if width <= 0 or height <= 0:
+        return JSONResponse(status_code=400, content={"message": "Viewport does not intersect the image."})
+    with stage('voi'):
+        pixels_8bit = render_viewport(entry, level, x, y, width, height,
+                                      request.window_center, request.window_width, gamma, request_key, token)
+    wl_requests.check(request_key, token)
+    viewport = {"level": level, "x": x, "y": y, "width": width, "height": height}
+    if request.format == 'json':
+        return json_response(dict(image_base64=encode_png_base64(pixels_8bit), **viewport))
+    response = render_response(pixels_8bit, request.format, request.quality)
+    response.headers.update({f"X-Viewport-{k.capitalize()}": str(v) for k, v in viewport.items()})
+    return response
+
+
+@app.post("/render_viewport/")
+async def render_viewport_endpoint(request: ViewportRequest):
+    """W/L-рендер только видимой области на подходящем уровне пирамиды.
+
+    Рендерятся лишь тайлы, попавшие во вьюпорт; готовые тайлы берутся из кэша по
+    ключу (W/L, уровень, тайл), поэтому панорамирование почти ничего не стоит.
+    """
+    if request.format not in RESPONSE_FORMATS:
+        return unsupported_format_response(request.format)
+    entry = dicom_cache.get(request.image_id)
+    if entry is None:
+        return JSONResponse(status_code=404, content={"message": "No DICOM data in cache."})
+    request_key = wl_requests.key(request.session_id, entry.image_id)
+    token = wl_requests.begin(request_key)
+    try:
+        return await run_blocking(
+            render_executor, render_viewport_response, entry, request, wl_gamma(request.brightness),
+            request_key, token,
+        )
+    except SupersededError:
+        return superseded_response()
+    except Exception as e:
+        print(f"PYTHON ERROR on viewport render: {e}")
+        return JSONResponse(status_code=500, content={"message": f"An error occurred: {str(e)}"})
+
+
+# Экспорт до этого размера собирается в памяти, больший — во временном файле
+EXPORT_SPOOL_BYTES = 16 * 1024 * 1024
+EXPORT_CHUNK_BYTES = 1024 * 1024
+
+
+def export_dicom_sync(source, metadata, annotations, png_bytes, fmt='dicom'):
+    """Применяет metadata/аннотации к загруженному DICOM и сериализует его (выполняется в пуле воркеров)."""
+    with open_dataset(source) as (ds, _):
+        return export_response(ds, metadata, annotations, png_bytes, fmt)
+
+
+def export_cached_sync(entry, metadata, annotations, png_bytes, fmt='dicom'):
+    """То же для набора данных из кэша: изменения вносятся в копию, кэш не меняется."""
+    return export_response(copy_dataset(entry.dataset), metadata, annotations, png_bytes, fmt)
+
+
+def _iter_file(f):
+    try:
+        while True:
+            chunk = f.read(EXPORT_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+
+def export_response(ds, metadata, annotations, png_bytes, fmt):
+    from export import ExportError, apply_export
+    try:
+        apply_export(ds, metadata, annotations, png_bytes)
+    except ExportError as e:
+        return JSONResponse(status_code=500, content={"message": str(e)})
+    return serialize_export(ds, fmt)
+
+
+def serialize_export(ds, fmt):
+    """Part-10 файл потоком application/dicom (или прежний JSON с base64 при fmt='json')."""
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    ds.save_as(out, write_like_original=False)
+    size = out.tell()
+    out.seek(0)
+    if fmt == 'json':
+        with out:
+            out_bytes = out.read()
+        return {
+            'dicom_base64': base64.b64encode(out_bytes).decode('utf-8'),
+            'size': len(out_bytes)
+        }
+    return StreamingResponse(_iter_file(out), media_type='application/dicom',
+                             headers={'Content-Length': str(size)})
+
+
 @app.post("/export_dicom/")
 async def export_dicom(
-    file: UploadFile = File(...),
+    image_id: Optional[str] = Form(None),
+    file: Optional[UploadFile] = File(None),
     metadata: Optional[str] = Form(None),
     annotations: Optional[str] = Form(None),
     render: Optional[UploadFile] = File(None),  # PNG с уже «сожжёнными» аннотациями с клиента
+    format: str = Form('dicom'),
 ):
-    """Принимает исходный DICOM и опциональные metadata (tags/report), возвращает изменённый DICOM base64."""
+    """Экспорт изменённого DICOM: изображение из кэша по image_id (клиент присылает только
+    изменения metadata/аннотаций) или загруженный файл. Ответ — Part-10 файл
+    (application/dicom), при format=json — прежний JSON с base64."""
     try:
-        contents = await file.read()
-        ds = pydicom.dcmread(io.BytesIO(contents), force=True)
+        png_bytes = await render.read() if render is not None else None
+        if image_id is not None:
+            entry = dicom_cache.get(image_id)
+            if entry is None or entry.dataset is None:
+                return JSONResponse(status_code=404, content={"message": "No DICOM data in cache."})
+            return await run_blocking(render_executor, export_cached_sync, entry, metadata, annotations, png_bytes, format)
+        if file is None:
+            return JSONResponse(status_code=400, content={"message": "Either 'image_id' or 'file' is required."})
+        return await run_blocking(render_executor, export_dicom_sync, file.file, metadata, annotations, png_bytes, format)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"message": str(e)})
 
-        meta = {}
-        if metadata:
-            try:
-                meta = json.loads(metadata)
-            except Exception:
-                meta = {}
+EXPORT_BATCH_FORMATS = ('zip', 'multipart')
 
-        # Применяем текст отчёта, если есть
-        report = meta.get('report') if isinstance(meta, dict) else None
-        if report is not None:
-            try:
-                ds.ImageComments = str(report)
-            except Exception:
-                pass
-
-        # Применяем теги по словарю {keyword: value}
-        # Безопасность: не изменяем структурные пиксельные поля
-        forbidden_keywords = {
-            'Rows', 'Columns', 'BitsAllocated', 'BitsStored', 'HighBit',
-            'SamplesPerPixel', 'PhotometricInterpretation', 'PixelRepresentation',
-            'NumberOfFrames', 'PixelData'
-        }
 
-        def coerce_value_to_vr(v, vr):
-            # Разбираем множественные значения: "a\\b" или "a,b"
-            def split_multi(x):
-                if isinstance(x, str):
-                    if '\\' in x:
-                        return [i for i in x.split('\\') if i != '']
-                    if ',' in x:
-                        return [i for i in x.split(',') if i != '']
-                return x
-
-            v = split_multi(v)
-            def convert_one(x):
-                if vr in ('US', 'UL', 'SS', 'SL'):  # целые
-                    return int(x)
-                if vr in ('FL', 'FD'):  # float
-                    return float(x)
-                if vr == 'IS':  # Integer String
-                    return str(int(x))
-                if vr == 'DS':  # Decimal String
-                    return str(float(x))
-                # Остальные VR — оставляем как есть (строки и т.п.)
-                return x
-
-            if isinstance(v, (list, tuple)):
-                return [convert_one(x) for x in v]
-            return convert_one(v)
-
-        tags = meta.get('tags', {}) if isinstance(meta, dict) else {}
-        if isinstance(tags, dict):
-            for key, value in tags.items():
-                if key in forbidden_keywords:
-                    continue
-                try:
-                    tag = tag_for_keyword(key)
-                    if tag is None:
-                        continue
-                    vr = dictionary_VR(tag) or ''
-                    safe_value = coerce_value_to_vr(value, vr)
-                    setattr(ds, key, safe_value)
-                except Exception:
-                    # Игнорируем неподдерживаемые/некорректные ключи или значения
-                    pass
-
-        # Ветка 1: если клиент прислал готовый рендер (PNG) — используем его БЕЗ доп. конвертаций
-        if render is not None:
-            try:
-                png_bytes = await render.read()
-                img = Image.open(io.BytesIO(png_bytes)).convert('RGB')
-                arr = np.array(img, dtype=np.uint8)
-                # Записываем RGB 8-bit как PixelData, чтобы картинка совпадала 1:1
-                ds.Rows = int(arr.shape[0])
-                ds.Columns = int(arr.shape[1])
-                ds.PhotometricInterpretation = 'RGB'
-                ds.SamplesPerPixel = 3
-                ds.PlanarConfiguration = 0
-                ds.BitsAllocated = 8
-                ds.BitsStored = 8
-                ds.HighBit = 7
-                ds.PixelRepresentation = 0
-                # Чистим потенциальные конфликтующие поля
-                for k in [
-                    'PaletteColorLookupTableUID', 'RedPaletteColorLookupTableData',
-                    'GreenPaletteColorLookupTableData', 'BluePaletteColorLookupTableData',
-                    'SmallestImagePixelValue', 'LargestImagePixelValue',
-                    'VOILUTSequence', 'ModalityLUTSequence',
-                ]:
-                    if hasattr(ds, k):
-                        try:
-                            delattr(ds, k)
-                        except Exception:
-                            pass
-                # Meta + флаги
-                try:
-                    if not hasattr(ds, 'file_meta') or ds.file_meta is None:
-                        from pydicom.dataset import Dataset
-                        ds.file_meta = Dataset()
-                    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
-                except Exception:
-                    pass
-                ds.is_little_endian = True
-                ds.is_implicit_VR = False
-                ds.PixelData = arr.tobytes()
-            except Exception as e:
-                return JSONResponse(status_code=500, content={"message": f"Failed to use client render: {str(e)}"})
+def dataset_part10(dataset):
+    """Part-10 bytes набора данных из кэша — так он передаётся в процесс пула."""
+    out = io.BytesIO()
+    copy_dataset(dataset).save_as(out, write_like_original=False)
+    return out.getvalue()
 
-        # Ветка 2: если рендера нет — пробуем сжечь аннотации на сервере (как раньше)
-        elif annotations:
-            try:
-                ann = json.loads(annotations)
-            except Exception:
-                ann = None
-            if isinstance(ann, dict):
-                try:
-                    src_pixels = ds.pixel_array
-                    photometric = getattr(ds, 'PhotometricInterpretation', 'MONOCHROME2')
-                    height, width = (src_pixels.shape[0], src_pixels.shape[1]) if src_pixels.ndim >= 2 else (ds.Rows, ds.Columns)
-                    # Создаем базовое изображение только для вычисления координат/отрисовки маски
-                    if photometric.upper() == 'RGB' and src_pixels.ndim == 3 and src_pixels.dtype == np.uint8:
-                        img = Image.fromarray(src_pixels, mode='RGB')
-                    else:
-                        img = Image.new('L', (width, height), 0)
-
-                    draw = ImageDraw.Draw(img)
-                    # Функция поворота точки вокруг центра изображения на угол, как в UI (по часовой стрелке)
-                    try:
-                        rotation_deg = float(ann.get('rotation_deg', 0.0))
-                    except Exception:
-                        rotation_deg = 0.0
-                    import math
-                    if abs(rotation_deg) % 360 != 0:
-                        cx, cy = img.width / 2.0, img.height / 2.0
-                        # Преобразуем экранные координаты (после поворота по часовой) обратно в координаты исходного изображения
-                        # => вращаем точки на противоположный угол (CCW)
-                        theta = math.radians(rotation_deg)
-                        cos_t, sin_t = math.cos(theta), math.sin(theta)
-                        def rot(x, y):
-                            dx, dy = x - cx, y - cy
-                            rx = cos_t * dx - sin_t * dy + cx
-                            ry = sin_t * dx + cos_t * dy + cy
-                            return rx, ry
-                    else:
-                        def rot(x, y):
-                            return x, y
-                    try:
-                        font = ImageFont.load_default()
-                    except Exception:
-                        font = None
-
-                    def parse_color(c, fallback=(255, 255, 0)):
-                        if isinstance(c, str):
-                            # Expect formats like #RRGGBB
-                            c = c.strip()
-                            if c.startswith('#') and len(c) == 7:
-                                r = int(c[1:3], 16)
-                                g = int(c[3:5], 16)
-                                b = int(c[5:7], 16)
-                                return (r, g, b)
-                        return fallback
-
-                    # Тексты
-                    for t in ann.get('texts', []) or []:
-                        try:
-                            x = float(t.get('x', 0)); y = float(t.get('y', 0))
-                            x, y = rot(x, y)
-                            text = str(t.get('text', ''))
-                            color = parse_color(t.get('color'))
-                            # Фон
-                            if photometric.upper() == 'RGB':
-                                bg = (0, 0, 0)
-                            else:
-                                color = 255
-                                bg = 0
-                            if font:
-                                w, h = draw.textsize(text, font=font)
-                            else:
-                                w, h = draw.textsize(text)
-                            draw.rectangle([x - 5, y - 2, x - 5 + w + 10, y - 2 + h + 4], fill=bg)
-                            draw.text((x, y), text, fill=color, font=font)
-                        except Exception:
-                            pass
-
-                    # Стрелки
-                    for a in ann.get('arrows', []) or []:
-                        try:
-                            x1 = float(a.get('x1', 0)); y1 = float(a.get('y1', 0))
-                            x2 = float(a.get('x2', 0)); y2 = float(a.get('y2', 0))
-                            x1, y1 = rot(x1, y1)
-                            x2, y2 = rot(x2, y2)
-                            width = float(a.get('strokeWidth', 3))
-                            color = parse_color(a.get('color')) if photometric.upper() == 'RGB' else 255
-                            draw.line([(x1, y1), (x2, y2)], fill=color, width=int(max(1, round(width))))
-                            # наконечник стрелки
-                            import math
-                            dx = x2 - x1; dy = y2 - y1
-                            length = math.hypot(dx, dy) or 1.0
-                            ux, uy = dx / length, dy / length
-                            arrow_len = 15.0
-                            angle = 0.5
-                            px1 = x2 - arrow_len * (ux * math.cos(angle) + uy * math.sin(angle))
-                            py1 = y2 - arrow_len * (uy * math.cos(angle) - ux * math.sin(angle))
-                            px2 = x2 - arrow_len * (ux * math.cos(-angle) + uy * math.sin(-angle))
-                            py2 = y2 - arrow_len * (uy * math.cos(-angle) - ux * math.sin(-angle))
-                            draw.line([(x2, y2), (px1, py1)], fill=color, width=int(max(1, round(width))))
-                            draw.line([(x2, y2), (px2, py2)], fill=color, width=int(max(1, round(width))))
-                        except Exception:
-                            pass
-
-                    # Линейки
-                    for r in ann.get('rulers', []) or []:
-                        try:
-                            x1 = float(r.get('x1', 0)); y1 = float(r.get('y1', 0))
-                            x2 = float(r.get('x2', 0)); y2 = float(r.get('y2', 0))
-                            x1, y1 = rot(x1, y1)
-                            x2, y2 = rot(x2, y2)
-                            label = str(r.get('label', ''))
-                            color = (255, 255, 0) if photometric.upper() == 'RGB' else 255
-                            draw.line([(x1, y1), (x2, y2)], fill=color, width=3)
-                            # перпендикуляры на концах
-                            import math
-                            dx = x2 - x1; dy = y2 - y1
-                            length = math.hypot(dx, dy) or 1.0
-                            px = -dy / length * 10; py = dx / length * 10
-                            draw.line([(x1 - px, y1 - py), (x1 + px, y1 + py)], fill=color, width=2)
-                            draw.line([(x2 - px, y2 - py), (x2 + px, y2 + py)], fill=color, width=2)
-                            # подпись
-                            if label:
-                                mx = (x1 + x2) / 2 + 15
-                                my = (y1 + y2) / 2
-                                if photometric.upper() == 'RGB':
-                                    text_color = (255, 255, 0); bg = (0, 0, 0)
-                                else:
-                                    text_color = 255; bg = 0
-                                if font:
-                                    w, h = draw.textsize(label, font=font)
-                                else:
-                                    w, h = draw.textsize(label)
-                                draw.rectangle([mx - 5, my - h / 2 - 2, mx - 5 + w + 10, my - h / 2 + h + 4], fill=bg)
-                                draw.text((mx, my - h / 2), label, fill=text_color, font=font)
-                        except Exception:
-                            pass
-
-                    # Сжигаем аннотации непосредственно в исходные пиксели БЕЗ изменения размеров/битности
-                    try:
-                        if photometric.upper() == 'RGB' and src_pixels.ndim == 3 and src_pixels.dtype == np.uint8:
-                            base = Image.fromarray(src_pixels, 'RGB')
-                            overlay = img if img.mode == 'RGB' else img.convert('RGB')
-                            # Используем режим lighter для яркого burn-in
-                            base_np = np.array(base)
-                            over_np = np.array(overlay)
-                            base_np = np.maximum(base_np, over_np)
-                            ds.PixelData = base_np.tobytes()
-                        else:
-                            # Монохромный случай: рисуем маску и ставим пиксели в максимальное (или минимальное для MONOCHROME1) значение
-                            mask = img if img.mode == 'L' else img.convert('L')
-                            mask_np = np.array(mask, dtype=np.uint8)
-                            arr = np.array(src_pixels)  # сохранить dtype
-                            if np.issubdtype(arr.dtype, np.integer):
-                                info = np.iinfo(arr.dtype)
-                                maxv = info.max
-                                minv = info.min
-                            else:
-                                maxv, minv = 255, 0
-                            target = maxv if photometric.upper() != 'MONOCHROME1' else minv
-                            arr[mask_np > 0] = target
-                            ds.PixelData = arr.tobytes()
-                    except Exception:
-                        pass
-                except Exception:
-                    # Не фейлим экспорт, просто пропускаем аннотации
-                    pass
-
-        out_buf = io.BytesIO()
-        ds.save_as(out_buf, write_like_original=False)
-        out_bytes = out_buf.getvalue()
-        return {
-            'dicom_base64': base64.b64encode(out_bytes).decode('utf-8'),
-            'size': len(out_bytes)
-        }
+
+async def export_batch_results(sources, items):
+    """(имя, bytes или None, ошибка) по порядку items. Файлы обрабатываются в пуле
+    процессов; в работе одновременно не больше двух файлов на процесс, так что память
+    не растёт с размером пакета, а готовые результаты сразу уходят клиенту."""
+    from export import export_file
+    loop = asyncio.get_running_loop()
+    window = 2 * max(1, EXPORT_WORKERS)
+
+    def submit(source, item):
+        if export_pool is None:
+            return asyncio.ensure_future(run_blocking(render_executor, export_file, source, item.metadata, item.annotations))
+        return loop.run_in_executor(export_pool, export_file, source, item.metadata, item.annotations)
+
+    async def result(index, item, future):
+        name = item.filename
+        try:
+            sop_instance_uid, data = await future
+        except Exception as e:
+            return name or f"{index:04d}.dcm", None, str(e)
+        count_bytes('export', len(data))
+        return name or f"{index:04d}_{sop_instance_uid}.dcm", data, None
+
+    pending = deque()
+    for index, (source, item) in enumerate(zip(sources, items)):
+        if isinstance(source, CachedImage):
+            # Набор данных из кэша сериализуется непосредственно перед отправкой в пул
+            source = await run_blocking(render_executor, dataset_part10, source.dataset)
+        pending.append((index, item, submit(source, item)))
+        if len(pending) >= window:
+            yield await result(*pending.popleft())
+    while pending:
+        yield await result(*pending.popleft())
+
+
+@app.post("/export_batch/")
+async def export_batch(request: ExportBatchRequest):
+    """Пакетный экспорт: теги, отчёт и сожжённые аннотации для многих изображений (например,
+    серии для отправки в PACS) за один запрос. Каждый файл обрабатывается в процессе пула,
+    результаты отдаются потоком по мере готовности — ZIP (с manifest.json) или multipart/mixed."""
+    if request.format not in EXPORT_BATCH_FORMATS:
+        return JSONResponse(
+            status_code=400,
+            content={"message": f"Unsupported format '{request.format}'. Expected one of: {', '.join(EXPORT_BATCH_FORMATS)}"},
+        )
+    if not request.items:
+        return JSONResponse(status_code=400, content={"message": "No items to export."})
+    sources = []
+    for index, item in enumerate(request.items):
+        if (item.image_id is None) == (item.path is None):
+            return JSONResponse(status_code=400, content={"message": f"Item {index}: exactly one of 'image_id' or 'path' is required."})
+        if item.path is not None:
+            if not os.path.isfile(item.path):
+                return JSONResponse(status_code=404, content={"message": f"Item {index}: file not found: {item.path}"})
+            sources.append(item.path)
+            continue
+        entry = dicom_cache.get(item.image_id)
+        if entry is None or entry.dataset is None:
+            return JSONResponse(status_code=404, content={"message": f"Item {index}: no DICOM data in cache."})
+        sources.append(entry)
+    from export import zip_stream, multipart_stream, multipart_boundary
+    results = export_batch_results(sources, request.items)
+    if request.format == 'zip':
+        return StreamingResponse(zip_stream(results), media_type='application/zip',
+                                 headers={'Content-Disposition': 'attachment; filename="export.zip"'})
+    boundary = multipart_boundary()
+    return StreamingResponse(multipart_stream(results, boundary), media_type=f'multipart/mixed; boundary={boundary}')
+
+async def run_rewrite_job(job, pairs, request, salt):
+    """Перезапись файлов задания в пуле процессов (или потоков индексирования), не больше
+    двух файлов на воркер одновременно; прогресс — в job."""
+    from anonymize import rewrite_file
+    loop = asyncio.get_running_loop()
+    window = 2 * max(1, EXPORT_WORKERS if export_pool is not None else index_workers_from_env())
+    args = (request.profile, request.tags, request.report, salt)
+
+    def submit(source, destination):
+        if export_pool is None:
+            return asyncio.ensure_future(run_blocking(index_executor, rewrite_file, source, destination, *args))
+        return loop.run_in_executor(export_pool, rewrite_file, source, destination, *args)
+
+    async def collect(source, future):
+        try:
+            job.record(source, await future)
+        except Exception as e:
+            job.record(source, error=str(e))
+
+    try:
+        pending = deque()
+        for source, destination in pairs:
+            pending.append((source, submit(source, destination)))
+            if len(pending) >= window:
+                await collect(*pending.popleft())
+        while pending:
+            await collect(*pending.popleft())
+        job.finish()
     except Exception as e:
-        return JSONResponse(status_code=500, content={"message": str(e)})
+        print(f"PYTHON ERROR in batch job {job.job_id}: {e}")
+        job.finish('failed')
+        raise
+    report = job.report()
+    count_bytes('rewrite', report['bytes_read'] + report['bytes_written'])
+    print(f"Задание {job.job_id}: {report['written']} файлов за {report['elapsed_s']} с "
+          f"({report['files_per_s']} файлов/с, {report['mb_per_s']} MB/s)")
 
-if __name__ == "__main__":
-    import uvicorn
-    print("Запуск сервера на http://127.0.0.1:8000")
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+
+@app.post("/rewrite_folder/")
+async def rewrite_folder(request: RewriteFolderRequest):
+    """Фоновое задание: обезличивание (profile=basic) и/или правка тегов и отчёта во всех
+    файлах папки. Переписывается только заголовок, PixelData копируется байтами без
+    декодирования. Возвращает задание сразу; прогресс — GET /jobs/{job_id}."""
+    from anonymize import ANONYMIZATION_PROFILES
+    if request.profile not in ANONYMIZATION_PROFILES:
+        return JSONResponse(
+            status_code=400,
+            content={"message": f"Unknown profile '{request.profile}'. Expected one of: {', '.join(ANONYMIZATION_PROFILES)}"},
+        )
+    if not os.path.isdir(request.path):
+        return JSONResponse(status_code=400, content={"message": f"Not a directory: {request.path}"})
+    source_root, output_root = os.path.realpath(request.path), os.path.realpath(request.output_path)
+    if output_root == source_root or output_root.startswith(source_root + os.sep):
+        return JSONResponse(status_code=400, content={"message": "output_path must be outside of path."})
+    files = await run_blocking(render_executor, list_files, source_root, request.recursive)
+    pairs = [(path, os.path.join(output_root, os.path.relpath(path, source_root))) for path in files]
+    job = batch_jobs.add(BatchJob('rewrite_folder', len(pairs), path=source_root,
+                                  output_path=output_root, profile=request.profile))
+    job.task = asyncio.create_task(run_rewrite_job(job, pairs, request, request.salt or uuid.uuid4().hex))
+    return JSONResponse(status_code=202, content=job.report())
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Прогресс пакетного задания: обработано/записано/пропущено/ошибок, объёмы, файлов/с и MB/s."""
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"message": "Job not found."})
+    return job.report()
+
+
+@app.get("/jobs/")
+async def list_jobs():
+    return [job.report() for job in batch_jobs.list()]
+
+startup_timer.mark('app')
\ No newline at end of file
@@ -0,0 +1,199 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Границы бакетов гистограмм длительностей (секунды)
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Тайминги текущего запроса; в пул воркеров передаются через run_blocking (copy_context)
+_current_timings = contextvars.ContextVar('request_timings', default=None)
+
+# False внутри not_recorded(): синтетическая работа (прогрев) не попадает в метрики
+_recording = contextvars.ContextVar('metrics_recording', default=True)
+
+
+def server_timing_from_env():
+    """Заголовок Server-Timing в ответах (DICOM_SERVER_TIMING=1) — для DevTools и отладки."""
+    return os.environ.get('DICOM_SERVER_TIMING', '0').lower() in ('1', 'true', 'yes')
+
+
+class RequestTimings:
+    """Этапы одного запроса (мс) и объёмы данных в порядке выполнения."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.bytes = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self):
+        parts = [f"{name};dur={seconds * 1000.0:.2f}" for name, seconds in self.stages.items()]
+        parts += [f'{kind}_bytes;desc="{n}"' for kind, n in self.bytes.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000.0:.2f}")
+        return ', '.join(parts)
+
+
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+
+class MetricsRegistry:
+    """Накопленные метрики процесса в формате Prometheus text exposition.
+
+    - dicom_stage_seconds{stage} — гистограмма длительностей этапов обработки;
+    - dicom_request_seconds{endpoint} и dicom_requests_total{endpoint,status};
+    - dicom_bytes_total{kind} — объёмы (загрузки, декодированные пиксели, ответы).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._requests = {}
+        self._request_counts = {}
+        self._bytes = {}
+
+    def observe_stage(self, stage, seconds):
+        with self._lock:
+            self._stages.setdefault(stage, _Histogram()).observe(seconds)
+
+    def observe_request(self, endpoint, status, seconds):
+        with self._lock:
+            self._requests.setdefault(endpoint, _Histogram()).observe(seconds)
+            key = (endpoint, str(status))
+            self._request_counts[key] = self._request_counts.get(key, 0) + 1
+
+    def count_bytes(self, kind, n):
+        with self._lock:
+            self._bytes[kind] = self._bytes.get(kind, 0) + int(n)
+
+    @staticmethod
+    def _histogram_lines(name, label, histograms):
+        lines = [f"# TYPE {name} histogram"]
+        for value, histogram in sorted(histograms.items()):
+            labels = f'{label}="{value}"'
+            for bound, count in zip(DURATION_BUCKETS, histogram.buckets):
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{{labels}}} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+        return lines
+
+    def render(self, gauges=None):
+        """Текст для /metrics; gauges — {имя: число} текущих значений (кэши, запуск)."""
+        with self._lock:
+            lines = ["# HELP dicom_stage_seconds Time spent in a processing stage."]
+            lines += self._histogram_lines('dicom_stage_seconds', 'stage', self._stages)
+            lines.append("# HELP dicom_request_seconds HTTP request latency by endpoint.")
+            lines += self._histogram_lines('dicom_request_seconds', 'endpoint', self._requests)
+            lines.append("# HELP dicom_requests_total HTTP requests by endpoint and status.")
+            lines.append("# TYPE dicom_requests_total counter")
+            for (endpoint, status), count in sorted(self._request_counts.items()):
+                lines.append(f'dicom_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+            lines.append("# HELP dicom_bytes_total Bytes processed by kind.")
+            lines.append("# TYPE dicom_bytes_total counter")
+            for kind, count in sorted(self._bytes.items()):
+                lines.append(f'dicom_bytes_total{{kind="{kind}"}} {count}')
+        for name, value in (gauges or {}).items():
+            if value is None:
+                continue
+            lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def not_recorded():
+    """Этапы и объёмы внутри блока не учитываются — например, прогрев при запуске,
+    иначе его замеры смешались бы с замерами первых настоящих запросов."""
+    token = _recording.set(False)
+    try:
+        yield
+    finally:
+        _recording.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """Замер этапа: в гистограмму процесса и в тайминги текущего запроса (если есть)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _recording.get():
+            seconds = time.perf_counter() - start
+            registry.observe_stage(name, seconds)
+            timings = _current_timings.get()
+            if timings is not None:
+                timings.add(name, seconds)
+
+
+def stage_since_request_start(name):
+    """Этап от начала запроса до текущего момента — например, чтение и разбор тела
+    multipart, которые FastAPI выполняет до вызова эндпоинта."""
+    timings = _current_timings.get()
+    if timings is None:
+        return
+    seconds = time.perf_counter() - timings.started
+    registry.observe_stage(name, seconds)
+    timings.add(name, seconds)
+
+
+def count_bytes(kind, n):
+    if not _recording.get():
+        return
+    registry.count_bytes(kind, n)
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.bytes[kind] = timings.bytes.get(kind, 0) + int(n)
+
+
+class TimingMiddleware:
+    """ASGI-middleware: тайминги на каждый HTTP-запрос, метрика латентности по эндпоинту
+    и (при server_timing) заголовок Server-Timing с этапами запроса."""
+
+    def __init__(self, app, server_timing=False):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        status = [500]
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if self.server_timing:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", timings.server_timing().encode('latin-1')))
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_timings.reset(token)
+            # После маршрутизации в scope есть endpoint: имя функции вместо пути с параметрами
+            endpoint = getattr(scope.get("endpoint"), '__name__', 'unmatched')
+            registry.observe_request(endpoint, status[0], time.perf_counter() - timings.started)
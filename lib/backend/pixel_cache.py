@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+import numpy as np
+from numpy.lib import format as npy_format
+
+from settings import int_from_env
+
+
+# Папка кэша по умолчанию — рядом с сервером; DICOM_DISK_CACHE_DIR переопределяет
+DEFAULT_DISK_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pixel_cache')
+
+# Бюджет диска на декодированные пиксели (0 — кэш выключен)
+DEFAULT_DISK_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+# Версия формата записи: при изменении старые записи считаются промахами
+FORMAT_VERSION = 1
+
+# Кусок данных для CRC32 при записи и проверке
+_CRC_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+
+def content_hash(contents):
+    """SHA-1 исходного файла (bytes или mmap) — вторая часть ключа рядом с SOPInstanceUID."""
+    return hashlib.sha1(contents).hexdigest()
+
+
+def _crc32(array):
+    flat = array.reshape(-1).view(np.uint8)
+    crc = 0
+    for start in range(0, flat.size, _CRC_CHUNK_BYTES):
+        crc = zlib.crc32(flat[start:start + _CRC_CHUNK_BYTES], crc)
+    return crc
+
+
+class DiskPixelCache:
+    """Декодированные пиксели на диске: <key>.npy (отображается в память при чтении)
+    и <key>.json с метаданными и контрольной суммой.
+
+    Ключ — SOPInstanceUID плюс хэш содержимого файла: изменённый файл с тем же UID
+    не получит чужие пиксели. Запись атомарна (временный файл + os.replace, сайдкар
+    последним), при чтении проверяются версия, ключ, dtype/shape и размер, а CRC32 —
+    только при первом открытии записи в процессе (полный проход по данным загрузил бы
+    все страницы mmap на каждом попадании); повреждённая запись удаляется. Объём ограничен бюджетом, вытесняются записи,
+    к которым дольше всего не обращались (mtime сайдкара).
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or os.environ.get('DICOM_DISK_CACHE_DIR', DEFAULT_DISK_CACHE_DIR)
+        self.max_bytes = int_from_env('DICOM_DISK_CACHE_BYTES', DEFAULT_DISK_CACHE_BYTES) if max_bytes is None else int(max_bytes)
+        # RLock: evict удаляет записи через _remove, не отпуская блокировку
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.corrupt = 0
+        # (ключ, размер, mtime .npy) записей, чей CRC32 уже проверен в этом процессе
+        self._verified = set()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, sop_instance_uid, digest):
+        return hashlib.sha1(f"{sop_instance_uid}|{digest}".encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.root, key + '.npy'), os.path.join(self.root, key + '.json')
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        """Пиксели из кэша как read-only np.memmap (без декодирования) или None."""
+        if not self.enabled:
+            return None
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            self._count('misses')
+            return None
+        try:
+            pixels = np.load(data_path, mmap_mode='r')
+            stat = os.stat(data_path)
+            if (meta.get('version') != FORMAT_VERSION or meta.get('key') != key
+                    or str(pixels.dtype) != meta.get('dtype') or list(pixels.shape) != meta.get('shape')
+                    or stat.st_size != meta.get('file_bytes')):
+                raise ValueError("integrity check failed")
+            identity = (key, stat.st_size, stat.st_mtime_ns)
+            with self._lock:
+                verified = identity in self._verified
+            if not verified:
+                if _crc32(pixels) != meta.get('crc32'):
+                    raise ValueError("checksum mismatch")
+                with self._lock:
+                    self._verified.add(identity)
+        except Exception as e:
+            print(f"Запись дискового кэша {key} повреждена, удаляем: {e}")
+            self._count('corrupt')
+            self._count('misses')
+            self._remove(key)
+            return None
+        try:
+            # Время последнего обращения для вытеснения
+            os.utime(meta_path)
+        except OSError:
+            pass
+        self._count('hits')
+        return pixels
+
+    def put(self, key, pixels, metadata=None):
+        """Сохраняет декодированный массив; ошибки записи не мешают работе с изображением."""
+        if not self.enabled or pixels.nbytes > self.max_bytes:
+            return
+        data_path, meta_path = self._paths(key)
+        data_tmp = f"{data_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        meta_tmp = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            pixels = np.ascontiguousarray(pixels)
+            with open(data_tmp, 'wb') as f:
+                npy_format.write_array(f, pixels, allow_pickle=False)
+            meta = dict(metadata or {})
+            meta.update({
+                "version": FORMAT_VERSION,
+                "key": key,
+                "dtype": str(pixels.dtype),
+                "shape": list(pixels.shape),
+                "file_bytes": os.path.getsize(data_tmp),
+                "crc32": _crc32(pixels),
+                "created": time.time(),
+            })
+            with open(meta_tmp, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(data_tmp, data_path)
+            # Сайдкар появляется последним: без него запись считается отсутствующей
+            os.replace(meta_tmp, meta_path)
+            self._count('writes')
+        except Exception as e:
+            print(f"Не удалось записать пиксели в дисковый кэш: {e}")
+            for path in (data_tmp, meta_tmp):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return
+        self.evict()
+
+    def _remove(self, key):
+        """Удаляет оба файла записи; False, если что-то осталось на диске (на Windows
+        файл, ещё отображённый в память, удалить нельзя)."""
+        with self._lock:
+            self._verified = {identity for identity in self._verified if identity[0] != key}
+        # Сначала данные: если .npy занят, сайдкар остаётся, и запись по-прежнему
+        # учитывается в объёме и будет вытеснена повторно
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                return False
+        return True
+
+    def _entries(self):
+        """[(mtime сайдкара, ключ, байты)] всех полных записей."""
+        entries = []
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            data_path, meta_path = self._paths(key)
+            try:
+                entries.append((os.path.getmtime(meta_path), key,
+                                os.path.getsize(data_path) + os.path.getsize(meta_path)))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        """Удаляет самые давно использованные записи, пока объём не уложится в бюджет."""
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, _, size in entries)
+            for _, key, size in entries:
+                if total <= self.max_bytes:
+                    break
+                if not self._remove(key):
+                    # Запись занята (отображена в память): она остаётся в объёме,
+                    # вытесняется следующая по давности
+                    continue
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        entries = self._entries() if self.enabled else []
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "root": self.root,
+                "entries": len(entries),
+                "bytes": sum(size for _, _, size in entries),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "corrupt": self.corrupt,
+            }
@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from settings import int_from_env
+
+
+# Сторона тайла и минимальный размер верхнего уровня пирамиды
+TILE_SIZE = 256
+
+# Бюджет памяти на отрендеренные 8-битные тайлы всех изображений
+DEFAULT_TILE_CACHE_BYTES = 64 * 1024 * 1024
+
+# Сколько строк исходного уровня усреднять за раз: временные float32 остаются небольшими
+_DOWNSAMPLE_ROWS = 512
+
+
+def pyramid_shapes(shape):
+    """Размеры (rows, cols) уровней пирамиды: уровень 0 — оригинал, каждый следующий вдвое меньше."""
+    rows, cols = int(shape[0]), int(shape[1])
+    shapes = [(rows, cols)]
+    while max(rows, cols) > TILE_SIZE:
+        rows, cols = (rows + 1) // 2, (cols + 1) // 2
+        shapes.append((rows, cols))
+    return shapes
+
+
+def downsample(pixels):
+    """Уменьшение вдвое усреднением блоков 2x2 с сохранением dtype (хранимые значения
+    остаются валидными индексами LUT движка W/L). Нечётный край дублируется."""
+    rows, cols = pixels.shape[0], pixels.shape[1]
+    out = np.empty(((rows + 1) // 2, (cols + 1) // 2) + pixels.shape[2:], dtype=pixels.dtype)
+    integer = np.issubdtype(pixels.dtype, np.integer)
+    for start in range(0, rows, _DOWNSAMPLE_ROWS):
+        block = pixels[start:start + _DOWNSAMPLE_ROWS].astype(np.float32)
+        if block.shape[0] % 2:
+            block = np.concatenate([block, block[-1:]], axis=0)
+        if block.shape[1] % 2:
+            block = np.concatenate([block, block[:, -1:]], axis=1)
+        mean = (block[0::2, 0::2] + block[1::2, 0::2] + block[0::2, 1::2] + block[1::2, 1::2]) * 0.25
+        if integer:
+            mean = np.rint(mean)
+        out[start // 2:start // 2 + mean.shape[0]] = mean
+    return out
+
+
+def build_pyramid(pixels):
+    """Список уровней: [pixels, pixels/2, pixels/4, ...] до стороны не больше TILE_SIZE."""
+    levels = [pixels]
+    for _ in pyramid_shapes(pixels.shape)[1:]:
+        levels.append(downsample(levels[-1]))
+    return levels
+
+
+def pyramid_extra_bytes(pixels):
+    """Объём уровней пирамиды сверх оригинала (известен до её построения)."""
+    pixel_bytes = pixels.itemsize * (pixels.shape[2] if pixels.ndim == 3 else 1)
+    return sum(rows * cols * pixel_bytes for rows, cols in pyramid_shapes(pixels.shape)[1:])
+
+
+def tile_range(start, length):
+    """Номера тайлов, покрывающих отрезок [start, start + length)."""
+    return range(start // TILE_SIZE, (start + length - 1) // TILE_SIZE + 1)
+
+
+class TileCache:
+    """LRU отрендеренных тайлов по ключу (image_id, W/L, гамма, уровень, тайл).
+
+    При панорамировании с теми же W/L большая часть тайлов вьюпорта уже готова,
+    и рендерить приходится только открывшиеся края.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = int_from_env('DICOM_TILE_CACHE_BYTES', DEFAULT_TILE_CACHE_BYTES) if max_bytes is None else int(max_bytes)
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile):
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._tiles[key] = tile
+            self._bytes += tile.nbytes
+            while self._bytes > self.max_bytes and len(self._tiles) > 1:
+                _, evicted = self._tiles.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def discard(self, image_id):
+        """Удаляет тайлы изображения (после повторной загрузки с тем же handle)."""
+        with self._lock:
+            for key in [k for k in self._tiles if k[0] == image_id]:
+                self._bytes -= self._tiles.pop(key).nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tiles": len(self._tiles),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,173 @@
+import numpy as np
+
+
+ROI_SHAPES = ('rectangle', 'ellipse')
+
+# Кусок строк при построении таблиц (ограничивает временный массив квадратов)
+_SAT_CHUNK_ROWS = 256
+
+
+def _sum_dtype(bound):
+    """Самый компактный беззнаковый тип, в котором не переполнится сумма до bound."""
+    return np.uint32 if bound < 2 ** 32 else np.uint64
+
+
+def _exact_sums(pixels):
+    """Можно ли считать суммы квадратов точно в целых (int64) — для 32-битных данных нет."""
+    if not np.issubdtype(pixels.dtype, np.integer):
+        return False
+    span = int(pixels.max()) - int(pixels.min())
+    return span * span * pixels.size < 2 ** 63
+
+
+class SummedAreaTable:
+    """Таблицы накопленных сумм (summed-area tables) хранимых значений и их квадратов
+    для одного кадра: сумма по любому прямоугольнику — четыре обращения к таблице.
+
+    Значения сдвигаются на минимум кадра, чтобы стать неотрицательными; тип сумм
+    выбирается по худшему случаю (весь кадр из максимальных значений): для 8-битных
+    и небольших 12-битных изображений хватает uint32, иначе uint64. Дисперсия от
+    сдвига не зависит, среднее восстанавливается прибавлением offset.
+    Таблицы на одну строку и столбец больше кадра (нулевая рамка), чтобы запрос
+    прямоугольника у края не требовал проверок.
+    Для данных с плавающей точкой (и 32-битных целых) суммы хранятся в float64.
+    """
+
+    def __init__(self, pixels):
+        if pixels.ndim != 2:
+            raise ValueError("ROI statistics need a single-channel image")
+        rows, cols = pixels.shape
+        self.shape = (rows, cols)
+        integer = _exact_sums(pixels)
+        self.offset = int(pixels.min()) if integer else 0.0
+        if integer:
+            span = int(pixels.max()) - self.offset
+            count = rows * cols
+            value_dtype, square_dtype = _sum_dtype(span * count), _sum_dtype(span * span * count)
+            work_dtype = np.int64
+        else:
+            value_dtype = square_dtype = work_dtype = np.float64
+
+        self.values = np.zeros((rows + 1, cols + 1), dtype=value_dtype)
+        self.squares = np.zeros((rows + 1, cols + 1), dtype=square_dtype)
+        # Накопление по кускам строк: сумма столбцов переносится из последней строки куска
+        for start in range(0, rows, _SAT_CHUNK_ROWS):
+            block = pixels[start:start + _SAT_CHUNK_ROWS].astype(work_dtype)
+            if integer:
+                block -= self.offset
+            stop = start + block.shape[0]
+            for table, data in ((self.values, block), (self.squares, block * block)):
+                out = table[start + 1:stop + 1, 1:]
+                np.cumsum(data, axis=0, out=out)
+                out += table[start, 1:]
+            del block
+        np.cumsum(self.values[:, 1:], axis=1, out=self.values[:, 1:])
+        np.cumsum(self.squares[:, 1:], axis=1, out=self.squares[:, 1:])
+
+    @property
+    def nbytes(self):
+        return int(self.values.nbytes + self.squares.nbytes)
+
+    @staticmethod
+    def _box(table, top, left, bottom, right):
+        # Разность в int/float Python: без переполнения и потери точности uint
+        if table.dtype.kind == 'f':
+            return float(table[bottom, right]) - float(table[top, right]) \
+                - float(table[bottom, left]) + float(table[top, left])
+        return int(table[bottom, right]) - int(table[top, right]) - int(table[bottom, left]) + int(table[top, left])
+
+    def rectangle(self, top, left, bottom, right):
+        """(число пикселей, сумма, сумма квадратов) сдвинутых значений в [top:bottom, left:right]."""
+        count = (bottom - top) * (right - left)
+        return (count, self._box(self.values, top, left, bottom, right),
+                self._box(self.squares, top, left, bottom, right))
+
+    def rows(self, row_indices, lefts, rights):
+        """Те же суммы по набору горизонтальных отрезков (строка, [left, right)) — векторно."""
+        r0, r1 = row_indices, row_indices + 1
+        widths = rights - lefts
+        keep = widths > 0
+        r0, r1, lefts, rights = r0[keep], r1[keep], lefts[keep], rights[keep]
+
+        def spans(table):
+            work = np.float64 if table.dtype.kind == 'f' else np.int64
+            return (table[r1, rights].astype(work) - table[r0, rights].astype(work)
+                    - table[r1, lefts].astype(work) + table[r0, lefts].astype(work))
+
+        return int(widths[keep].sum()), spans(self.values).sum(), spans(self.squares).sum()
+
+
+def clip_roi(shape, x, y, width, height):
+    """Прямоугольник ROI в пикселях кадра, обрезанный по его границам, или None."""
+    rows, cols = shape
+    left, top = max(0, int(np.floor(x))), max(0, int(np.floor(y)))
+    right, bottom = min(cols, int(np.ceil(x + width))), min(rows, int(np.ceil(y + height)))
+    if right <= left or bottom <= top:
+        return None
+    return top, left, bottom, right
+
+
+def ellipse_mask(x, y, width, height, top, left, bottom, right):
+    """Маска пикселей (центров) эллипса, вписанного в (x, y, width, height), внутри
+    обрезанного прямоугольника [top:bottom, left:right] — одной векторной операцией."""
+    cy, cx = y + height / 2.0, x + width / 2.0
+    ry, rx = max(height / 2.0, 1e-6), max(width / 2.0, 1e-6)
+    yy = ((np.arange(top, bottom, dtype=np.float64) + 0.5 - cy) / ry)[:, None]
+    xx = ((np.arange(left, right, dtype=np.float64) + 0.5 - cx) / rx)[None, :]
+    return yy * yy + xx * xx <= 1.0
+
+
+def _moments(count, total, squares, offset):
+    mean = total / count + offset
+    # Дисперсия по сдвинутым значениям (устойчивее к потере точности)
+    shifted_mean = total / count
+    variance = max(squares / count - shifted_mean * shifted_mean, 0.0)
+    return mean, float(np.sqrt(variance))
+
+
+def roi_stats(pixels, table, shape, x, y, width, height, slope=1.0, intercept=0.0, spacing=None):
+    """Статистика ROI в единицах модальности (mean, std, min, max) и площадь.
+
+    Прямоугольник: среднее и СКО — O(1) по таблицам накопленных сумм; min/max по
+    таблицам не считаются, поэтому берутся одной векторной редукцией по срезу (view).
+    Эллипс: маска по описанному прямоугольнику; суммы — по строкам маски через те же
+    таблицы, min/max — редукцией по маске.
+    spacing — (строка, столбец) мм на пиксель для площади в мм².
+    """
+    if shape not in ROI_SHAPES:
+        raise ValueError(f"Unknown ROI shape '{shape}'. Expected one of: {', '.join(ROI_SHAPES)}")
+    bounds = clip_roi(table.shape, x, y, width, height)
+    if bounds is None:
+        raise ValueError("ROI does not intersect the image")
+    top, left, bottom, right = bounds
+    box = pixels[top:bottom, left:right]
+    if shape == 'rectangle':
+        count, total, squares = table.rectangle(top, left, bottom, right)
+        low, high = box.min(), box.max()
+    else:
+        mask = ellipse_mask(x, y, width, height, top, left, bottom, right)
+        if not mask.any():
+            raise ValueError("ROI does not contain any pixel centres")
+        row_hits = mask.any(axis=1)
+        # Границы отрезка эллипса в каждой строке (маска выпукла по строкам)
+        lefts = np.argmax(mask, axis=1) + left
+        rights = right - np.argmax(mask[:, ::-1], axis=1)
+        row_indices = np.arange(top, bottom)[row_hits]
+        count, total, squares = table.rows(row_indices, lefts[row_hits], rights[row_hits])
+        selected = box[mask]
+        low, high = selected.min(), selected.max()
+
+    mean, std = _moments(count, float(total), float(squares), table.offset)
+    result = {
+        "shape": shape,
+        "bounds": {"x": left, "y": top, "width": right - left, "height": bottom - top},
+        "pixels": int(count),
+        "mean": mean * slope + intercept,
+        "std": std * abs(slope),
+        "min": min(float(low) * slope + intercept, float(high) * slope + intercept),
+        "max": max(float(low) * slope + intercept, float(high) * slope + intercept),
+        "area_mm2": None,
+    }
+    if spacing is not None:
+        result["area_mm2"] = count * float(spacing[0]) * float(spacing[1])
+    return result
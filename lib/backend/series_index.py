@@ -0,0 +1,200 @@
+import os
+import threading
+
+import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+from settings import int_from_env
+
+
+# Чтение заголовков — в основном ввод-вывод, поэтому потоков больше, чем ядер
+DEFAULT_INDEX_WORKERS = 8
+
+
+def index_workers_from_env():
+    return int_from_env('DICOM_INDEX_WORKERS', min(DEFAULT_INDEX_WORKERS, 2 * (os.cpu_count() or 1)), minimum=1)
+
+
+def _text(ds, keyword):
+    value = ds.get(keyword)
+    if value is None:
+        return ''
+    try:
+        return str(value).strip()
+    except Exception:
+        return ''
+
+
+def _floats(value):
+    try:
+        return [float(v) for v in value]
+    except (TypeError, ValueError):
+        return None
+
+
+def read_header(path):
+    """Заголовок одного файла без PixelData; None, если это не DICOM-изображение."""
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, force=True)
+    except (InvalidDicomError, OSError, ValueError, EOFError, AttributeError, KeyError, TypeError):
+        return None
+    series_uid = _text(ds, 'SeriesInstanceUID')
+    if not series_uid or 'Rows' not in ds:
+        # DICOMDIR, SR, мусор в папке — в индекс не попадают
+        return None
+    try:
+        instance_number = int(ds.get('InstanceNumber'))
+    except (TypeError, ValueError):
+        instance_number = None
+    try:
+        frames = max(1, int(ds.get('NumberOfFrames', 1) or 1))
+    except (TypeError, ValueError):
+        frames = 1
+    return {
+        "path": path,
+        "study_instance_uid": _text(ds, 'StudyInstanceUID'),
+        "series_instance_uid": series_uid,
+        "sop_instance_uid": _text(ds, 'SOPInstanceUID'),
+        "patient_name": _text(ds, 'PatientName'),
+        "patient_id": _text(ds, 'PatientID'),
+        "study_date": _text(ds, 'StudyDate'),
+        "study_description": _text(ds, 'StudyDescription'),
+        "series_description": _text(ds, 'SeriesDescription'),
+        "series_number": _text(ds, 'SeriesNumber'),
+        "modality": _text(ds, 'Modality'),
+        "instance_number": instance_number,
+        "image_position": _floats(ds.get('ImagePositionPatient')),
+        "image_orientation": _floats(ds.get('ImageOrientationPatient')),
+        "number_of_frames": frames,
+        "rows": int(ds.Rows),
+        "columns": int(ds.Columns),
+    }
+
+
+def _slice_position(record, normal):
+    """Положение среза вдоль нормали к плоскости (проекция ImagePositionPatient)."""
+    position = record["image_position"]
+    if normal is None or position is None or len(position) != 3:
+        return None
+    return float(np.dot(normal, position))
+
+
+def sort_instances(records):
+    """Сортирует срезы серии по положению вдоль нормали, затем по InstanceNumber и пути."""
+    orientation = next((r["image_orientation"] for r in records
+                        if r["image_orientation"] and len(r["image_orientation"]) == 6), None)
+    normal = np.cross(orientation[:3], orientation[3:]) if orientation else None
+    for record in records:
+        record["slice_position"] = _slice_position(record, normal)
+
+    def key(record):
+        position = record["slice_position"]
+        number = record["instance_number"]
+        return (
+            position is None, position if position is not None else 0.0,
+            number is None, number if number is not None else 0,
+            record["path"],
+        )
+
+    return sorted(records, key=key)
+
+
+def list_files(root, recursive=True):
+    if not recursive:
+        return sorted(os.path.join(root, name) for name in os.listdir(root)
+                      if os.path.isfile(os.path.join(root, name)))
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        files.extend(os.path.join(dirpath, name) for name in sorted(filenames))
+    return files
+
+
+class SeriesIndex:
+    """Индекс исследование/серия/срез для папок, открытых через /index_folder/.
+
+    Хранит только заголовочную информацию и пути: пиксели среза читаются и
+    декодируются при первом обращении к нему.
+    """
+
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def index_directory(self, root, executor=None, recursive=True):
+        """Читает заголовки всех файлов папки (параллельно, если есть пул) и возвращает индекс."""
+        files = list_files(root, recursive)
+        if executor is None:
+            records = [read_header(path) for path in files]
+        else:
+            records = list(executor.map(read_header, files))
+        records = [r for r in records if r is not None]
+
+        grouped = {}
+        for record in records:
+            grouped.setdefault(record["series_instance_uid"], []).append(record)
+        series = {uid: sort_instances(items) for uid, items in grouped.items()}
+        with self._lock:
+            self._series.update(series)
+        return {
+            "root": root,
+            "files_scanned": len(files),
+            "dicom_files": len(records),
+            "studies": self._studies(series),
+        }
+
+    @staticmethod
+    def _studies(series):
+        studies = {}
+        for uid, instances in series.items():
+            first = instances[0]
+            study = studies.setdefault(first["study_instance_uid"], {
+                "study_instance_uid": first["study_instance_uid"],
+                "patient_name": first["patient_name"],
+                "patient_id": first["patient_id"],
+                "study_date": first["study_date"],
+                "study_description": first["study_description"],
+                "series": [],
+            })
+            study["series"].append({
+                "series_instance_uid": uid,
+                "series_number": first["series_number"],
+                "series_description": first["series_description"],
+                "modality": first["modality"],
+                "number_of_instances": len(instances),
+                "instances": [
+                    {
+                        "index": i,
+                        "sop_instance_uid": r["sop_instance_uid"],
+                        "instance_number": r["instance_number"],
+                        "slice_position": r["slice_position"],
+                        "number_of_frames": r["number_of_frames"],
+                    }
+                    for i, r in enumerate(instances)
+                ],
+            })
+        for study in studies.values():
+            study["series"].sort(key=lambda s: (s["series_number"] == '', s["series_number"].zfill(8)))
+        return list(studies.values())
+
+    def instance(self, series_uid, index):
+        """Запись среза index в отсортированной серии или None."""
+        with self._lock:
+            instances = self._series.get(series_uid)
+        if instances is None or not 0 <= index < len(instances):
+            return None
+        return instances[index]
+
+    def instances(self, series_uid):
+        """Отсортированные записи срезов серии (пустой список, если серия не индексирована)."""
+        with self._lock:
+            return list(self._series.get(series_uid, ()))
+
+    def series_uids(self):
+        with self._lock:
+            return list(self._series)
+
+    def series_length(self, series_uid):
+        with self._lock:
+            return len(self._series.get(series_uid, ()))
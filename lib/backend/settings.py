@@ -0,0 +1,14 @@
+import os
+
+
+# Модуль без тяжёлых зависимостей: его импортируют все модули backend'а (и процессы пулов)
+
+
+def int_from_env(name, default, minimum=None):
+    """Целое из переменной окружения name; default, если она не задана или не число.
+    minimum — нижняя граница (например, 0 воркеров)."""
+    try:
+        value = int(os.environ.get(name, default))
+    except ValueError:
+        value = default
+    return value if minimum is None else max(minimum, value)
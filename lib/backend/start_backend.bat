@@ -1,7 +1,7 @@
 @echo off
 echo Starting DICOM Viewer Backend...
 cd /d "%~dp0"
-python main.py
+python -m uvicorn main:app --host 127.0.0.1 --port 8000
 pause
 
 
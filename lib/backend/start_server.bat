@@ -4,6 +4,6 @@ echo Установка зависимостей...
 pip install fastapi uvicorn pydicom pillow numpy
 
 echo Запуск сервера...
-python main.py
+python -m uvicorn main:app --host 127.0.0.1 --port 8000
 
 pause
@@ -0,0 +1,55 @@
+import threading
+import time
+
+
+# Модуль импортируется первым в main.py и не должен тянуть тяжёлых зависимостей:
+# всё, что импортируется после него, попадает в фазу "imports"
+
+
+class StartupTimer:
+    """Фазы запуска сервера (импорты, сборка приложения, старт, прогрев) и время
+    от запуска процесса до первого показанного изображения."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self._lock = threading.Lock()
+        self.phases = {}
+        self.state = 'starting'
+        self.first_image_ms = None
+
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self.started) * 1000.0, 1)
+
+    def mark(self, phase):
+        """Завершает фазу phase: её длительность — время с конца предыдущей фазы."""
+        now = time.perf_counter()
+        with self._lock:
+            self.phases[phase] = round((now - self._last) * 1000.0, 1)
+            self._last = now
+
+    def set_state(self, state):
+        with self._lock:
+            self.state = state
+
+    def first_image(self):
+        """Отмечает первое изображение; True только для самого первого вызова."""
+        with self._lock:
+            if self.first_image_ms is not None:
+                return False
+            self.first_image_ms = round((time.perf_counter() - self.started) * 1000.0, 1)
+            return True
+
+    def report(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "phases_ms": dict(self.phases),
+                "uptime_ms": round((time.perf_counter() - self.started) * 1000.0, 1),
+                "time_to_first_image_ms": self.first_image_ms,
+            }
+
+    def summary(self):
+        with self._lock:
+            phases = ', '.join(f"{name} {ms} мс" for name, ms in self.phases.items())
+        return f"Запуск сервера: {phases} (всего {self.elapsed_ms()} мс)"
@@ -0,0 +1,82 @@
+import io
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+
+# Модули backend'а импортируются по имени, как при запуске сервера из lib/backend
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Кэши на диске — во временной папке, экспорт — в пуле потоков (без spawn-процессов)
+_CACHE_ROOT = tempfile.mkdtemp(prefix='dicom-tests-')
+os.environ.setdefault('DICOM_DISK_CACHE_DIR', os.path.join(_CACHE_ROOT, 'pixel_cache'))
+os.environ.setdefault('DICOM_THUMBNAIL_DIR', os.path.join(_CACHE_ROOT, 'thumbnail_cache'))
+os.environ.setdefault('DICOM_EXPORT_WORKERS', '0')
+
+
+def make_dicom(rows=64, cols=64, dtype=np.int16, seed=0, sop_uid='auto', transfer_syntax=None,
+               frames=1, pixels=None, tags=None):
+    """Небольшой DICOM Part-10 (bytes) с шумовыми пикселями; sop_uid=None — без SOPInstanceUID.
+    tags — дополнительные атрибуты {keyword: value}."""
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    if pixels is None:
+        rng = np.random.default_rng(seed)
+        shape = (frames, rows, cols) if frames > 1 else (rows, cols)
+        pixels = rng.integers(0, 4096, size=shape).astype(dtype)
+    file_meta = FileMetaDataset()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+    uid = generate_uid() if sop_uid == 'auto' else sop_uid
+    file_meta.MediaStorageSOPInstanceUID = uid or generate_uid()
+    ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    if uid:
+        ds.SOPInstanceUID = uid
+    ds.Modality = 'CT'
+    ds.Rows, ds.Columns = pixels.shape[-2], pixels.shape[-1]
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = pixels.dtype.itemsize * 8
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 1 if np.issubdtype(pixels.dtype, np.signedinteger) else 0
+    ds.RescaleSlope, ds.RescaleIntercept = 1.0, -1024.0
+    ds.WindowCenter, ds.WindowWidth = 40, 400
+    ds.PixelSpacing = [0.5, 0.5]
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    for keyword, value in (tags or {}).items():
+        setattr(ds, keyword, value)
+    ds.PixelData = pixels.tobytes()
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    if transfer_syntax is not None:
+        ds.compress(transfer_syntax)
+    buf = io.BytesIO()
+    ds.save_as(buf, write_like_original=False)
+    return buf.getvalue()
+
+
+@pytest.fixture(scope='session')
+def backend():
+    import main
+    return main
+
+
+@pytest.fixture
+def client(backend):
+    from fastapi.testclient import TestClient
+    backend.dicom_cache.clear()
+    with TestClient(backend.app) as test_client:
+        yield test_client
+    backend.dicom_cache.clear()
+
+
+def upload(client, dicom_bytes, name='image.dcm'):
+    response = client.post('/process_dicom/', files={'file': (name, dicom_bytes, 'application/dicom')})
+    assert response.status_code == 200, response.text
+    return response.json()
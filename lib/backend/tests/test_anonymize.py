@@ -0,0 +1,217 @@
+import io
+import os
+import time
+
+import pydicom
+import pytest
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, generate_uid
+
+from anonymize import pseudonym, remap_uid, rewrite_file
+from conftest import make_dicom
+
+STUDY_UID = generate_uid()
+SERIES_UID = generate_uid()
+FRAME_OF_REFERENCE_UID = generate_uid()
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def ct_slice(seed=0, transfer_syntax=None, referenced_uid=None):
+    """Срез одной серии с PHI, приватным тегом и ссылками на экземпляры в последовательностях."""
+    reference = Dataset()
+    reference.ReferencedSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    reference.ReferencedSOPInstanceUID = referenced_uid or generate_uid()
+    reference.add_new(0x00091001, 'LO', 'private in sequence')
+    return make_dicom(seed=seed, transfer_syntax=transfer_syntax, tags={
+        'PatientName': 'Doe^John',
+        'PatientID': 'MRN-42',
+        'PatientBirthDate': '19700101',
+        'InstitutionName': 'General Hospital',
+        'StudyInstanceUID': STUDY_UID,
+        'SeriesInstanceUID': SERIES_UID,
+        'FrameOfReferenceUID': FRAME_OF_REFERENCE_UID,
+        'ReferencedImageSequence': [reference],
+    })
+
+
+def with_private_tag(data):
+    ds = pydicom.dcmread(io.BytesIO(data))
+    ds.add_new(0x00091010, 'LO', 'private at top level')
+    buf = io.BytesIO()
+    ds.save_as(buf, write_like_original=False)
+    return buf.getvalue()
+
+
+def structured_report():
+    """SR без PixelData: текст отчёта и наблюдатель в ContentSequence."""
+    file_meta = FileMetaDataset()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.88.11'
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'SR'
+    ds.PatientName = 'Doe^John'
+    ds.PatientID = 'MRN-42'
+    ds.StudyInstanceUID = STUDY_UID
+    ds.SeriesInstanceUID = generate_uid()
+    text = Dataset()
+    text.ValueType = 'TEXT'
+    text.TextValue = 'John Doe, no findings'
+    ds.ContentSequence = [text]
+    observer = Dataset()
+    observer.VerifyingObserverName = 'Smith^Jane'
+    ds.VerifyingObserverSequence = [observer]
+    predecessor = Dataset()
+    predecessor.StudyInstanceUID = STUDY_UID
+    predecessor.PersonName = 'Doe^John'
+    ds.PredecessorDocumentsSequence = [predecessor]
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    buf = io.BytesIO()
+    ds.save_as(buf, write_like_original=False)
+    return buf.getvalue()
+
+
+def test_basic_profile_removes_phi_and_private_tags(tmp_path):
+    source = write(tmp_path / 'in' / 'a.dcm', with_private_tag(ct_slice()))
+    destination = str(tmp_path / 'out' / 'a.dcm')
+    assert rewrite_file(source, destination, 'basic', salt='s1') is not None
+
+    ds = pydicom.dcmread(destination)
+    alias = pseudonym('s1', 'MRN-42')
+    assert str(ds.PatientName) == alias and ds.PatientID == alias
+    assert ds.PatientBirthDate == ''
+    assert 'InstitutionName' not in ds
+    assert ds.PatientIdentityRemoved == 'YES'
+    assert not any(elem.tag.is_private for elem in ds)
+    assert not any(elem.tag.is_private for elem in ds.ReferencedImageSequence[0])
+    assert ds.file_meta.MediaStorageSOPInstanceUID == ds.SOPInstanceUID
+
+
+def test_uids_are_remapped_consistently_across_files(tmp_path):
+    first = make_dicom(seed=1)
+    first_uid = pydicom.dcmread(io.BytesIO(first)).SOPInstanceUID
+    sources = [
+        write(tmp_path / 'in' / 'a.dcm', ct_slice(seed=1)),
+        write(tmp_path / 'in' / 'b.dcm', ct_slice(seed=2, referenced_uid=first_uid)),
+        write(tmp_path / 'in' / 'c.dcm', ct_slice(seed=3, referenced_uid=first_uid)),
+    ]
+    outputs = []
+    for i, source in enumerate(sources):
+        destination = str(tmp_path / 'out' / f'{i}.dcm')
+        rewrite_file(source, destination, 'basic', salt='s1')
+        outputs.append(pydicom.dcmread(destination))
+    a, b, c = outputs
+
+    for ds in outputs:
+        assert ds.StudyInstanceUID != STUDY_UID
+        assert ds.FrameOfReferenceUID != FRAME_OF_REFERENCE_UID
+    assert a.StudyInstanceUID == b.StudyInstanceUID == c.StudyInstanceUID
+    assert a.SeriesInstanceUID == b.SeriesInstanceUID == c.SeriesInstanceUID
+    assert a.FrameOfReferenceUID == b.FrameOfReferenceUID
+    assert len({ds.SOPInstanceUID for ds in outputs}) == 3
+    # Ссылка внутри последовательности заменена так же в разных файлах
+    b_ref = b.ReferencedImageSequence[0].ReferencedSOPInstanceUID
+    c_ref = c.ReferencedImageSequence[0].ReferencedSOPInstanceUID
+    assert b_ref == c_ref != first_uid
+    # Класс SOP — не UID экземпляра, он не меняется
+    assert b.ReferencedImageSequence[0].ReferencedSOPClassUID == '1.2.840.10008.5.1.4.1.1.2'
+
+    other_salt = str(tmp_path / 'out' / 'other.dcm')
+    rewrite_file(sources[1], other_salt, 'basic', salt='s2')
+    other = pydicom.dcmread(other_salt)
+    assert other.StudyInstanceUID != b.StudyInstanceUID
+    assert other.ReferencedImageSequence[0].ReferencedSOPInstanceUID != b_ref
+
+
+@pytest.mark.parametrize('transfer_syntax', [None, RLELossless])
+def test_pixel_data_and_transfer_syntax_unchanged(tmp_path, transfer_syntax):
+    source = write(tmp_path / 'in' / 'a.dcm', ct_slice(transfer_syntax=transfer_syntax))
+    destination = str(tmp_path / 'out' / 'a.dcm')
+    rewrite_file(source, destination, 'basic', tags={'SeriesDescription': 'anon'}, salt='s1')
+
+    original, rewritten = pydicom.dcmread(source), pydicom.dcmread(destination)
+    assert rewritten.file_meta.TransferSyntaxUID == original.file_meta.TransferSyntaxUID
+    assert rewritten.PixelData == original.PixelData
+    assert rewritten.SeriesDescription == 'anon'
+
+
+def test_profile_none_only_edits_tags(tmp_path):
+    source = write(tmp_path / 'in' / 'a.dcm', ct_slice())
+    destination = str(tmp_path / 'out' / 'a.dcm')
+    rewrite_file(source, destination, 'none', tags={'PatientName': 'Edited'})
+
+    original, rewritten = pydicom.dcmread(source), pydicom.dcmread(destination)
+    assert str(rewritten.PatientName) == 'Edited'
+    assert rewritten.SOPInstanceUID == original.SOPInstanceUID
+    assert rewritten.InstitutionName == 'General Hospital'
+
+
+def test_objects_without_pixels_are_rewritten(tmp_path):
+    source = write(tmp_path / 'in' / 'sr.dcm', structured_report())
+    destination = str(tmp_path / 'out' / 'sr.dcm')
+    assert rewrite_file(source, destination, 'basic', salt='s1') is not None
+
+    ds = pydicom.dcmread(destination)
+    assert ds.Modality == 'SR'
+    assert str(ds.PatientName) == pseudonym('s1', 'MRN-42')
+    assert 'ContentSequence' not in ds and 'VerifyingObserverSequence' not in ds
+    predecessor = ds.PredecessorDocumentsSequence[0]
+    assert str(predecessor.PersonName) == ''
+    assert predecessor.StudyInstanceUID == ds.StudyInstanceUID == remap_uid('s1', STUDY_UID)
+
+
+def test_non_dicom_file_is_skipped(tmp_path):
+    source = write(tmp_path / 'in' / 'notes.txt', b'not a dicom file\n' * 20)
+    destination = str(tmp_path / 'out' / 'notes.txt')
+    assert rewrite_file(source, destination, 'basic', salt='s1') is None
+    assert not os.path.exists(destination)
+
+
+def wait_for_job(client, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        report = client.get(f'/jobs/{job_id}').json()
+        if report['state'] != 'running' or time.monotonic() > deadline:
+            return report
+        time.sleep(0.05)
+
+
+def test_rewrite_folder_job(client, tmp_path):
+    source_root = tmp_path / 'study'
+    write(source_root / 'series' / 'a.dcm', ct_slice(seed=1))
+    write(source_root / 'series' / 'b.dcm', ct_slice(seed=2, transfer_syntax=RLELossless))
+    write(source_root / 'sr' / 'report.dcm', structured_report())
+    notes = write(source_root / 'notes.txt', b'not a dicom file\n' * 20)
+    output_root = tmp_path / 'anon'
+
+    response = client.post('/rewrite_folder/', json={
+        'path': str(source_root), 'output_path': str(output_root), 'salt': 's1',
+    })
+    assert response.status_code == 202
+    report = wait_for_job(client, response.json()['job_id'])
+
+    assert report['state'] == 'done'
+    assert (report['total'], report['written'], report['skipped'], report['failed']) == (4, 3, 1, 0)
+    assert report['skipped_files'] == [os.path.realpath(notes)]
+    for relative in ('series/a.dcm', 'series/b.dcm', 'sr/report.dcm'):
+        ds = pydicom.dcmread(str(output_root / relative))
+        assert str(ds.PatientName) == pseudonym('s1', 'MRN-42')
+
+
+def test_rewrite_folder_rejects_output_inside_source(client, tmp_path):
+    response = client.post('/rewrite_folder/', json={
+        'path': str(tmp_path), 'output_path': str(tmp_path / 'anon'),
+    })
+    assert response.status_code == 400
+    assert client.post('/rewrite_folder/', json={
+        'path': str(tmp_path), 'output_path': str(tmp_path.parent / 'anon'), 'profile': 'full',
+    }).status_code == 400
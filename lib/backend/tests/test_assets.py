@@ -0,0 +1,43 @@
+import ast
+import os
+import re
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PUBSPEC = os.path.join(BACKEND_DIR, '..', '..', 'pubspec.yaml')
+ASSET_LINE = re.compile(r'^\s+- lib/backend/(\S+)\s*$')
+
+
+def bundled_files():
+    with open(PUBSPEC, encoding='utf-8') as f:
+        return {match.group(1) for match in map(ASSET_LINE.match, f) if match}
+
+
+def local_imports(module):
+    """Модули backend'а, которые module импортирует (в том числе лениво внутри функций)."""
+    with open(os.path.join(BACKEND_DIR, module + '.py'), encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split('.')[0])
+    return {name for name in names if os.path.isfile(os.path.join(BACKEND_DIR, name + '.py'))}
+
+
+def runtime_modules():
+    seen, pending = set(), ['main']
+    while pending:
+        module = pending.pop()
+        if module not in seen:
+            seen.add(module)
+            pending.extend(local_imports(module))
+    return seen
+
+
+def test_bundle_has_only_runtime_files():
+    """pubspec.yaml поставляет модули, достижимые из main, и requirements.txt — и ничего больше."""
+    bundled = bundled_files()
+    assert bundled == {module + '.py' for module in runtime_modules()} | {'requirements.txt'}
+    for name in bundled:
+        assert os.path.isfile(os.path.join(BACKEND_DIR, name))
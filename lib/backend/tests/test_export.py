@@ -0,0 +1,178 @@
+import base64
+import io
+import json
+
+import numpy as np
+import pydicom
+import pytest
+from PIL import Image
+
+from conftest import make_dicom, upload
+
+METADATA = json.dumps({'report': 'No acute findings', 'tags': {'PatientName': 'Doe^Jane', 'StudyDescription': 'Head CT'}})
+
+
+def read_export(response):
+    assert response.status_code == 200, response.text
+    assert response.headers['content-type'] == 'application/dicom'
+    assert int(response.headers['content-length']) == len(response.content)
+    return pydicom.dcmread(io.BytesIO(response.content))
+
+
+def assert_metadata_applied(ds):
+    assert ds.ImageComments == 'No acute findings'
+    assert str(ds.PatientName) == 'Doe^Jane'
+    assert ds.StudyDescription == 'Head CT'
+
+
+def test_export_cached_image(client, backend):
+    dicom_bytes = make_dicom()
+    image_id = upload(client, dicom_bytes)['image_id']
+    ds = read_export(client.post('/export_dicom/', data={'image_id': image_id, 'metadata': METADATA}))
+    assert_metadata_applied(ds)
+    original = pydicom.dcmread(io.BytesIO(dicom_bytes))
+    assert np.array_equal(ds.pixel_array, original.pixel_array)
+    # Изменения вносятся в копию: набор данных в кэше остаётся прежним
+    assert 'ImageComments' not in backend.dicom_cache.get(image_id).dataset
+
+
+def test_export_uploaded_file(client):
+    ds = read_export(client.post('/export_dicom/', data={'metadata': METADATA},
+                                 files={'file': ('image.dcm', make_dicom(), 'application/dicom')}))
+    assert_metadata_applied(ds)
+
+
+def test_export_with_render(client):
+    image_id = upload(client, make_dicom())['image_id']
+    render = io.BytesIO()
+    Image.new('RGB', (20, 10), (255, 0, 0)).save(render, format='PNG')
+    ds = read_export(client.post('/export_dicom/', data={'image_id': image_id},
+                                 files={'render': ('render.png', render.getvalue(), 'image/png')}))
+    assert ds.PhotometricInterpretation == 'RGB'
+    assert (ds.Rows, ds.Columns) == (10, 20)
+    assert (ds.pixel_array == [255, 0, 0]).all()
+
+
+def test_export_json_format(client):
+    image_id = upload(client, make_dicom())['image_id']
+    response = client.post('/export_dicom/', data={'image_id': image_id, 'metadata': METADATA, 'format': 'json'})
+    assert response.status_code == 200, response.text
+    body = response.json()
+    dicom_bytes = base64.b64decode(body['dicom_base64'])
+    assert body['size'] == len(dicom_bytes)
+    assert_metadata_applied(pydicom.dcmread(io.BytesIO(dicom_bytes)))
+
+
+@pytest.mark.parametrize('data, status', [
+    ({'image_id': 'missing'}, 404),
+    ({}, 400),
+])
+def test_export_errors(client, data, status):
+    response = client.post('/export_dicom/', data=data)
+    assert response.status_code == status
+    assert response.json()['message']
+
+
+def test_export_unreadable_render(client):
+    image_id = upload(client, make_dicom())['image_id']
+    response = client.post('/export_dicom/', data={'image_id': image_id},
+                           files={'render': ('render.png', b'not an image', 'image/png')})
+    assert response.status_code == 500
+    assert response.json()['message']
+
+
+def parse_multipart(response):
+    """Части multipart/mixed ответа: [(заголовки, тело)] по Content-Length каждой части."""
+    boundary = response.headers['content-type'].split('boundary=', 1)[1].encode()
+    body, parts, position = response.content, [], 0
+    while True:
+        start = body.index(b'--' + boundary, position) + len(boundary) + 2
+        if body[start:start + 2] == b'--':
+            return parts
+        header_end = body.index(b'\r\n\r\n', start)
+        headers = dict(line.split(': ', 1) for line in body[start + 2:header_end].decode('utf-8').split('\r\n'))
+        length = int(headers['Content-Length'])
+        parts.append((headers, body[header_end + 4:header_end + 4 + length]))
+        position = header_end + 4 + length
+
+
+@pytest.fixture
+def batch(client, tmp_path):
+    """Элементы пакета: файл с диска, изображение из кэша, нечитаемый файл и опасные
+    или повторяющиеся имена; эталон — export_file для путей."""
+    from export import export_file
+
+    metadata = json.loads(METADATA)
+    paths = []
+    for seed in range(2):
+        path = tmp_path / f"source{seed}.dcm"
+        path.write_bytes(make_dicom(seed=seed))
+        paths.append(str(path))
+    broken = tmp_path / 'broken.dcm'
+    broken.write_bytes(b'not a dicom file')
+    image_id = upload(client, make_dicom(seed=5))['image_id']
+    items = [
+        {'path': paths[0], 'metadata': metadata, 'filename': '../../evil.dcm'},
+        {'path': paths[1], 'metadata': metadata, 'filename': 'a"b\r\nX-Injected: 1.dcm'},
+        {'image_id': image_id, 'metadata': metadata, 'filename': 'manifest.json'},
+        {'path': str(broken), 'filename': 'broken.dcm'},
+        {'path': paths[0], 'metadata': metadata, 'filename': 'EVIL.dcm'},
+    ]
+    expected_names = ['evil.dcm', 'a_b__X-Injected_ 1.dcm', 'manifest_1.json', 'broken.dcm', 'EVIL_1.dcm']
+    references = {'evil.dcm': export_file(paths[0], metadata)[1], 'a_b__X-Injected_ 1.dcm': export_file(paths[1], metadata)[1],
+                  'EVIL_1.dcm': export_file(paths[0], metadata)[1]}
+    return items, expected_names, references
+
+
+def test_export_batch_zip(client, batch):
+    import zipfile
+
+    items, expected_names, references = batch
+    response = client.post('/export_batch/', json={'items': items, 'format': 'zip'})
+    assert response.status_code == 200, response.text
+    assert response.headers['content-type'] == 'application/zip'
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    manifest = json.loads(archive.read('manifest.json'))
+    assert [entry['name'] for entry in manifest] == expected_names
+    assert 'error' in manifest[3] and 'bytes' not in manifest[3]
+    assert sorted(archive.namelist()) == sorted(set(expected_names) - {'broken.dcm'} | {'manifest.json'})
+    for name, data in references.items():
+        assert archive.read(name) == data
+    exported = pydicom.dcmread(io.BytesIO(archive.read('manifest_1.json')))
+    assert_metadata_applied(exported)
+    assert manifest[2]['bytes'] == archive.getinfo('manifest_1.json').file_size
+
+
+def test_export_batch_multipart_matches_zip(client, batch):
+    import zipfile
+
+    items, expected_names, references = batch
+    response = client.post('/export_batch/', json={'items': items, 'format': 'multipart'})
+    assert response.status_code == 200, response.text
+    parts = parse_multipart(response)
+    names = [headers['Content-Disposition'].split('filename="', 1)[1][:-1] for headers, _ in parts]
+    # manifest.json зарезервировано только в ZIP
+    assert names == expected_names[:2] + ['manifest.json'] + expected_names[3:]
+    assert all('X-Injected' not in headers for headers, _ in parts)
+    types = [headers['Content-Type'] for headers, _ in parts]
+    assert types == ['application/dicom'] * 3 + ['application/json', 'application/dicom']
+    error = json.loads(parts[3][1])
+    assert error['name'] == 'broken.dcm' and error['error']
+    payloads = dict(zip(names, (data for _, data in parts)))
+    for name, data in references.items():
+        assert payloads[name] == data
+    archive = zipfile.ZipFile(io.BytesIO(client.post('/export_batch/', json={'items': items}).content))
+    assert payloads['manifest.json'] == archive.read('manifest_1.json')
+
+
+@pytest.mark.parametrize('body, status', [
+    ({'items': [], 'format': 'zip'}, 400),
+    ({'items': [{'image_id': 'x'}], 'format': 'tar'}, 400),
+    ({'items': [{'filename': 'x.dcm'}]}, 400),
+    ({'items': [{'image_id': 'missing'}]}, 404),
+    ({'items': [{'path': '/nonexistent/file.dcm'}]}, 404),
+])
+def test_export_batch_validation(client, body, status):
+    response = client.post('/export_batch/', json=body)
+    assert response.status_code == status
+    assert response.json()['message']
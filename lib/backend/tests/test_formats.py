@@ -0,0 +1,80 @@
+import base64
+import io
+
+import numpy as np
+import pydicom
+import pytest
+from PIL import Image
+
+from conftest import make_dicom, upload
+from wl_engine import window_to_uint8
+
+ROWS, COLS = 48, 40
+
+
+@pytest.fixture
+def image(client):
+    dicom_bytes = make_dicom(rows=ROWS, cols=COLS)
+    ds = pydicom.dcmread(io.BytesIO(dicom_bytes))
+    values = ds.pixel_array.astype(np.float64) * float(ds.RescaleSlope) + float(ds.RescaleIntercept)
+    return upload(client, dicom_bytes)['image_id'], values
+
+
+def update_wl(client, image_id, fmt, **extra):
+    return client.post('/update_wl/', json=dict({'image_id': image_id, 'window_center': 40,
+                                                 'window_width': 400, 'format': fmt}, **extra))
+
+
+def test_raw_returns_shape_and_pixels(client, image):
+    image_id, values = image
+    response = update_wl(client, image_id, 'raw')
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/octet-stream'
+    assert (response.headers['x-image-width'], response.headers['x-image-height'],
+            response.headers['x-image-channels']) == (str(COLS), str(ROWS), '1')
+    assert len(response.content) == ROWS * COLS
+    pixels = np.frombuffer(response.content, dtype=np.uint8).reshape(ROWS, COLS)
+    assert np.array_equal(pixels, window_to_uint8(values, 40.0, 400.0))
+
+
+@pytest.mark.parametrize('fmt, media_type, pil_format', [
+    ('png', 'image/png', 'PNG'),
+    ('jpeg', 'image/jpeg', 'JPEG'),
+    ('webp', 'image/webp', 'WEBP'),
+])
+def test_binary_formats(client, image, fmt, media_type, pil_format):
+    image_id, values = image
+    response = update_wl(client, image_id, fmt, quality=95)
+    assert response.status_code == 200
+    assert response.headers['content-type'] == media_type
+    assert response.headers['x-image-width'] == str(COLS)
+    decoded = Image.open(io.BytesIO(response.content))
+    assert decoded.format == pil_format
+    assert decoded.size == (COLS, ROWS)
+    if fmt == 'png':
+        assert np.array_equal(np.array(decoded), window_to_uint8(values, 40.0, 400.0))
+
+
+def test_json_format_keeps_base64_png(client, image):
+    image_id, values = image
+    response = update_wl(client, image_id, 'json')
+    assert response.status_code == 200
+    png = Image.open(io.BytesIO(base64.b64decode(response.json()['image_base64'])))
+    assert np.array_equal(np.array(png), window_to_uint8(values, 40.0, 400.0))
+
+
+def test_unknown_format_is_rejected(client, image):
+    image_id, _ = image
+    response = update_wl(client, image_id, 'bmp')
+    assert response.status_code == 400
+    assert "Unsupported format 'bmp'" in response.json()['message']
+    response = client.post('/update_brightness/', params={'brightness': 1.2, 'image_id': image_id, 'format': 'gif'})
+    assert response.status_code == 400
+
+
+def test_brightness_raw(client, image):
+    image_id, values = image
+    response = client.post('/update_brightness/', params={'brightness': 1.0, 'image_id': image_id, 'format': 'raw'})
+    assert response.status_code == 200
+    assert np.array_equal(np.frombuffer(response.content, dtype=np.uint8).reshape(ROWS, COLS),
+                          window_to_uint8(values, 40.0, 400.0))
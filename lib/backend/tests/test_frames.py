@@ -0,0 +1,88 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.encaps import generate_pixel_data_frame
+from pydicom.uid import RLELossless
+
+from conftest import make_dicom, upload
+from frames import FrameSource, decode_frames
+from wl_engine import window_to_uint8
+
+FRAMES = 6
+
+
+@pytest.fixture(scope='module')
+def rle_cine():
+    dicom_bytes = make_dicom(rows=32, cols=40, frames=FRAMES, transfer_syntax=RLELossless, seed=7)
+    ds = pydicom.dcmread(io.BytesIO(dicom_bytes))
+    return dicom_bytes, ds, ds.pixel_array
+
+
+@pytest.mark.parametrize('workers', [0, 3])
+def test_decode_all_matches_pixel_array(rle_cine, workers):
+    _, ds, reference = rle_cine
+    source = FrameSource(ds)
+    assert source.is_encapsulated
+    executor = ThreadPoolExecutor(workers) if workers else None
+    try:
+        assert source.decode_all(executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    assert not source.is_encapsulated
+    for index in range(FRAMES):
+        assert np.array_equal(source.frame(index), reference[index])
+
+
+def test_decode_all_reuses_frames_decoded_on_demand(rle_cine):
+    _, ds, reference = rle_cine
+    source = FrameSource(ds)
+    assert np.array_equal(source.frame(FRAMES - 1), reference[FRAMES - 1])
+    assert np.array_equal(source.frame(2), reference[2])
+    source.decode_all()
+    for index in range(FRAMES):
+        assert np.array_equal(source.frame(index), reference[index])
+
+
+def test_decode_frames_with_known_frames(rle_cine):
+    _, ds, reference = rle_cine
+    source = FrameSource(ds)
+    fragments = list(generate_pixel_data_frame(ds.PixelData, FRAMES))
+    # Заведомо «неверный» известный кадр показывает, что он не декодируется повторно
+    known = {0: reference[0], 3: np.zeros_like(reference[3])}
+    out = decode_frames(ds.file_meta.TransferSyntaxUID, source._pixel_module, fragments, known=known)
+    assert out.shape == reference.shape
+    assert not out[3].any()
+    for index in (0, 1, 2, 4, 5):
+        assert np.array_equal(out[index], reference[index])
+
+
+def test_frame_index_out_of_range(rle_cine):
+    _, ds, _ = rle_cine
+    source = FrameSource(ds)
+    for index in (-1, FRAMES):
+        with pytest.raises(IndexError):
+            source.frame(index)
+
+
+def test_frame_endpoint_bounds(client, rle_cine):
+    dicom_bytes, ds, reference = rle_cine
+    image_id = upload(client, dicom_bytes)['image_id']
+    for index in (-1, FRAMES):
+        response = client.get(f'/frame/{index}', params={'image_id': image_id})
+        assert response.status_code == 400
+        assert response.json()['message'] == f"Frame {index} out of range (0..{FRAMES - 1})"
+
+    response = client.get(f'/frame/{FRAMES - 1}', params={'image_id': image_id, 'window_center': 40,
+                                                            'window_width': 400, 'format': 'raw'})
+    assert response.status_code == 200, response.text
+    values = reference[FRAMES - 1].astype(np.float64) * float(ds.RescaleSlope) + float(ds.RescaleIntercept)
+    assert response.content == window_to_uint8(values, 40.0, 400.0).tobytes()
+
+
+def test_frame_endpoint_unknown_image(client):
+    response = client.get('/frame/0', params={'image_id': 'missing'})
+    assert response.status_code == 404
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+from conftest import make_dicom, upload
+from image_cache import ImageCache
+
+
+def entry(image_id, nbytes):
+    return SimpleNamespace(image_id=image_id, nbytes=nbytes)
+
+
+def test_least_recently_used_evicted_over_budget():
+    cache = ImageCache(max_bytes=250)
+    for image_id in ('a', 'b'):
+        cache.put(entry(image_id, 100))
+    assert cache.get('a') is not None  # 'b' становится самым старым
+    cache.put(entry('c', 100))
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes'], stats['evictions']) == (2, 200, 1)
+
+
+def test_oversized_image_kept_as_only_entry():
+    cache = ImageCache(max_bytes=100)
+    cache.put(entry('a', 50))
+    cache.put(entry('big', 500))
+    assert len(cache) == 1 and 'big' in cache
+
+
+def test_get_without_id_returns_last_used():
+    cache = ImageCache(max_bytes=1000)
+    assert cache.get() is None
+    cache.put(entry('a', 10))
+    cache.put(entry('b', 10))
+    assert cache.get().image_id == 'b'
+    cache.get('a')
+    assert cache.get().image_id == 'a'
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (3, 1)
+
+
+def test_replacing_entry_updates_bytes():
+    cache = ImageCache(max_bytes=1000)
+    cache.put(entry('a', 100))
+    cache.put(entry('a', 300))
+    assert len(cache) == 1 and cache.stats()['bytes'] == 300
+
+
+def test_uploaded_images_rendered_by_id(client):
+    first = upload(client, make_dicom(seed=1))['image_id']
+    second = upload(client, make_dicom(seed=2))['image_id']
+    assert first != second
+
+    def render(image_id=None):
+        response = client.post('/update_wl/', json={'window_center': 40, 'window_width': 400, 'image_id': image_id})
+        assert response.status_code == 200
+        return response.json()['image_base64']
+
+    assert render(first) != render(second)
+    # Без image_id — последнее использованное изображение
+    assert render() == render(second)
+    assert client.get('/cache_stats/').json()['entries'] == 2
+
+
+def test_unknown_image_id_is_404(client):
+    upload(client, make_dicom())
+    response = client.post('/update_wl/', json={'window_center': 40, 'window_width': 400, 'image_id': 'missing'})
+    assert response.status_code == 404
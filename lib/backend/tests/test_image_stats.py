@@ -0,0 +1,108 @@
+import io
+
+import numpy as np
+import pydicom
+import pytest
+
+from conftest import make_dicom, upload
+from image_stats import (CT_PRESETS, FINE_HISTOGRAM_BINS, MAX_HISTOGRAM_BINS, PERCENTILES, auto_window,
+                         compute_stats, window_presets)
+
+# Нечётное число пикселей, не кратное 4 и 200: p * n / 100 ни для одного перцентиля
+# не целое, и «ближайший ранг» ImageStats совпадает с method='inverted_cdf'
+SHAPE = (61, 67)
+
+
+def rescaled(pixels, slope, intercept):
+    return pixels.astype(np.float64) * slope + intercept
+
+
+@pytest.mark.parametrize('dtype, low, high', [(np.int16, -2000, 3000), (np.uint16, 0, 4095), (np.uint8, 0, 255)])
+@pytest.mark.parametrize('slope, intercept', [(1.0, 0.0), (1.0, -1024.0), (0.25, 3.0), (-2.0, 100.0)])
+def test_integer_percentiles_match_numpy(dtype, low, high, slope, intercept):
+    pixels = np.random.default_rng(2).integers(low, high + 1, size=SHAPE).astype(dtype)
+    stats = compute_stats(pixels, slope, intercept)
+    values = rescaled(pixels, slope, intercept)
+    summary = stats.summary()
+    for p in PERCENTILES:
+        assert stats.percentile(p) == np.percentile(values, p, method='inverted_cdf'), p
+        assert summary['percentiles'][str(p)] == stats.percentile(p)
+    assert (summary['min'], summary['max'], summary['count']) == (values.min(), values.max(), values.size)
+    assert summary['mean'] == pytest.approx(values.mean())
+    assert summary['std'] == pytest.approx(values.std())
+    assert stats.stored_range == (int(pixels.min()), int(pixels.max()))
+
+
+@pytest.mark.parametrize('slope, intercept', [(1.0, 0.0), (2.0, -50.0)])
+def test_float_percentiles_within_one_bin(slope, intercept):
+    pixels = np.random.default_rng(3).normal(100.0, 40.0, size=SHAPE).astype(np.float32)
+    stats = compute_stats(pixels, slope, intercept)
+    values = rescaled(pixels, slope, intercept)
+    tolerance = (values.max() - values.min()) / FINE_HISTOGRAM_BINS
+    for p in PERCENTILES:
+        assert abs(stats.percentile(p) - np.percentile(values, p, method='inverted_cdf')) <= tolerance, p
+    assert (stats.min, stats.max) == pytest.approx((values.min(), values.max()))
+
+
+def test_auto_window_is_1_99_percentile():
+    pixels = np.random.default_rng(4).integers(0, 4096, size=SHAPE).astype(np.uint16)
+    values = rescaled(pixels, 1.0, -1024.0)
+    low, high = np.percentile(values, [1, 99], method='inverted_cdf')
+    assert auto_window(compute_stats(pixels, 1.0, -1024.0)) == ((low + high) / 2.0, high - low)
+    # Однородное изображение: ширина окна не меньше 1
+    assert auto_window(compute_stats(np.full(SHAPE, 7, dtype=np.int16))) == (7.0, 1.0)
+
+
+def test_histogram_rebins_counts():
+    pixels = np.random.default_rng(5).integers(0, 1000, size=SHAPE).astype(np.int16)
+    histogram = compute_stats(pixels).histogram(32)
+    expected, _ = np.histogram(pixels, bins=32, range=(pixels.min(), pixels.max()))
+    assert histogram['counts'] == expected.tolist()
+
+
+def test_window_presets():
+    stats = compute_stats(np.arange(-1000, 1000, dtype=np.int16).reshape(40, 50))
+    ct = window_presets(stats, 'CT', (40.0, 400.0))
+    assert [p['id'] for p in ct] == ['header', 'full_range', 'p1_p99', 'p5_p95'] + [p[0] for p in CT_PRESETS]
+    assert ct[0]['window_center'] == 40.0 and ct[0]['window_width'] == 400.0
+    assert ct[1]['window_center'] == stats.min / 2 + stats.max / 2
+    assert [p['id'] for p in window_presets(stats, 'MR')] == ['full_range', 'p1_p99', 'p5_p95']
+
+
+def without_header_window(dicom_bytes):
+    ds = pydicom.dcmread(io.BytesIO(dicom_bytes))
+    del ds.WindowCenter, ds.WindowWidth
+    buf = io.BytesIO()
+    ds.save_as(buf)
+    return buf.getvalue()
+
+
+def test_initial_window_and_image_stats_endpoint(client):
+    dicom_bytes = make_dicom(rows=SHAPE[0], cols=SHAPE[1])
+    values = rescaled(pydicom.dcmread(io.BytesIO(dicom_bytes)).pixel_array, 1.0, -1024.0)
+    low, high = np.percentile(values, [1, 99], method='inverted_cdf')
+
+    with_header = upload(client, dicom_bytes)
+    assert (with_header['window_center'], with_header['window_width']) == (40, 400)
+    auto = upload(client, without_header_window(dicom_bytes))
+    assert (auto['window_center'], auto['window_width']) == ((low + high) / 2.0, high - low)
+    assert 'header' not in [p['id'] for p in auto['window_presets']]
+
+    response = client.get('/image_stats/', params={'image_id': auto['image_id'], 'bins': 64})
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert body['modality'] == 'CT'
+    assert body['statistics']['percentiles']['1'] == low
+    assert body['statistics']['percentiles']['99'] == high
+    assert sum(body['histogram']['counts']) == values.size and len(body['histogram']['counts']) == 64
+    assert body['presets'] == auto['window_presets']
+
+
+@pytest.mark.parametrize('bins', [0, MAX_HISTOGRAM_BINS + 1])
+def test_image_stats_rejects_bins(client, bins):
+    image_id = upload(client, make_dicom())['image_id']
+    assert client.get('/image_stats/', params={'image_id': image_id, 'bins': bins}).status_code == 400
+
+
+def test_image_stats_unknown_image(client):
+    assert client.get('/image_stats/', params={'image_id': 'missing'}).status_code == 404
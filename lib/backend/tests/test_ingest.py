@@ -0,0 +1,14 @@
+from conftest import make_dicom, upload
+
+
+def test_sopless_uploads_get_distinct_ids(client, backend):
+    # Небольшие загрузки Starlette держит в памяти: handle считается по их байтам
+    first = upload(client, make_dicom(sop_uid=None, seed=1))
+    second = upload(client, make_dicom(sop_uid=None, seed=2))
+    assert first['image_id'] != second['image_id']
+    assert backend.dicom_cache.get(first['image_id']) is not backend.dicom_cache.get(second['image_id'])
+
+
+def test_same_bytes_get_same_id(client):
+    dicom_bytes = make_dicom(sop_uid=None, seed=3)
+    assert upload(client, dicom_bytes)['image_id'] == upload(client, dicom_bytes)['image_id']
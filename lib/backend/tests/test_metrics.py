@@ -0,0 +1,86 @@
+import re
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import make_dicom
+from metrics import MetricsRegistry, TimingMiddleware, server_timing_from_env
+
+
+def metric_value(text, name, **labels):
+    """Значение строки метрики name{labels} из текста /metrics (None, если строки нет)."""
+    selector = ','.join(f'{key}="{value}"' for key, value in labels.items())
+    line = f'{name}{{{selector}}}' if labels else name
+    for row in text.splitlines():
+        if row.startswith(line + ' '):
+            return float(row.rsplit(' ', 1)[1])
+    return None
+
+
+@pytest.mark.parametrize('value, enabled', [(None, False), ('0', False), ('1', True), ('true', True),
+                                            ('YES', True), ('off', False)])
+def test_server_timing_from_env(monkeypatch, value, enabled):
+    if value is None:
+        monkeypatch.delenv('DICOM_SERVER_TIMING', raising=False)
+    else:
+        monkeypatch.setenv('DICOM_SERVER_TIMING', value)
+    assert server_timing_from_env() is enabled
+
+
+def timing_middleware(app):
+    """Экземпляр TimingMiddleware в собранном стеке приложения."""
+    layer = app.middleware_stack
+    while not isinstance(layer, TimingMiddleware):
+        layer = layer.app
+    return layer
+
+
+@pytest.mark.parametrize('server_timing', [False, True])
+def test_request_metrics_and_server_timing(backend, monkeypatch, server_timing):
+    with TestClient(backend.app) as client:
+        # Флаг берётся из DICOM_SERVER_TIMING при сборке приложения; в тестах он выключен
+        middleware = timing_middleware(backend.app)
+        assert middleware.server_timing is False
+        monkeypatch.setattr(middleware, 'server_timing', server_timing)
+        before = client.get('/metrics').text
+        dicom_bytes = make_dicom()
+        response = client.post('/process_dicom/', files={'file': ('image.dcm', dicom_bytes, 'application/dicom')})
+        assert response.status_code == 200
+        after = client.get('/metrics').text
+    backend.dicom_cache.clear()
+
+    header = response.headers.get('server-timing')
+    if server_timing:
+        stages = dict(re.findall(r'(\w+);dur=([\d.]+)', header))
+        assert {'dcmread', 'histogram', 'voi', 'png_encode', 'total'} <= set(stages)
+        assert f'upload_bytes;desc="{len(dicom_bytes)}"' in header
+    else:
+        assert header is None
+
+    def delta(name, **labels):
+        return (metric_value(after, name, **labels) or 0) - (metric_value(before, name, **labels) or 0)
+
+    assert delta('dicom_requests_total', endpoint='process_dicom_file', status='200') == 1
+    assert delta('dicom_request_seconds_count', endpoint='process_dicom_file') == 1
+    assert delta('dicom_request_seconds_bucket', endpoint='process_dicom_file', le='+Inf') == 1
+    assert delta('dicom_stage_seconds_count', stage='dcmread') >= 1
+    assert delta('dicom_bytes_total', kind='upload') == len(dicom_bytes)
+    assert '# TYPE dicom_stage_seconds histogram' in after
+    assert '# TYPE dicom_requests_total counter' in after
+    assert metric_value(after, 'dicom_image_cache_entries') >= 1
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    for seconds in (0.0005, 0.003, 0.003, 20.0):
+        registry.observe_stage('decode', seconds)
+    registry.count_bytes('png', 10)
+    text = registry.render({'dicom_ready': 1, 'dicom_disk_cache_hits_total': 3, 'skipped': None})
+    assert metric_value(text, 'dicom_stage_seconds_bucket', stage='decode', le='0.001') == 1
+    assert metric_value(text, 'dicom_stage_seconds_bucket', stage='decode', le='0.005') == 3
+    assert metric_value(text, 'dicom_stage_seconds_bucket', stage='decode', le='10.0') == 3
+    assert metric_value(text, 'dicom_stage_seconds_bucket', stage='decode', le='+Inf') == 4
+    assert metric_value(text, 'dicom_stage_seconds_sum', stage='decode') == pytest.approx(20.0065)
+    assert metric_value(text, 'dicom_bytes_total', kind='png') == 10
+    assert '# TYPE dicom_ready gauge' in text and '# TYPE dicom_disk_cache_hits_total counter' in text
+    assert 'skipped' not in text
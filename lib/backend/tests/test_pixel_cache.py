@@ -0,0 +1,125 @@
+import io
+import json
+import os
+import time
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.uid import RLELossless
+
+import pixel_cache
+from conftest import make_dicom, upload
+from pixel_cache import DiskPixelCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DiskPixelCache(root=str(tmp_path), max_bytes=64 * 1024 * 1024)
+
+
+def test_round_trip(cache):
+    pixels = np.arange(64 * 48, dtype=np.int16).reshape(64, 48)
+    key = cache.key('1.2.3', 'abc')
+    cache.put(key, pixels, {"sop_instance_uid": '1.2.3'})
+    cached = cache.get(key)
+    assert isinstance(cached, np.memmap)
+    np.testing.assert_array_equal(cached, pixels)
+    assert cache.stats()['hits'] == 1 and cache.stats()['writes'] == 1
+
+
+def test_key_depends_on_content(cache):
+    cache.put(cache.key('1.2.3', 'abc'), np.zeros((4, 4), np.uint16))
+    assert cache.get(cache.key('1.2.3', 'def')) is None
+
+
+def test_corrupt_entry_is_removed(cache):
+    key = cache.key('1.2.3', 'abc')
+    cache.put(key, np.ones((32, 32), np.uint16))
+    data_path, meta_path = cache._paths(key)
+    with open(meta_path, encoding='utf-8') as f:
+        meta = json.load(f)
+    meta['crc32'] ^= 1
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    assert cache.get(key) is None
+    assert cache.stats()['corrupt'] == 1
+    assert not os.path.exists(data_path) and not os.path.exists(meta_path)
+
+
+def test_least_recently_used_evicted_over_budget(tmp_path):
+    cache = DiskPixelCache(root=str(tmp_path), max_bytes=1024 * 1024)
+    keys = [cache.key(str(i), 'x') for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, np.zeros((256, 512), np.uint16))
+        os.utime(cache._paths(key)[1], (time.time() - 100 + i, time.time() - 100 + i))
+    cache.max_bytes = 600 * 1024
+    cache.evict()
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[1]) is not None and cache.get(keys[2]) is not None
+
+
+def test_compressed_upload_served_from_disk(client, backend):
+    dicom_bytes = make_dicom(seed=3, transfer_syntax=RLELossless)
+    first = upload(client, dicom_bytes)
+    # Запись на диск идёт в фоне
+    deadline = time.monotonic() + 5.0
+    while backend.pixel_cache.stats()['writes'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    hits = backend.pixel_cache.stats()['hits']
+    backend.dicom_cache.clear()
+    assert upload(client, dicom_bytes)['image_id'] == first['image_id']
+    assert backend.pixel_cache.stats()['hits'] == hits + 1
+
+
+def test_checksum_verified_once_per_entry(cache, monkeypatch):
+    key = cache.key('1.2.3', 'abc')
+    cache.put(key, np.ones((32, 32), np.uint16))
+    calls = []
+    original = pixel_cache._crc32
+    monkeypatch.setattr(pixel_cache, '_crc32', lambda array: calls.append(1) or original(array))
+    for _ in range(3):
+        assert cache.get(key) is not None
+    assert len(calls) == 1
+
+
+def test_evict_counts_only_removed_entries(tmp_path, monkeypatch):
+    cache = DiskPixelCache(root=str(tmp_path), max_bytes=1024 * 1024)
+    keys = [cache.key(str(i), 'x') for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, np.zeros((256, 512), np.uint16))
+        os.utime(cache._paths(key)[1], (time.time() - 100 + i, time.time() - 100 + i))
+    locked = cache._paths(keys[0])[0]
+    real_remove = os.remove
+
+    def remove(path):
+        # Как на Windows: отображённый в память .npy удалить нельзя
+        if path == locked:
+            raise PermissionError(path)
+        real_remove(path)
+
+    monkeypatch.setattr(pixel_cache.os, 'remove', remove)
+    cache.max_bytes = 300 * 1024
+    cache.evict()
+    stats = cache.stats()
+    assert os.path.exists(locked)
+    assert stats['evictions'] == 2
+    assert stats['bytes'] > 0
+
+
+def test_changed_pixels_under_same_sop_uid_are_not_served_from_disk(client, backend):
+    sop_uid = '1.2.826.0.1.3680043.8.498.1'
+    first = make_dicom(sop_uid=sop_uid, seed=1, transfer_syntax=RLELossless)
+    second = make_dicom(sop_uid=sop_uid, seed=2, transfer_syntax=RLELossless)
+    writes = backend.pixel_cache.stats()['writes']
+    image_id = upload(client, first)['image_id']
+    deadline = time.time() + 10
+    while backend.pixel_cache.stats()['writes'] == writes and time.time() < deadline:
+        time.sleep(0.01)
+    first_pixels = np.array(backend.dicom_cache.get(image_id).pixels)
+
+    assert upload(client, second)['image_id'] == image_id
+    second_pixels = np.array(backend.dicom_cache.get(image_id).pixels)
+    assert not np.array_equal(first_pixels, second_pixels)
+    expected = pydicom.dcmread(io.BytesIO(second)).pixel_array
+    np.testing.assert_array_equal(second_pixels, expected)
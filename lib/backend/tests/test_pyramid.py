@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from pyramid import TILE_SIZE, build_pyramid, downsample, pyramid_shapes
+
+
+def block_mean(pixels):
+    """Эталон: среднее блоков 2x2 в float64, нечётный край дублируется."""
+    padded = pixels.astype(np.float64)
+    if padded.shape[0] % 2:
+        padded = np.concatenate([padded, padded[-1:]], axis=0)
+    if padded.shape[1] % 2:
+        padded = np.concatenate([padded, padded[:, -1:]], axis=1)
+    rows, cols = padded.shape[0] // 2, padded.shape[1] // 2
+    return padded.reshape(rows, 2, cols, 2).mean(axis=(1, 3))
+
+
+@pytest.mark.parametrize('shape', [(64, 64), (65, 63), (1, 7), (1100, 9)])
+@pytest.mark.parametrize('dtype', [np.int16, np.uint16, np.uint8, np.float32])
+def test_downsample_matches_block_mean(shape, dtype):
+    rng = np.random.default_rng(5)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        pixels = rng.integers(max(info.min, -2000), min(info.max, 4000) + 1, size=shape).astype(dtype)
+    else:
+        pixels = rng.uniform(-1000, 1000, size=shape).astype(dtype)
+    result = downsample(pixels)
+    expected = block_mean(pixels)
+    assert result.dtype == pixels.dtype
+    assert result.shape == expected.shape
+    if np.issubdtype(dtype, np.integer):
+        assert np.abs(result.astype(np.float64) - expected).max() <= 0.5
+    else:
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-3)
+
+
+def test_pyramid_shapes_halve_to_tile_size():
+    shapes = pyramid_shapes((3000, 1001))
+    assert shapes[0] == (3000, 1001)
+    for previous, current in zip(shapes, shapes[1:]):
+        assert current == ((previous[0] + 1) // 2, (previous[1] + 1) // 2)
+    assert max(shapes[-1]) <= TILE_SIZE < max(shapes[-2])
+    assert pyramid_shapes((TILE_SIZE, 10)) == [(TILE_SIZE, 10)]
+
+
+def test_build_pyramid_levels_follow_shapes():
+    pixels = np.arange(600 * 300, dtype=np.int16).reshape(600, 300) % 4096
+    levels = build_pyramid(pixels)
+    assert levels[0] is pixels
+    assert [level.shape for level in levels] == pyramid_shapes(pixels.shape)
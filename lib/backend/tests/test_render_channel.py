@@ -0,0 +1,108 @@
+import asyncio
+import json
+import time
+
+from conftest import make_dicom, upload
+from workers import LatestSlot
+
+
+def receive_all(ws, count_frames):
+    """Сообщения канала до count_frames-го кадра: ошибки и заголовки (бинарные части пропускаются)."""
+    messages = []
+    frames = 0
+    while frames < count_frames:
+        message = json.loads(ws.receive_text())
+        messages.append(message)
+        if 'error' not in message:
+            ws.receive_bytes()
+            frames += 1
+    return messages
+
+
+def test_latest_slot_keeps_newest_value():
+    async def scenario():
+        slot = LatestSlot()
+        for value in (1, 2, 3):
+            slot.put(value)
+        assert await slot.get() == 3
+        assert slot.coalesced == 2
+        slot.close()
+        return await slot.get()
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_raw_frame_matches_update_wl(client):
+    image_id = upload(client, make_dicom())['image_id']
+    request = {'window_center': 40, 'window_width': 400, 'image_id': image_id, 'format': 'raw'}
+    with client.websocket_connect('/ws/render/') as ws:
+        ws.send_text(json.dumps(dict(request, seq=1)))
+        header = json.loads(ws.receive_text())
+        content = ws.receive_bytes()
+    assert header['seq'] == 1 and header['image_id'] == image_id and header['format'] == 'raw'
+    assert (header['width'], header['height'], header['channels']) == (64, 64, 1)
+    assert content == client.post('/update_wl/', json=request).content
+
+
+def test_png_is_default_format(client):
+    image_id = upload(client, make_dicom())['image_id']
+    with client.websocket_connect('/ws/render/') as ws:
+        ws.send_text(json.dumps({'window_center': 40, 'window_width': 400, 'image_id': image_id}))
+        header = json.loads(ws.receive_text())
+        content = ws.receive_bytes()
+    assert header['format'] == 'png' and header['seq'] is None
+    assert content.startswith(b'\x89PNG\r\n\x1a\n')
+
+
+def test_every_step_rendered_or_coalesced(client):
+    image_id = upload(client, make_dicom())['image_id']
+    with client.websocket_connect('/ws/render/') as ws:
+        for seq in range(1, 6):
+            ws.send_text(json.dumps({'window_center': 40 + seq, 'window_width': 400, 'image_id': image_id,
+                                     'seq': seq, 'format': 'raw'}))
+        headers = []
+        while not headers or headers[-1]['seq'] != 5:
+            headers.extend(receive_all(ws, 1))
+    seqs = [header['seq'] for header in headers]
+    assert seqs == sorted(seqs)
+    assert len(headers) + sum(header['coalesced'] for header in headers) == 5
+
+
+def test_errors_are_not_coalesced_away(client):
+    image_id = upload(client, make_dicom())['image_id']
+    with client.websocket_connect('/ws/render/?session_id=test') as ws:
+        ws.send_text(json.dumps({'window_center': 40, 'window_width': 400, 'image_id': image_id, 'seq': 1,
+                                 'format': 'bogus'}))
+        ws.send_text(json.dumps({'window_center': 40, 'window_width': 400, 'image_id': 'missing', 'seq': 2}))
+        ws.send_text('not json')
+        ws.send_text(json.dumps({'window_center': 'x', 'seq': 4}))
+        ws.send_text(json.dumps({'window_center': 40, 'window_width': 400, 'image_id': image_id, 'seq': 5}))
+        messages = receive_all(ws, 1)
+    errors = {m['seq']: m for m in messages if 'error' in m}
+    assert set(errors) == {1, 2, None, 4}
+    assert errors[2]['image_id'] == 'missing'
+    assert [m['seq'] for m in messages if 'error' not in m] == [5]
+
+
+def test_frame_error_tagged_with_request(client):
+    image_id = upload(client, make_dicom())['image_id']
+    with client.websocket_connect('/ws/render/') as ws:
+        ws.send_text(json.dumps({'window_center': 40, 'window_width': 400, 'image_id': image_id, 'seq': 7,
+                                 'frame': 3}))
+        message = json.loads(ws.receive_text())
+    assert message['seq'] == 7 and message['image_id'] == image_id and 'out of range' in message['error']
+
+
+def test_channel_keys_released_on_close(client, backend):
+    image_id = upload(client, make_dicom())['image_id']
+    before = len(backend.wl_requests)
+    for _ in range(3):
+        # Без session_id каждое соединение получает свою сессию
+        with client.websocket_connect('/ws/render/') as ws:
+            ws.send_text(json.dumps({'window_center': 40, 'window_width': 400, 'image_id': image_id, 'seq': 1}))
+            receive_all(ws, 1)
+    # Обработчик канала завершается в event loop клиента уже после выхода из with
+    deadline = time.monotonic() + 5.0
+    while len(backend.wl_requests) != before and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(backend.wl_requests) == before
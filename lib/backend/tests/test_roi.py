@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from conftest import make_dicom, upload
+from roi import SummedAreaTable, ellipse_mask, roi_stats
+
+
+def naive_stats(pixels, mask):
+    selected = pixels.astype(np.float64)[mask]
+    return selected.mean(), selected.std(), selected.min(), selected.max()
+
+
+@pytest.mark.parametrize('dtype, low, high', [
+    (np.int16, -1024, 3071),
+    (np.uint16, 0, 65535),
+    (np.uint8, 0, 255),
+    (np.float32, -100.0, 100.0),
+])
+@pytest.mark.parametrize('shape', ['rectangle', 'ellipse'])
+@pytest.mark.parametrize('roi', [(0, 0, 70, 50), (10.5, 7.25, 33.0, 21.5), (40, 25, 60, 50)])
+def test_roi_stats_match_numpy(dtype, low, high, shape, roi):
+    rng = np.random.default_rng(3)
+    if np.issubdtype(dtype, np.integer):
+        pixels = rng.integers(low, high + 1, size=(50, 70)).astype(dtype)
+    else:
+        pixels = rng.uniform(low, high, size=(50, 70)).astype(dtype)
+    table = SummedAreaTable(pixels)
+    x, y, width, height = roi
+    result = roi_stats(pixels, table, shape, x, y, width, height, slope=2.0, intercept=-5.0)
+
+    bounds = result['bounds']
+    top, left = bounds['y'], bounds['x']
+    bottom, right = top + bounds['height'], left + bounds['width']
+    mask = np.zeros(pixels.shape, dtype=bool)
+    if shape == 'rectangle':
+        mask[top:bottom, left:right] = True
+    else:
+        mask[top:bottom, left:right] = ellipse_mask(x, y, width, height, top, left, bottom, right)
+    mean, std, low_value, high_value = naive_stats(pixels, mask)
+
+    assert result['pixels'] == int(mask.sum())
+    assert result['mean'] == pytest.approx(mean * 2.0 - 5.0, rel=1e-9, abs=1e-6)
+    assert result['std'] == pytest.approx(std * 2.0, rel=1e-6, abs=1e-6)
+    assert result['min'] == pytest.approx(low_value * 2.0 - 5.0)
+    assert result['max'] == pytest.approx(high_value * 2.0 - 5.0)
+
+
+def test_roi_outside_image_is_rejected():
+    pixels = np.zeros((10, 10), dtype=np.int16)
+    with pytest.raises(ValueError):
+        roi_stats(pixels, SummedAreaTable(pixels), 'rectangle', 20, 20, 5, 5)
+
+
+def test_roi_endpoint(client):
+    image_id = upload(client, make_dicom())['image_id']
+    response = client.post('/roi_stats/', json={'image_id': image_id, 'shape': 'rectangle',
+                                                'x': 8, 'y': 4, 'width': 16, 'height': 10})
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert body['image_id'] == image_id
+    assert body['pixels'] == 160
+    assert body['area_mm2'] == pytest.approx(160 * 0.25)
+
+
+@pytest.mark.parametrize('payload', [
+    {'shape': 'polygon', 'x': 0, 'y': 0, 'width': 4, 'height': 4},
+    {'shape': 'rectangle', 'x': 100, 'y': 100, 'width': 4, 'height': 4},
+    {'shape': 'rectangle', 'x': 0, 'y': 0, 'width': 4, 'height': 4, 'frame': 1},
+])
+def test_roi_endpoint_rejects_bad_requests(client, payload):
+    image_id = upload(client, make_dicom())['image_id']
+    response = client.post('/roi_stats/', json=dict(payload, image_id=image_id))
+    assert response.status_code == 400
+    assert response.json()['message']
+
+
+def test_roi_endpoint_unknown_image(client):
+    response = client.post('/roi_stats/', json={'image_id': 'missing', 'x': 0, 'y': 0, 'width': 4, 'height': 4})
+    assert response.status_code == 404
@@ -0,0 +1,101 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import make_dicom
+from series_index import SeriesIndex, read_header, sort_instances
+
+STUDY = '1.2.826.0.1.3680043.2.1125.1'
+AXIAL = [1, 0, 0, 0, 1, 0]
+SAGITTAL = [0, 1, 0, 0, 0, -1]
+
+
+def write_instance(path, series_uid, number=None, position=None, orientation=None, series_number='1'):
+    tags = {'StudyInstanceUID': STUDY, 'SeriesInstanceUID': series_uid, 'SeriesNumber': series_number}
+    if number is not None:
+        tags['InstanceNumber'] = number
+    if position is not None:
+        tags['ImagePositionPatient'] = position
+    if orientation is not None:
+        tags['ImageOrientationPatient'] = orientation
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(make_dicom(rows=8, cols=8, tags=tags))
+    return str(path)
+
+
+@pytest.fixture
+def series_folder(tmp_path):
+    """Две серии одного исследования в перемешанных именах файлов и подпапках плюс
+    файлы, которые не должны попасть в индекс."""
+    rng = random.Random(4)
+    names = [f"IM{n:04d}" for n in rng.sample(range(1000), 14)]
+    expected = {'1.1': [], '1.2': []}
+    # Аксиальная серия: InstanceNumber идут против положения — решает положение
+    for index, z in enumerate(rng.sample(range(8), 8)):
+        path = tmp_path / ('a' if index % 2 else 'b') / names.pop()
+        expected['1.1'].append((z * 2.5, write_instance(path, '1.1', number=20 - z, position=[0, 0, z * 2.5],
+                                                        orientation=AXIAL)))
+    # Сагиттальная серия: нормаль к плоскости (-1, 0, 0), срезы смещаются по x
+    for x in rng.sample(range(6), 6):
+        path = tmp_path / names.pop()
+        expected['1.2'].append((float(x), write_instance(path, '1.2', number=x, position=[x * -1.0, 5, 5],
+                                                         orientation=SAGITTAL, series_number='2')))
+    (tmp_path / 'notes.txt').write_text('not dicom')
+    (tmp_path / 'DICOMDIR').write_bytes(b'\0' * 256)
+    return tmp_path, {uid: [path for _, path in sorted(items)] for uid, items in expected.items()}
+
+
+@pytest.mark.parametrize('workers', [0, 4])
+def test_index_groups_and_sorts_series(series_folder, workers):
+    root, expected = series_folder
+    index = SeriesIndex()
+    executor = ThreadPoolExecutor(workers) if workers else None
+    result = index.index_directory(str(root), executor)
+    assert result['files_scanned'] == 16
+    assert result['dicom_files'] == 14
+    [study] = result['studies']
+    assert study['study_instance_uid'] == STUDY
+    assert [s['series_instance_uid'] for s in study['series']] == ['1.1', '1.2']
+    for uid, paths in expected.items():
+        assert [r['path'] for r in index.instances(uid)] == paths
+    positions = [i['slice_position'] for i in study['series'][0]['instances']]
+    assert positions == sorted(positions)
+
+
+def test_non_recursive_index_skips_subfolders(series_folder):
+    root, expected = series_folder
+    result = SeriesIndex().index_directory(str(root), recursive=False)
+    assert result['dicom_files'] == len(expected['1.2'])
+
+
+def test_sort_fallbacks(tmp_path):
+    records = [read_header(write_instance(tmp_path / name, '9', number=number, position=position,
+                                          orientation=AXIAL if position else None))
+               for name, number, position in [
+                   ('e', None, None), ('d', None, None),  # ни положения, ни номера — по пути
+                   ('c', 2, None), ('b', 1, None),        # только номер
+                   ('a', 7, [0, 0, 3.0]), ('f', 5, [0, 0, -1.0]),
+               ]]
+    ordered = [r['path'].rsplit('/', 1)[-1] for r in sort_instances(records)]
+    # Срезы с положением — первыми, затем по InstanceNumber, затем по пути
+    assert ordered == ['f', 'a', 'b', 'c', 'd', 'e']
+
+
+def test_instance_numbers_without_orientation(tmp_path):
+    records = [read_header(write_instance(tmp_path / f"{n}", '9', number=number, position=[0, 0, n]))
+               for n, number in enumerate([3, 1, 2])]
+    assert [r['instance_number'] for r in sort_instances(records)] == [1, 2, 3]
+
+
+def test_index_folder_endpoint(client, series_folder):
+    root, expected = series_folder
+    response = client.post('/index_folder/', json={'path': str(root)})
+    assert response.status_code == 200, response.text
+    assert response.json()['dicom_files'] == 14
+    last = len(expected['1.1']) - 1
+    response = client.get(f'/series/1.1/{last}')
+    assert response.status_code == 200, response.text
+    assert response.json()['index'] == last and response.json()['series_length'] == len(expected['1.1'])
+    assert client.get('/series/1.1/99').status_code == 404
+    assert client.post('/index_folder/', json={'path': str(root / 'notes.txt')}).status_code == 400
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from pydicom.multival import MultiValue
+from pydicom.valuerep import DSfloat
+
+from dicom_io import first_float
+from settings import int_from_env
+
+
+@pytest.mark.parametrize('value, minimum, expected', [
+    (None, None, 7),
+    ('12', None, 12),
+    ('not a number', None, 7),
+    ('-3', 0, 0),
+    ('-3', None, -3),
+])
+def test_int_from_env(monkeypatch, value, minimum, expected):
+    if value is None:
+        monkeypatch.delenv('DICOM_TEST_VALUE', raising=False)
+    else:
+        monkeypatch.setenv('DICOM_TEST_VALUE', value)
+    assert int_from_env('DICOM_TEST_VALUE', 7, minimum=minimum) == expected
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, None),
+    ('40', 40.0),
+    (DSfloat('-600.5'), -600.5),
+    (MultiValue(DSfloat, ['40', '400']), 40.0),
+    ([1.5, 2.5], 1.5),
+    ([], None),
+    ('abc', None),
+    (np.float32(3.0), 3.0),
+])
+def test_first_float(value, expected):
+    assert first_float(value, None) == expected
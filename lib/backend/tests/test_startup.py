@@ -0,0 +1,43 @@
+import threading
+import time
+
+from fastapi.testclient import TestClient
+
+
+def wait_for_state(client, state, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        body = client.get('/').json()
+        if body['state'] == state or time.monotonic() > deadline:
+            return body
+        time.sleep(0.01)
+
+
+def test_health_reports_warming_until_warm_up_finishes(backend, monkeypatch):
+    release = threading.Event()
+    warm_up = backend.warm_up
+
+    def held_warm_up():
+        release.wait(10)
+        warm_up()
+
+    monkeypatch.setattr(backend, 'warm_up', held_warm_up)
+    with TestClient(backend.app) as client:
+        body = client.get('/').json()
+        assert body['status'] == 'ok' and body['state'] == 'warming'
+        assert 'dicom_ready 0' in client.get('/metrics').text.splitlines()
+        release.set()
+        body = wait_for_state(client, 'ready')
+        assert body['state'] == 'ready'
+        assert {'imports', 'app', 'server_start', 'warm_up'} <= set(body['startup']['phases_ms'])
+        assert 'dicom_ready 1' in client.get('/metrics').text.splitlines()
+
+
+def test_warm_up_not_recorded_in_metrics(backend):
+    def warm_up_stages():
+        return {name: histogram.count for name, histogram in backend.registry._stages.items()
+                if name in ('png_encode', 'base64')}, dict(backend.registry._bytes).get('png')
+
+    before = warm_up_stages()
+    backend._run_warm_up()
+    assert warm_up_stages() == before
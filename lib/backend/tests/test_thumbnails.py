@@ -0,0 +1,138 @@
+import base64
+import io
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+from pydicom.uid import RLELossless, generate_uid
+
+from conftest import make_dicom
+from thumbnails import ThumbnailCache, ThumbnailWorker, make_thumbnail
+
+SERIES_UID = generate_uid()
+
+
+def write_slice(path, value, sop_uid, transfer_syntax=None):
+    """Срез с постоянным значением: 0 — чёрная миниатюра, 3000 — белая (окно 40/400)."""
+    path = Path(path)
+    pixels = np.full((64, 64), value, dtype=np.int16)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(make_dicom(pixels=pixels, sop_uid=sop_uid, transfer_syntax=transfer_syntax,
+                                tags={'SeriesInstanceUID': SERIES_UID, 'InstanceNumber': 1}))
+    return str(path)
+
+
+def rewrite_in_place(path, value, sop_uid):
+    """Перезапись файла с тем же UID и тем же размером; mtime гарантированно другой."""
+    before = os.stat(path).st_mtime_ns
+    write_slice(path, value, sop_uid)
+    os.utime(path, ns=(before + 10**9, before + 10**9))
+
+
+def brightness(jpeg):
+    return float(np.asarray(Image.open(io.BytesIO(jpeg))).mean())
+
+
+@pytest.fixture
+def source(tmp_path):
+    sop_uid = generate_uid()
+    return write_slice(tmp_path / 'series' / 'a.dcm', 0, sop_uid), sop_uid
+
+
+def test_cache_round_trip(tmp_path, source):
+    path, sop_uid = source
+    cache = ThumbnailCache(root=str(tmp_path / 'cache'), max_bytes=1 << 20)
+    key = cache.key(sop_uid, path, 128)
+    assert key not in cache and cache.get(key) is None
+
+    cache.put(key, b'jpeg')
+    assert key in cache and cache.get(key) == b'jpeg'
+    assert cache.key(sop_uid, path, 64) != key
+    stats = cache.stats()
+    assert (stats['entries'], stats['hits'], stats['misses'], stats['writes']) == (1, 1, 1, 1)
+
+
+def test_missing_source_has_no_key(tmp_path):
+    cache = ThumbnailCache(root=str(tmp_path / 'cache'), max_bytes=1 << 20)
+    key = cache.key(generate_uid(), str(tmp_path / 'missing.dcm'), 128)
+    assert key is None and key not in cache and cache.get(key) is None
+    cache.put(key, b'jpeg')
+    assert cache.stats()['writes'] == 0
+
+
+def test_rewrite_in_place_changes_key(tmp_path, source):
+    path, sop_uid = source
+    cache = ThumbnailCache(root=str(tmp_path / 'cache'), max_bytes=1 << 20)
+    key = cache.key(sop_uid, path, 128)
+    cache.put(key, b'old')
+    rewrite_in_place(path, 3000, sop_uid)
+    assert cache.key(sop_uid, path, 128) != key
+    assert cache.key(sop_uid, path, 128) not in cache
+
+
+def test_cache_evicts_least_recently_used(tmp_path, source):
+    path, _ = source
+    cache = ThumbnailCache(root=str(tmp_path / 'cache'), max_bytes=250)
+    keys = [cache.key(f'1.2.{i}', path, 128) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, b'x' * 100)
+        os.utime(cache._path(key), (i, i))
+    assert cache.stats()['bytes'] <= 250
+    assert keys[0] not in cache and keys[2] in cache
+
+
+@pytest.mark.parametrize('transfer_syntax, method', [(None, 'native'), (RLELossless, 'full_decode')])
+def test_make_thumbnail(tmp_path, transfer_syntax, method):
+    path = write_slice(tmp_path / 'a.dcm', 3000, generate_uid(), transfer_syntax)
+    data, used = make_thumbnail(path, 32)
+    image = Image.open(io.BytesIO(data))
+    assert used == method
+    assert image.format == 'JPEG' and max(image.size) <= 32
+    assert brightness(data) > 250
+
+
+def wait_idle(worker, timeout=10):
+    deadline = time.monotonic() + timeout
+    while worker.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert worker.pending() == 0
+
+
+def test_worker_generates_and_refreshes_after_rewrite(tmp_path, source):
+    path, sop_uid = source
+    cache = ThumbnailCache(root=str(tmp_path / 'cache'), max_bytes=1 << 20)
+    worker = ThumbnailWorker(cache, size=32)
+    record = {"sop_instance_uid": sop_uid, "path": path}
+
+    worker.schedule([record])
+    wait_idle(worker)
+    assert worker.stats()['generated'] == 1
+    assert brightness(worker.cached(record)) < 5
+
+    worker.schedule([record])
+    assert worker.pending() == 0  # уже в кэше — повторно не ставится
+
+    rewrite_in_place(path, 3000, sop_uid)
+    assert worker.cached(record) is None
+    assert brightness(worker.thumbnail(record)) > 250
+    assert worker.stats()['generated'] == 2
+
+
+def test_series_thumbnails_follow_in_place_rewrite(client, tmp_path):
+    sop_uid = generate_uid()
+    path = write_slice(tmp_path / 'study' / 'a.dcm', 0, sop_uid)
+    assert client.post('/index_folder/', json={'path': str(tmp_path / 'study')}).status_code == 200
+
+    def thumbnail():
+        response = client.get(f'/series/{SERIES_UID}/thumbnails', params={'wait': True})
+        assert response.status_code == 200
+        entry, = response.json()['thumbnails']
+        assert entry['sop_instance_uid'] == sop_uid
+        return base64.b64decode(entry['image_base64'])
+
+    assert brightness(thumbnail()) < 5
+    rewrite_in_place(path, 3000, sop_uid)
+    assert brightness(thumbnail()) > 250
@@ -0,0 +1,146 @@
+import io
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.uid import generate_uid
+
+from conftest import make_dicom
+from volume import SeriesVolume, VolumeCache, slice_spacing
+
+
+def write_series(directory, count, rows=64, cols=48, rescales=None, dtypes=None):
+    instances = []
+    for index in range(count):
+        dicom_bytes = make_dicom(rows, cols, dtype=(dtypes or {}).get(index, np.int16), seed=index)
+        if rescales is not None:
+            ds = pydicom.dcmread(io.BytesIO(dicom_bytes))
+            ds.RescaleSlope, ds.RescaleIntercept = rescales[index]
+            buf = io.BytesIO()
+            ds.save_as(buf)
+            dicom_bytes = buf.getvalue()
+        path = directory / f"{index:03d}.dcm"
+        path.write_bytes(dicom_bytes)
+        instances.append({"path": str(path), "slice_position": float(index)})
+    return instances
+
+
+def reference(instances):
+    slices = [pydicom.dcmread(r["path"]) for r in instances]
+    return np.stack([s.pixel_array * float(s.RescaleSlope) + float(s.RescaleIntercept) for s in slices])
+
+
+@pytest.mark.parametrize('workers', [0, 3])
+def test_uniform_series_keeps_stored_dtype(tmp_path, workers):
+    instances = write_series(tmp_path, 7)
+    executor = ThreadPoolExecutor(workers) if workers else None
+    volume = SeriesVolume('1.2.3', instances, executor)
+    assert volume.volume.dtype == np.int16
+    np.testing.assert_allclose(volume.volume * volume.slope + volume.intercept, reference(instances))
+
+
+def test_mixed_rescale_converted_to_float32(tmp_path):
+    rescales = [(1.0, -1024.0), (2.0, 0.0), (0.5, 10.0), (1.0, -1024.0), (3.0, -5.0)]
+    instances = write_series(tmp_path, len(rescales), rescales=rescales)
+    volume = SeriesVolume('1.2.3', instances, ThreadPoolExecutor(2))
+    assert volume.volume.dtype == np.float32 and volume.slope == 1.0 and volume.intercept == 0.0
+    np.testing.assert_allclose(volume.volume, reference(instances), rtol=1e-6)
+
+
+def test_mixed_dtypes_converted_to_float32(tmp_path):
+    instances = write_series(tmp_path, 4, dtypes={2: np.uint16})
+    volume = SeriesVolume('1.2.3', instances)
+    assert volume.volume.dtype == np.float32
+    np.testing.assert_allclose(volume.volume, reference(instances), rtol=1e-6)
+
+
+def test_plane_views_are_strided_views(tmp_path):
+    instances = write_series(tmp_path, 5)
+    volume = SeriesVolume('1.2.3', instances)
+    assert [volume.plane_length(plane) for plane in ('axial', 'coronal', 'sagittal')] == [5, 64, 48]
+    view, vertical, horizontal = volume.plane_view('coronal', 10)
+    assert np.shares_memory(view, volume.volume)
+    # Верх корональной плоскости — последний (краниальный) срез
+    np.testing.assert_array_equal(view, volume.volume[::-1, 10, :])
+    assert (vertical, horizontal) == (1.0, 0.5)
+    with pytest.raises(ValueError):
+        volume.plane_view('oblique', 0)
+
+
+def test_reformat_resampled_to_square_pixels(tmp_path):
+    volume = SeriesVolume('1.2.3', write_series(tmp_path, 5))
+    # Шаг срезов 1 мм при пикселе 0.5 мм: по вертикали вдвое больше строк
+    assert volume.render('coronal', 0, 40, 400).shape == (10, 48)
+    assert volume.render('sagittal', 0, 40, 400).shape == (10, 64)
+    assert volume.render('axial', 0, 40, 400).shape == (64, 48)
+
+
+def test_slice_spacing():
+    assert slice_spacing([{"slice_position": p} for p in (0.0, 2.5, 5.0, 5.0, 7.5)], 1.0) == 2.5
+    assert slice_spacing([{"slice_position": None}, {"slice_position": 1.0}], 3.0) == 3.0
+    assert slice_spacing([{}], None) == 1.0
+
+
+def test_volume_cache_builds_once_and_evicts(tmp_path):
+    first, second = tmp_path / 'a', tmp_path / 'b'
+    first.mkdir()
+    second.mkdir()
+    cache = VolumeCache(max_bytes=1)
+    volume = cache.get_or_build('a', write_series(first, 3))
+    assert cache.get_or_build('a', []) is volume
+    cache.get_or_build('b', write_series(second, 3))
+    assert cache.get('a') is None and cache.get('b') is not None
+    assert cache.stats()['volumes'] == 1
+
+
+def write_indexed_series(directory, count):
+    series_uid = generate_uid()
+    for index in range(count):
+        ds = pydicom.dcmread(io.BytesIO(make_dicom(64, 48, seed=index)))
+        ds.SeriesInstanceUID = series_uid
+        ds.InstanceNumber = index + 1
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.ImagePositionPatient = [0, 0, float(index)]
+        ds.save_as(str(directory / f"{count - index:03d}.dcm"))
+    return series_uid
+
+
+def test_mpr_endpoints(client, tmp_path):
+    series_uid = write_indexed_series(tmp_path, 6)
+    assert client.post('/index_folder/', json={'path': str(tmp_path)}).status_code == 200
+
+    info = client.post(f'/volume/{series_uid}').json()
+    assert info['shape'] == [6, 64, 48]
+    response = client.post('/render_mpr/', json={'series_uid': series_uid, 'plane': 'coronal', 'index': 5,
+                                                 'window_center': 40, 'window_width': 400, 'format': 'raw'})
+    assert response.status_code == 200
+    assert (response.headers['X-MPR-Plane'], response.headers['X-MPR-Count']) == ('coronal', '64')
+    assert len(response.content) == 12 * 48
+
+    assert client.post('/render_mpr/', json={'series_uid': series_uid, 'plane': 'oblique'}).status_code == 400
+    assert client.post('/render_mpr/', json={'series_uid': series_uid, 'index': 6}).status_code == 400
+    assert client.post('/render_mpr/', json={'series_uid': 'missing'}).status_code == 404
+
+
+def test_peak_memory_below_two_volumes(tmp_path):
+    instances = write_series(tmp_path, 100, rows=256, cols=256)
+    tracemalloc.start()
+    volume = SeriesVolume('1.2.3', instances)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Прежде срезы держались списком и копировались в объём: пик больше двух объёмов
+    assert peak < 2 * volume.volume.nbytes
+
+
+def test_mixed_rescale_conversion_does_not_copy_volume(tmp_path):
+    rescales = [(1.0 + index % 3, -1024.0) for index in range(100)]
+    instances = write_series(tmp_path, 100, rows=256, cols=256, rescales=rescales)
+    tracemalloc.start()
+    volume = SeriesVolume('1.2.3', instances)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert volume.volume.dtype == np.float32
+    # float32-объём плюс константы; копия хранимых значений рядом дала бы 1.5 объёма
+    assert peak < 1.4 * volume.volume.nbytes
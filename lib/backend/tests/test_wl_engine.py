@@ -0,0 +1,82 @@
+import base64
+import io
+
+import numpy as np
+import pydicom
+import pytest
+from PIL import Image
+
+from conftest import make_dicom, upload
+from wl_engine import WindowLevelEngine, wl_gamma
+
+
+def legacy_window_level(raw_pixels, wc, ww, brightness, photometric):
+    """Прежний путь /update_wl/ над массивом float64 после Rescale — эталон для LUT."""
+    min_val, max_val = wc - ww / 2, wc + ww / 2
+    pixels_clipped = np.clip(raw_pixels, min_val, max_val)
+    if max_val > min_val:
+        pixels_normalized = (pixels_clipped - min_val) / (max_val - min_val)
+    else:
+        pixels_normalized = np.zeros_like(pixels_clipped)
+    if brightness != 1.0:
+        if brightness < 1.0:
+            pixels_normalized = np.power(pixels_normalized, 1.0 / (2.0 - brightness))
+        else:
+            pixels_normalized = np.power(pixels_normalized, 1.0 / brightness)
+    pixels_normalized = np.clip(pixels_normalized, 0, 1)
+    pixels_8bit = (pixels_normalized * 255).astype(np.uint8)
+    if photometric == "MONOCHROME1":
+        pixels_8bit = 255 - pixels_8bit
+    return pixels_8bit
+
+
+@pytest.mark.parametrize('dtype, low, high, slope, intercept', [
+    (np.int16, -1024, 3071, 1.0, 0.0),
+    (np.int16, 0, 4095, 1.0, -1024.0),
+    (np.uint16, 0, 4095, 1.0, 0.0),
+    (np.uint16, 0, 65535, 0.5, 10.0),
+    (np.uint8, 0, 255, 1.0, 0.0),
+    (np.float32, -500, 1500, 1.0, 0.0),
+])
+@pytest.mark.parametrize('photometric', ['MONOCHROME2', 'MONOCHROME1'])
+@pytest.mark.parametrize('brightness', [0.6, 1.0, 1.2, 1.8])
+def test_render_matches_legacy_path(dtype, low, high, slope, intercept, photometric, brightness):
+    stored = np.random.default_rng(1).integers(low, high + 1, size=(96, 80)).astype(dtype)
+    raw = stored.astype(np.float64) * slope + intercept
+    engine = WindowLevelEngine(stored, slope, intercept, invert=photometric == 'MONOCHROME1')
+    for wc, ww in ((40.0, 400.0), (1000.0, 2500.0), (0.0, 0.0)):
+        expected = legacy_window_level(raw, wc, ww, brightness, photometric)
+        assert np.array_equal(engine.render(wc, ww, wl_gamma(brightness)), expected), (wc, ww)
+
+
+def test_update_wl_matches_legacy_path(client):
+    dicom_bytes = make_dicom(seed=5)
+    image_id = upload(client, dicom_bytes)['image_id']
+    ds = pydicom.dcmread(io.BytesIO(dicom_bytes))
+    raw = ds.pixel_array.astype(np.float64) * float(ds.RescaleSlope) + float(ds.RescaleIntercept)
+    for brightness in (1.0, 1.5):
+        response = client.post('/update_wl/', json={'image_id': image_id, 'window_center': 60,
+                                                    'window_width': 300, 'brightness': brightness})
+        assert response.status_code == 200
+        image = np.asarray(Image.open(io.BytesIO(base64.b64decode(response.json()['image_base64']))))
+        assert np.array_equal(image, legacy_window_level(raw, 60.0, 300.0, brightness, 'MONOCHROME2'))
+
+
+def test_lut_is_accounted_before_first_render():
+    pixels = np.random.default_rng(0).integers(-1024, 3071, size=(64, 64)).astype(np.int16)
+    engine = WindowLevelEngine(pixels, 1.0, -1024.0)
+    before = engine.nbytes
+    engine.render(40, 400)
+    engine.render(60, 300)
+    assert engine.nbytes == before
+    assert before >= engine.lut(40, 400).nbytes
+
+
+def test_cache_accounting_matches_resident_after_render(client, backend):
+    image_id = upload(client, make_dicom())['image_id']
+    response = client.post('/update_wl/', json={'image_id': image_id, 'window_center': 40, 'window_width': 400,
+                                                'format': 'raw'})
+    assert response.status_code == 200
+    entry = backend.dicom_cache.get(image_id)
+    accounted = {item['image_id']: item['bytes'] for item in backend.dicom_cache.stats()['images']}
+    assert accounted[image_id] == entry.nbytes
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+import pytest
+
+from workers import LatestRequestTracker, SupersededError, _workers_from_env, create_executor, run_blocking
+
+
+def test_run_blocking_uses_pool_threads():
+    executor = create_executor(2)
+    try:
+        name = asyncio.run(run_blocking(executor, lambda: threading.current_thread().name))
+    finally:
+        executor.shutdown()
+    assert name.startswith('dicom-worker')
+
+
+def test_zero_workers_run_inline():
+    assert create_executor(0) is None
+    assert asyncio.run(run_blocking(None, threading.get_ident)) == threading.get_ident()
+
+
+@pytest.mark.parametrize('value, expected', [('3', 3), ('0', 0), ('-1', 0)])
+def test_render_workers_from_env(monkeypatch, value, expected):
+    monkeypatch.setenv('DICOM_RENDER_WORKERS', value)
+    assert _workers_from_env() == expected
+
+
+def test_requests_without_session_do_not_supersede_each_other():
+    tracker = LatestRequestTracker()
+    key = tracker.key(None, 'image')
+    first, second = tracker.begin(key), tracker.begin(key)
+    tracker.check(key, first)
+    tracker.check(key, second)
+    assert len(tracker) == 0
+
+
+def test_newer_request_of_same_session_supersedes_older():
+    tracker = LatestRequestTracker()
+    key = tracker.key('window-1', 'image')
+    first = tracker.begin(key)
+    second = tracker.begin(key)
+    tracker.check(key, second)
+    with pytest.raises(SupersededError):
+        tracker.check(key, first)
+    # Другая сессия с тем же изображением не затронута
+    other = tracker.key('window-2', 'image')
+    tracker.check(other, tracker.begin(other))
+
+
+def test_keys_dropped_when_image_evicted():
+    from image_cache import ImageCache
+
+    tracker = LatestRequestTracker()
+    cache = ImageCache(max_bytes=0, on_evict=tracker.discard)
+    tracker.begin(tracker.key('window-1', 'old'))
+    tracker.begin(tracker.key('window-1', 'new'))
+
+    class Entry:
+        def __init__(self, image_id):
+            self.image_id = image_id
+            self.nbytes = 1
+
+    cache.put(Entry('old'))
+    cache.put(Entry('new'))
+    assert 'old' not in cache
+    assert len(tracker) == 1
+
+
+def test_released_key_supersedes_running_request_and_never_reuses_tokens():
+    tracker = LatestRequestTracker()
+    key = tracker.key('channel', 'image')
+    running = tracker.begin(key)
+    tracker.release(key)
+    assert len(tracker) == 0
+    with pytest.raises(SupersededError):
+        tracker.check(key, running)
+    # Новый запрос того же ключа не воскрешает старый
+    tracker.check(key, tracker.begin(key))
+    with pytest.raises(SupersededError):
+        tracker.check(key, running)
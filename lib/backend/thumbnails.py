@@ -0,0 +1,340 @@
+import hashlib
+import io
+import itertools
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+from pydicom.encaps import generate_pixel_data_frame
+from pydicom.pixel_data_handlers.util import convert_color_space
+
+from dicom_io import first_float, open_dataset
+from frames import FrameSource, number_of_frames
+from image_stats import compute_stats, auto_window
+from settings import int_from_env
+
+
+# Сторона миниатюры по умолчанию (пиксели, по большей стороне)
+DEFAULT_THUMBNAIL_SIZE = 128
+# Папка и бюджет дискового кэша миниатюр (JPEG по 2–6 KB)
+DEFAULT_THUMBNAIL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thumbnail_cache')
+DEFAULT_THUMBNAIL_CACHE_BYTES = 256 * 1024 * 1024
+THUMBNAIL_QUALITY = 80
+
+# Синтаксисы передачи, которые Pillow декодирует сразу в уменьшенном разрешении:
+# JPEG — масштабирование DCT (draft, 1/2..1/8), JPEG 2000 — уровни вейвлета (reduce)
+JPEG_DRAFT_SYNTAXES = ('1.2.840.10008.1.2.4.50', '1.2.840.10008.1.2.4.51')
+JPEG2000_SYNTAXES = ('1.2.840.10008.1.2.4.90', '1.2.840.10008.1.2.4.91')
+
+# Приоритеты фоновой очереди: миниатюра-представитель серии раньше остальных срезов
+PRIORITY_REQUESTED = 0
+PRIORITY_SERIES = 1
+PRIORITY_INSTANCE = 2
+
+
+def thumbnail_size_from_env():
+    return int_from_env('DICOM_THUMBNAIL_SIZE', DEFAULT_THUMBNAIL_SIZE, minimum=16)
+
+
+def _reduce_factor(shape, size):
+    """Во сколько раз (степень двойки) можно уменьшить кадр, оставаясь не меньше size."""
+    factor = 1
+    while min(shape) // (factor * 2) >= size:
+        factor *= 2
+    return factor
+
+
+def _first_frame_bytes(ds):
+    return next(generate_pixel_data_frame(ds.PixelData, number_of_frames(ds)))
+
+
+def reduced_pixels(ds, size):
+    """Пиксели кадра 0 в уменьшенном разрешении (не меньше size по меньшей стороне,
+    где это возможно) и способ их получения.
+
+    - несжатые данные: прореживание view отображённого файла — читаются только нужные строки;
+    - JPEG baseline/extended 8 бит: Pillow draft (DCT-масштабирование при декодировании);
+    - JPEG 2000: Pillow reduce (декодируются только нужные уровни вейвлета);
+    - остальное (RLE, JPEG-LS, ...): полное декодирование кадра и прореживание.
+    """
+    rows, cols = int(ds.Rows), int(ds.Columns)
+    factor = _reduce_factor((rows, cols), size)
+    transfer_syntax = str(getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', ''))
+    if FrameSource.can_view_native(ds):
+        return FrameSource(ds).frame(0)[::factor, ::factor], 'native'
+    signed = int(getattr(ds, 'PixelRepresentation', 0)) == 1
+    if factor > 1 and (transfer_syntax in JPEG_DRAFT_SYNTAXES
+                       or (transfer_syntax in JPEG2000_SYNTAXES and not signed)):
+        try:
+            image = Image.open(io.BytesIO(_first_frame_bytes(ds)))
+            if transfer_syntax in JPEG_DRAFT_SYNTAXES:
+                image.draft(image.mode, (cols // factor, rows // factor))
+                method = 'jpeg_draft'
+            else:
+                image.reduce = factor.bit_length() - 1
+                method = 'j2k_reduce'
+            image.load()
+            return np.asarray(image), method
+        except Exception:
+            # 12-битный JPEG и прочее, что Pillow не декодирует, — через pydicom
+            pass
+    pixels = ds.pixel_array
+    if number_of_frames(ds) > 1:
+        pixels = pixels[0]
+    return pixels[::factor, ::factor], 'full_decode'
+
+
+def window_thumbnail(pixels, ds, method):
+    """8-битная миниатюра в окне из заголовка (иначе 1–99 перцентиль уменьшенного кадра)."""
+    photometric = str(getattr(ds, 'PhotometricInterpretation', 'MONOCHROME2'))
+    if pixels.ndim == 3:
+        # Pillow (draft/reduce) отдаёт уже RGB, остальные пути — в исходном пространстве
+        if photometric.startswith('YBR') and method not in ('jpeg_draft', 'j2k_reduce'):
+            pixels = convert_color_space(np.ascontiguousarray(pixels), photometric, 'RGB')
+        return np.ascontiguousarray(pixels[..., :3], dtype=np.uint8)
+    slope = first_float(ds.get('RescaleSlope'), 1.0)
+    intercept = first_float(ds.get('RescaleIntercept'), 0.0)
+    wc, ww = first_float(ds.get('WindowCenter'), None), first_float(ds.get('WindowWidth'), None)
+    if wc is None or ww is None or ww <= 0:
+        wc, ww = auto_window(compute_stats(np.ascontiguousarray(pixels), slope, intercept))
+    values = pixels.astype(np.float32) * np.float32(slope) + np.float32(intercept)
+    low = wc - ww / 2.0
+    out = np.clip((values - low) * (255.0 / max(ww, 1e-6)), 0, 255).astype(np.uint8)
+    return 255 - out if photometric == 'MONOCHROME1' else out
+
+
+def make_thumbnail(path, size):
+    """JPEG-миниатюра файла path (сторона не больше size) и способ декодирования."""
+    with open_dataset(path) as (ds, _):
+        pixels, method = reduced_pixels(ds, size)
+        image = Image.fromarray(window_thumbnail(pixels, ds, method))
+    image.thumbnail((size, size), Image.BILINEAR)
+    out = io.BytesIO()
+    image.save(out, format='JPEG', quality=THUMBNAIL_QUALITY)
+    return out.getvalue(), method
+
+
+class ThumbnailCache:
+    """Миниатюры на диске: <ключ>.jpg (см. key), запись атомарна,
+    при превышении бюджета удаляются давно не использованные (mtime)."""
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or os.environ.get('DICOM_THUMBNAIL_DIR', DEFAULT_THUMBNAIL_DIR)
+        self.max_bytes = (int_from_env('DICOM_THUMBNAIL_CACHE_BYTES', DEFAULT_THUMBNAIL_CACHE_BYTES)
+                          if max_bytes is None else int(max_bytes))
+        self._lock = threading.Lock()
+        self._bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    @staticmethod
+    def key(sop_instance_uid, source, size):
+        """Ключ миниатюры: SOPInstanceUID, размер и mtime файла-источника и сторона
+        миниатюры. Перезапись файла на месте с тем же UID (/rewrite_folder/, правка
+        тегов) даёт новый ключ, старая миниатюра просто вытесняется. None — файла нет."""
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        identity = f"{sop_instance_uid}|{stat.st_size}|{stat.st_mtime_ns}|{size}"
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key + '.jpg')
+
+    def get(self, key):
+        data = None
+        if key is not None:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def __contains__(self, key):
+        return key is not None and os.path.exists(self._path(key))
+
+    def put(self, key, data):
+        if key is None or self.max_bytes <= 0:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Не удалось записать миниатюру: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self.writes += 1
+            if self._bytes is None:
+                self._bytes = self._total_bytes()
+            else:
+                self._bytes += len(data)
+            if self._bytes > self.max_bytes:
+                self._evict_locked()
+
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return entries
+        for name in names:
+            if name.endswith('.jpg'):
+                path = os.path.join(self.root, name)
+                try:
+                    entries.append((os.path.getmtime(path), path, os.path.getsize(path)))
+                except OSError:
+                    continue
+        return entries
+
+    def _total_bytes(self):
+        return sum(size for _, _, size in self._entries())
+
+    def _evict_locked(self):
+        # Освобождаем с запасом (до 90% бюджета), чтобы не сканировать папку на каждой записи
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._bytes = total
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            return {
+                "root": self.root,
+                "entries": len(entries),
+                "bytes": sum(size for _, _, size in entries),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+            }
+
+
+def _lower_thread_priority():
+    # В Linux приоритет (nice) задаётся для отдельного потока по его TID;
+    # на других системах поток работает с обычным приоритетом
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+    except (AttributeError, OSError):
+        pass
+
+
+class ThumbnailWorker:
+    """Фоновый поток с пониженным приоритетом, который строит миниатюры по очереди
+    с приоритетами (запрошенные клиентом, представители серий, остальные срезы).
+    Уже построенные и стоящие в очереди миниатюры повторно не ставятся."""
+
+    def __init__(self, cache, size=None):
+        self.cache = cache
+        self.size = thumbnail_size_from_env() if size is None else size
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._queued = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.generated = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.methods = {}
+
+    def schedule(self, records, priority=PRIORITY_INSTANCE):
+        """Ставит в очередь миниатюры записей SeriesIndex (path, sop_instance_uid)."""
+        with self._lock:
+            for record in records:
+                sop = record.get("sop_instance_uid")
+                if not sop or self._queued.get(sop, priority + 1) <= priority:
+                    continue
+                if self.cache.key(sop, record["path"], self.size) in self.cache:
+                    continue
+                # Повышение приоритета — новая запись в очереди; старая будет пропущена
+                self._queued[sop] = priority
+                self._queue.put((priority, next(self._order), sop, record["path"]))
+            if self._thread is None and self._queued:
+                self._thread = threading.Thread(target=self._run, name='thumbnail-worker', daemon=True)
+                self._thread.start()
+
+    def pending(self):
+        with self._lock:
+            return len(self._queued)
+
+    def cached(self, record):
+        """Миниатюра записи SeriesIndex из кэша или None."""
+        return self.cache.get(self.cache.key(record["sop_instance_uid"], record["path"], self.size))
+
+    def thumbnail(self, record):
+        """Миниатюра из кэша или построенная сейчас (в вызывающем потоке)."""
+        data = self.cached(record)
+        if data is None:
+            data = self._generate(record["sop_instance_uid"], record["path"])
+        return data
+
+    def _generate(self, sop, path):
+        start = time.perf_counter()
+        # Ключ — до чтения файла: если файл перепишут во время построения, миниатюра
+        # останется под старым ключом и не выдаст себя за новую версию
+        key = self.cache.key(sop, path, self.size)
+        try:
+            data, method = make_thumbnail(path, self.size)
+        except Exception as e:
+            print(f"Не удалось построить миниатюру {path}: {e}")
+            with self._lock:
+                self.failed += 1
+            return None
+        self.cache.put(key, data)
+        with self._lock:
+            self.generated += 1
+            self.seconds += time.perf_counter() - start
+            self.methods[method] = self.methods.get(method, 0) + 1
+        return data
+
+    def _run(self):
+        _lower_thread_priority()
+        while True:
+            priority, _, sop, path = self._queue.get()
+            with self._lock:
+                if self._queued.get(sop) != priority:
+                    continue  # устаревшая запись: миниатюра уже построена или повышена
+            if self.cache.key(sop, path, self.size) not in self.cache:
+                self._generate(sop, path)
+            with self._lock:
+                if self._queued.get(sop) == priority:
+                    del self._queued[sop]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "pending": len(self._queued),
+                "generated": self.generated,
+                "failed": self.failed,
+                "avg_ms": round(self.seconds / self.generated * 1000.0, 2) if self.generated else None,
+                "decode_methods": dict(self.methods),
+            }
@@ -0,0 +1,258 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from dicom_io import first_float, open_dataset
+from frames import FrameSource, number_of_frames
+from image_stats import compute_stats
+from settings import int_from_env
+from wl_engine import WindowLevelEngine
+
+
+# Бюджет памяти на собранные объёмы серий (КТ 512x512x500 int16 — 250 MB)
+DEFAULT_VOLUME_CACHE_BYTES = 1024 * 1024 * 1024
+
+PLANES = ('axial', 'coronal', 'sagittal')
+
+
+def _read_slice(path):
+    """Хранимые пиксели среза (копия из отображённого файла) и его Rescale/геометрия."""
+    with open_dataset(path) as (ds, _):
+        if number_of_frames(ds) != 1:
+            raise ValueError(f"{path}: multi-frame instances cannot be stacked into a volume")
+        if FrameSource.can_view_native(ds):
+            pixels = np.array(FrameSource(ds).frame(0))
+        else:
+            pixels = ds.pixel_array
+        spacing = ds.get('PixelSpacing')
+        return {
+            "pixels": pixels,
+            "slope": first_float(ds.get('RescaleSlope'), 1.0),
+            "intercept": first_float(ds.get('RescaleIntercept'), 0.0),
+            "pixel_spacing": [first_float(v, 1.0) for v in spacing] if spacing is not None and len(spacing) == 2 else None,
+            "slice_thickness": first_float(ds.get('SliceThickness'), None),
+            "photometric": str(ds.get('PhotometricInterpretation', 'MONOCHROME2')),
+            "window_center": ds.get('WindowCenter'),
+            "window_width": ds.get('WindowWidth'),
+            "modality": str(ds.get('Modality', '')),
+        }
+
+
+def slice_spacing(instances, fallback):
+    """Шаг между срезами: медиана разностей положений вдоль нормали, иначе SliceThickness."""
+    positions = [r.get("slice_position") for r in instances]
+    if len(positions) > 1 and all(p is not None for p in positions):
+        steps = np.abs(np.diff(np.asarray(positions, dtype=np.float64)))
+        steps = steps[steps > 1e-6]
+        if steps.size:
+            return float(np.median(steps))
+    return fallback if fallback and fallback > 0 else 1.0
+
+
+def resample_rows(image, factor):
+    """Линейная интерполяция по вертикали: высота умножается на factor (исправление
+    анизотропии реформата). Работает на 8-битном результате W/L — строк немного."""
+    rows = image.shape[0]
+    out_rows = max(1, int(round(rows * factor)))
+    if out_rows == rows:
+        return image
+    position = (np.arange(out_rows, dtype=np.float32) + 0.5) / np.float32(factor) - 0.5
+    position = np.clip(position, 0, rows - 1)
+    lower = position.astype(np.intp)
+    upper = np.minimum(lower + 1, rows - 1)
+    weight = (position - lower).reshape((-1,) + (1,) * (image.ndim - 1))
+    blended = image[lower] * (1.0 - weight) + image[upper] * weight
+    return np.rint(blended).astype(np.uint8)
+
+
+def _rescale_to_float32(volume, rescales, mismatched):
+    """Переводит объём хранимых значений в float32 (единицы модальности) на месте.
+
+    Буфер расширяется до размера float32 (resize/realloc), затем срезы пересчитываются
+    с последнего: float32-срез k ложится на байты исходных срезов с индексами >= k,
+    которые уже прочитаны, поэтому второй копии объёма не нужно — только один срез.
+    mismatched — срезы {индекс: пиксели}, не записанные в объём из-за типа.
+    """
+    count = volume.shape[0]
+    slice_shape = volume.shape[1:]
+    size = int(np.prod(slice_shape))
+    if volume.dtype.itemsize > 4:
+        # float64-данные: float32 уже, чем исходный тип, расширять нечего
+        out = np.empty(volume.shape, dtype=np.float32)
+        for index, (slope, intercept) in enumerate(rescales):
+            source = mismatched.get(index, volume[index])
+            out[index] = source * np.float32(slope) + np.float32(intercept)
+        return out
+    source_dtype = volume.dtype
+    volume.resize((count * size * 4 // source_dtype.itemsize,), refcheck=False)
+    source = volume[:count * size].reshape((count,) + slice_shape)
+    target = volume.view(np.float32)[:count * size].reshape((count,) + slice_shape)
+    for index in range(count - 1, -1, -1):
+        slope, intercept = rescales[index]
+        pixels = mismatched.pop(index, None)
+        if pixels is None:
+            pixels = source[index].astype(np.float32)
+        target[index] = pixels * np.float32(slope) + np.float32(intercept)
+    return target
+
+
+class SeriesVolume:
+    """Срезы серии, собранные в один непрерывный массив (срез, строка, столбец) хранимых
+    значений — компактный целочисленный тип, как в файлах; Rescale учитывается в LUT.
+
+    Реформаты — strided view этого массива (без копирования) через тот же движок W/L.
+    Срезы упорядочены по положению вдоль нормали (SeriesIndex), индекс 0 — нижний
+    для аксиальной серии, поэтому в корональной/сагиттальной плоскостях ось срезов
+    разворачивается, чтобы верх изображения был краниальным.
+    """
+
+    def __init__(self, series_uid, instances, executor=None):
+        self.series_uid = series_uid
+        paths = [r["path"] for r in instances]
+        first = _read_slice(paths[0])
+        shape = first["pixels"].shape
+        if len(shape) != 2:
+            raise ValueError("Only single-channel series can be reformatted")
+
+        # Объём выделяется сразу по первому срезу, каждый воркер пишет свой срез прямо
+        # в него: в памяти одновременно объём и по одному декодированному срезу на воркер
+        volume = np.empty((len(paths),) + shape, dtype=first["pixels"].dtype)
+        rescales = [None] * len(paths)
+        # Срезы, чьи значения не помещаются в тип объёма (редкие серии со смешанными типами)
+        mismatched = {}
+
+        def load(item):
+            index, path = item
+            s = first if index == 0 else _read_slice(path)
+            if s["pixels"].shape != shape:
+                raise ValueError("Slices of the series have different dimensions")
+            rescales[index] = (s["slope"], s["intercept"])
+            if np.can_cast(s["pixels"].dtype, volume.dtype, 'safe'):
+                volume[index] = s["pixels"]
+            else:
+                mismatched[index] = s["pixels"]
+
+        items = list(enumerate(paths))
+        if executor is not None:
+            list(executor.map(load, items))
+        else:
+            for item in items:
+                load(item)
+        del first["pixels"]
+
+        if len(set(rescales)) == 1 and not mismatched:
+            self.slope, self.intercept = rescales[0]
+        else:
+            # Разные Rescale/типы по срезам: объём хранится в единицах модальности
+            volume = _rescale_to_float32(volume, rescales, mismatched)
+            self.slope, self.intercept = 1.0, 0.0
+        self.volume = volume
+
+        row_spacing, col_spacing = first["pixel_spacing"] or (1.0, 1.0)
+        self.spacing = (slice_spacing(instances, first["slice_thickness"]), row_spacing, col_spacing)
+        self.photometric = first["photometric"]
+        self.modality = first["modality"]
+        self.header_window = (first["window_center"], first["window_width"])
+        self.stats = compute_stats(self.volume, self.slope, self.intercept)
+        self.engine = WindowLevelEngine(
+            self.volume, self.slope, self.intercept,
+            invert=self.photometric == "MONOCHROME1",
+            value_range=self.stats.stored_range,
+        )
+
+    @property
+    def nbytes(self):
+        return int(self.volume.nbytes + self.engine.nbytes + self.stats.nbytes)
+
+    def plane_length(self, plane):
+        """Число положений в плоскости (сколько можно прокручивать)."""
+        slices, rows, cols = self.volume.shape
+        return {'axial': slices, 'coronal': rows, 'sagittal': cols}[plane]
+
+    def plane_view(self, plane, index):
+        """Срез объёма в плоскости plane без копирования и вертикальный/горизонтальный шаг (мм)."""
+        slice_step, row_spacing, col_spacing = self.spacing
+        if plane == 'axial':
+            return self.volume[index], row_spacing, col_spacing
+        if plane == 'coronal':
+            return self.volume[::-1, index, :], slice_step, col_spacing
+        if plane == 'sagittal':
+            return self.volume[::-1, :, index], slice_step, row_spacing
+        raise ValueError(f"Unknown plane '{plane}'. Expected one of: {', '.join(PLANES)}")
+
+    def render(self, plane, index, wc, ww, gamma=1.0):
+        """8-битный реформат с квадратными пикселями (шаг по вертикали приводится к горизонтальному)."""
+        view, vertical, horizontal = self.plane_view(plane, index)
+        image = self.engine.render(wc, ww, gamma, pixels=view)
+        if horizontal > 0 and abs(vertical / horizontal - 1.0) > 0.01:
+            image = resample_rows(image, vertical / horizontal)
+        return image
+
+    def describe(self):
+        slices, rows, cols = self.volume.shape
+        return {
+            "series_instance_uid": self.series_uid,
+            "shape": [slices, rows, cols],
+            "spacing": list(self.spacing),
+            "dtype": str(self.volume.dtype),
+            "bytes": self.nbytes,
+            "planes": {plane: self.plane_length(plane) for plane in PLANES},
+        }
+
+
+class VolumeCache:
+    """LRU собранных объёмов по SeriesInstanceUID с ограничением по памяти.
+    on_evict(series_uid) вызывается для вытесненных объёмов вне блокировки."""
+
+    def __init__(self, max_bytes=None, on_evict=None):
+        self.max_bytes = int_from_env('DICOM_VOLUME_CACHE_BYTES', DEFAULT_VOLUME_CACHE_BYTES) if max_bytes is None else int(max_bytes)
+        self.on_evict = on_evict
+        self._volumes = OrderedDict()
+        self._lock = threading.Lock()
+        # Сборка одной серии выполняется один раз, даже при параллельных запросах
+        self._building = {}
+
+    def get(self, series_uid):
+        with self._lock:
+            volume = self._volumes.get(series_uid)
+            if volume is not None:
+                self._volumes.move_to_end(series_uid)
+            return volume
+
+    def get_or_build(self, series_uid, instances, executor=None):
+        with self._lock:
+            volume = self._volumes.get(series_uid)
+            if volume is not None:
+                self._volumes.move_to_end(series_uid)
+                return volume
+            lock = self._building.setdefault(series_uid, threading.Lock())
+        with lock:
+            volume = self.get(series_uid)
+            if volume is None:
+                volume = SeriesVolume(series_uid, instances, executor)
+                self._put(volume)
+        with self._lock:
+            self._building.pop(series_uid, None)
+        return volume
+
+    def _put(self, volume):
+        evicted_uids = []
+        with self._lock:
+            self._volumes[volume.series_uid] = volume
+            total = sum(v.nbytes for v in self._volumes.values())
+            while total > self.max_bytes and len(self._volumes) > 1:
+                series_uid, evicted = self._volumes.popitem(last=False)
+                total -= evicted.nbytes
+                evicted_uids.append(series_uid)
+        if self.on_evict is not None:
+            for series_uid in evicted_uids:
+                self.on_evict(series_uid)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "volumes": len(self._volumes),
+                "bytes": sum(v.nbytes for v in self._volumes.values()),
+                "max_bytes": self.max_bytes,
+            }
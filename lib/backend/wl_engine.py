@@ -0,0 +1,187 @@
+import numpy as np
+
+
+def window_to_uint8(values, wc, ww, gamma=1.0, invert=False):
+    """Window/Level + гамма яркости над массивом значений (уже после Rescale) -> uint8.
+
+    Используется и для построения LUT, и как запасной путь для данных, к которым
+    LUT неприменим, поэтому результат обоих путей совпадает побитно.
+    """
+    min_val, max_val = wc - ww / 2, wc + ww / 2
+    pixels_clipped = np.clip(values, min_val, max_val)
+
+    # Нормализуем к 0-1 диапазону
+    if max_val > min_val:
+        pixels_normalized = (pixels_clipped - min_val) / (max_val - min_val)
+    else:
+        pixels_normalized = np.zeros_like(pixels_clipped)
+
+    if gamma != 1.0:
+        pixels_normalized = np.power(pixels_normalized, gamma)
+
+    pixels_normalized = np.clip(pixels_normalized, 0, 1)
+    pixels_8bit = (pixels_normalized * 255).astype(np.uint8)
+
+    if invert:
+        pixels_8bit = 255 - pixels_8bit
+    return pixels_8bit
+
+
+def wl_gamma(brightness):
+    """Показатель степени для яркости в /update_wl/ (мягкая корректировка)."""
+    if brightness == 1.0:
+        return 1.0
+    if brightness < 1.0:
+        # Затемнение
+        return 1.0 / (2.0 - brightness)
+    # Осветление
+    return 1.0 / brightness
+
+
+def brightness_gamma(brightness):
+    """Показатель степени для яркости в /update_brightness/."""
+    if brightness == 1.0:
+        return 1.0
+    return 1.0 / brightness
+
+
+# Целочисленные типы, для которых LUT покрывает весь диапазон хранимых значений.
+# Знаковые массивы индексируются через беззнаковое представление того же размера.
+_LUT_INDEX_DTYPES = {
+    np.dtype(np.uint8): np.uint8,
+    np.dtype(np.int8): np.uint8,
+    np.dtype(np.uint16): np.uint16,
+    np.dtype(np.int16): np.uint16,
+}
+
+
+# Сколько пикселей обрабатывать за раз в запасном (не-LUT) пути: временные
+# float32-массивы остаются в пределах ~1 MB вместо нескольких копий всего изображения
+FALLBACK_TILE_PIXELS = 256 * 1024
+
+
+class WindowLevelEngine:
+    """Рендер W/L через таблицу (LUT), индексируемую хранимым значением пикселя.
+
+    В LUT заранее учтены Rescale Slope/Intercept, окно, гамма яркости и инверсия
+    MONOCHROME1, так что каждое обновление — одна индексация LUT исходным
+    целочисленным массивом без промежуточных float-копий всего изображения.
+    """
+
+    def __init__(self, pixels, slope=1.0, intercept=0.0, invert=False, value_range=None):
+        self.pixels = pixels
+        self.slope = float(slope)
+        self.intercept = float(intercept)
+        self.invert = invert
+        self._index = None
+        self._lut_size = 0
+        self._lut_slices = []
+        self._stored_values = None
+        self._lut_values = None
+        # (ключ, таблица) одним кортежем, чтобы параллельные запросы не видели их вразнобой
+        self._last_lut = None
+
+        index_dtype = _LUT_INDEX_DTYPES.get(pixels.dtype)
+        if index_dtype is not None and pixels.size:
+            # view() не копирует данные: int16 -1 превращается в индекс 65535
+            self._index = pixels.view(index_dtype)
+            self._lut_size = np.iinfo(index_dtype).max + 1
+            if value_range is None:
+                value_range = (int(pixels.min()), int(pixels.max()))
+            # Считаем LUT только для реально встречающихся значений (12-битные данные
+            # в 16-битном контейнере — 4096 записей вместо 65536)
+            self._lut_slices = self._index_slices(int(value_range[0]), int(value_range[1]))
+            self._stored_values = np.concatenate([
+                np.arange(sl.start, sl.stop, dtype=np.int64) for sl in self._lut_slices
+            ]).astype(index_dtype).view(pixels.dtype)
+            self._lut_values = self._rescale(self._stored_values)
+
+    def _index_slices(self, vmin, vmax):
+        """Диапазоны индексов LUT, соответствующие хранимым значениям [vmin, vmax]."""
+        size = self._lut_size
+        if vmin >= 0:
+            return [slice(vmin, vmax + 1)]
+        if vmax < 0:
+            return [slice(vmin + size, vmax + 1 + size)]
+        return [slice(0, vmax + 1), slice(vmin + size, size)]
+
+    @property
+    def uses_lut(self):
+        return self._index is not None
+
+    @property
+    def nbytes(self):
+        """Дополнительная память движка (таблицы), без самого массива пикселей."""
+        total = 0
+        if self._lut_values is not None:
+            # LUT последнего окна (uint8 на каждое хранимое значение) учитывается заранее:
+            # она строится при первом рендере, когда запись уже учтена в кэше изображений
+            total += self._lut_values.nbytes + self._stored_values.nbytes + self._lut_size
+        return total
+
+    def _rescale(self, stored):
+        if self.slope != 1.0 or self.intercept != 0.0:
+            return stored.astype(np.float64) * self.slope + self.intercept
+        return stored
+
+    def lut(self, wc, ww, gamma=1.0):
+        key = (float(wc), float(ww), float(gamma))
+        last = self._last_lut
+        if last is not None and last[0] == key:
+            return last[1]
+        lut = self._expand(window_to_uint8(self._lut_values, wc, ww, gamma, self.invert))
+        self._last_lut = (key, lut)
+        return lut
+
+    def _expand(self, values):
+        """Раскладывает значения для встречающихся хранимых значений в полную LUT."""
+        lut = np.zeros(self._lut_size, dtype=np.uint8)
+        offset = 0
+        for sl in self._lut_slices:
+            count = sl.stop - sl.start
+            lut[sl] = values[offset:offset + count]
+            offset += count
+        return lut
+
+    @property
+    def stored_values(self):
+        """Хранимые значения, покрываемые LUT (1-D), или None, если LUT неприменим."""
+        return self._stored_values
+
+    def render_mapped(self, values_8bit):
+        """Рендер произвольного поэлементного отображения, заданного на stored_values."""
+        return self._expand(values_8bit)[self._index]
+
+    def render(self, wc, ww, gamma=1.0, pixels=None):
+        """Возвращает 8-битное изображение для заданных W/L и гаммы.
+
+        pixels — другой кадр того же объекта (тот же dtype и Rescale); по умолчанию
+        рендерится массив, переданный в конструктор.
+        """
+        if pixels is None:
+            index = self._index
+            pixels = self.pixels
+        else:
+            same_dtype = self._index is not None and pixels.dtype == self.pixels.dtype
+            index = pixels.view(self._index.dtype) if same_dtype else None
+        if index is not None:
+            # Индексация lut[index] идёт буферами; np.take сначала приводит весь массив
+            # индексов к intp (8 байт на пиксель — 128 MB для 4096x4096)
+            return self.lut(wc, ww, gamma)[index]
+        return self._render_tiled(pixels, wc, ww, gamma)
+
+    def _render_tiled(self, pixels, wc, ww, gamma):
+        """Запасной путь (float-пиксели, 32-битные данные): Rescale в float32 полосами строк."""
+        out = np.empty(pixels.shape, dtype=np.uint8)
+        if pixels.size == 0:
+            return out
+        row_pixels = max(1, pixels.size // pixels.shape[0])
+        rows_per_tile = max(1, FALLBACK_TILE_PIXELS // row_pixels)
+        for start in range(0, pixels.shape[0], rows_per_tile):
+            block = pixels[start:start + rows_per_tile].astype(np.float32)
+            if self.slope != 1.0:
+                block *= np.float32(self.slope)
+            if self.intercept != 0.0:
+                block += np.float32(self.intercept)
+            out[start:start + rows_per_tile] = window_to_uint8(block, wc, ww, gamma, self.invert)
+        return out
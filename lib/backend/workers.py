@@ -0,0 +1,166 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from settings import int_from_env
+
+
+def _workers_from_env():
+    # Минимум 2 потока даже на одном ядре: короткий W/L-рендер не должен ждать
+    # в очереди за долгой загрузкой
+    return int_from_env('DICOM_RENDER_WORKERS', max(2, min(4, os.cpu_count() or 1)), minimum=0)
+
+
+def create_executor(max_workers=None):
+    """Пул потоков для CPU-тяжёлой работы (dcmread, декодирование, W/L, PNG).
+
+    NumPy, Pillow и кодеки pydicom большую часть времени отпускают GIL, поэтому
+    потоков достаточно, а массивы не приходится сериализовать между процессами.
+    0 воркеров — выполнять прямо в event loop (прежнее поведение, для сравнения).
+    """
+    if max_workers is None:
+        max_workers = _workers_from_env()
+    if max_workers == 0:
+        return None
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dicom-worker')
+    # ThreadPoolExecutor создаёт потоки лениво и может не создать новый, пока
+    # «свободным» числится поток, уже занятый долгой задачей (загрузкой), — тогда
+    # W/L-запрос ждёт её окончания. Запускаем все потоки заранее.
+    barrier = threading.Barrier(max_workers)
+    for future in [executor.submit(barrier.wait) for _ in range(max_workers)]:
+        future.result()
+    return executor
+
+
+def export_workers_from_env():
+    return int_from_env('DICOM_EXPORT_WORKERS', os.cpu_count() or 1, minimum=0)
+
+
+def create_process_pool(max_workers=None):
+    """Пул процессов для пакетной работы на чистом Python (рисование аннотаций PIL,
+    правка тегов, сериализация), которая держит GIL и в потоках не распараллеливается.
+
+    Процессы запускаются через spawn (как на Windows, где работает приложение) при первой
+    задаче; в них передаются пути или bytes файлов, а не разобранные наборы данных.
+    0 воркеров (DICOM_EXPORT_WORKERS=0) — None, работа идёт в пуле потоков.
+    """
+    if max_workers is None:
+        max_workers = export_workers_from_env()
+    if max_workers == 0:
+        return None
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+async def run_blocking(executor, fn, *args, **kwargs):
+    """Выполняет fn в пуле и ожидает результат, не блокируя event loop.
+
+    Контекст (contextvars) запроса передаётся в воркер: этапы, замеренные там,
+    попадают в тайминги своего запроса.
+    """
+    if executor is None:
+        return fn(*args, **kwargs)
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, call)
+
+
+class SupersededError(Exception):
+    """Запрос устарел: для того же ключа уже пришёл более новый."""
+
+
+class LatestRequestTracker:
+    """Отслеживает последний запрос по ключу (сессия, изображение/серия).
+
+    Каждый новый запрос получает токен; воркер перед каждым тяжёлым этапом
+    вызывает check() и прекращает работу, если его обогнал более свежий запрос.
+    Запросы без сессии (ключ None) не вытесняют друг друга: иначе разные клиенты,
+    смотрящие одно изображение, отменяли бы запросы друг друга.
+    """
+
+    def __init__(self):
+        self._latest = {}
+        # Токены сквозные, а не по ключу: после release()/discard() новый запрос не
+        # получит токен, совпадающий с токеном ещё идущего старого
+        self._tokens = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(session_id, target):
+        """Ключ запроса; None, если клиент не передал session_id."""
+        return None if session_id is None else (session_id, target)
+
+    def begin(self, key):
+        """Токен нового запроса; None — запрос не участвует в вытеснении."""
+        if key is None:
+            return None
+        with self._lock:
+            token = next(self._tokens)
+            self._latest[key] = token
+            return token
+
+    def is_latest(self, key, token):
+        if token is None:
+            return True
+        with self._lock:
+            return self._latest.get(key) == token
+
+    def check(self, key, token):
+        if not self.is_latest(key, token):
+            raise SupersededError(f"Request superseded for {key}")
+
+    def release(self, key):
+        """Забывает ключ (клиент отключился): его незавершённый запрос считается вытесненным."""
+        with self._lock:
+            self._latest.pop(key, None)
+
+    def discard(self, target):
+        """Забывает ключи всех сессий для изображения/серии (при вытеснении из кэша)."""
+        with self._lock:
+            for key in [key for key in self._latest if key[1] == target]:
+                del self._latest[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._latest)
+
+
+class LatestSlot:
+    """Очередь глубины 1 для event loop: новое значение заменяет ещё не взятое.
+
+    Используется каналом рендера: пока идёт рендер, промежуточные шаги
+    перетаскивания W/L перезаписывают друг друга, и следующим рендерится
+    только самый свежий. Счётчик coalesced — сколько шагов было пропущено.
+    """
+
+    def __init__(self):
+        self._value = None
+        self._has_value = False
+        self._closed = False
+        self._event = asyncio.Event()
+        self.coalesced = 0
+
+    def put(self, value):
+        if self._has_value:
+            self.coalesced += 1
+        self._value = value
+        self._has_value = True
+        self._event.set()
+
+    def close(self):
+        self._closed = True
+        self._event.set()
+
+    async def get(self):
+        """Следующее значение; None, если слот закрыт и пуст."""
+        while not self._has_value:
+            if self._closed:
+                return None
+            self._event.clear()
+            await self._event.wait()
+        value, self._value, self._has_value = self._value, None, False
+        return value
@@ -1,7 +1,9 @@
 import 'package:flutter/material.dart';
 import 'screens/home_screen.dart';
+import 'services/embedded_server_service.dart';
 
 void main() {
+  EmbeddedServerService.markAppLaunch();
   runApp(const MyApp());
 }
 
@@ -1824,12 +1824,6 @@ class MagnifierPainter extends CustomPainter {
   }
 }
 
-// Новая функция для декодирования в фоне
-Uint8List _decodeResponseInIsolate(String responseBody) {
-  final Map<String, dynamic> data = jsonDecode(responseBody);
-  return base64Decode(data['image_base64']);
-}
-
 // Функция для декодирования изображения в изоляте
 Uint8List _decodeImageInIsolate(dynamic data) {
   final String imageBase64 = data as String;
@@ -1857,6 +1851,11 @@ class _HomeScreenState extends State<HomeScreen> with WidgetsBindingObserver {
   bool _showInfoPanel = true;
   bool _editInfo = false;
   String? _currentFileName;
+  String? _imageId; // Handle изображения в кэше сервера (из ответа /process_dicom/)
+  // Стабильный id этого окна для сервера: новый W/L-запрос отменяет только устаревшие
+  // запросы этого же окна, а не других окон/клиентов с тем же изображением
+  final String _sessionId =
+      '${DateTime.now().microsecondsSinceEpoch.toRadixString(16)}-${Random().nextInt(1 << 32).toRadixString(16)}';
   final TextEditingController _reportController = TextEditingController();
   final Map<String, TextEditingController> _tagControllers = {};
   
@@ -1983,7 +1982,7 @@ class _HomeScreenState extends State<HomeScreen> with WidgetsBindingObserver {
           name: 'Save with annotations',
           icon: Icons.save,
           shortcut: 'Ctrl+S',
-          enabled: _originalDicomBytes != null,
+          enabled: _imageId != null || _originalDicomBytes != null,
         ),
         MenuItem(name: '-'), // Разделитель
         MenuItem(
@@ -2007,7 +2006,7 @@ class _HomeScreenState extends State<HomeScreen> with WidgetsBindingObserver {
             _saveAnnotatedPng();
             break;
           case 'Save with annotations':
-            if (_originalDicomBytes != null) {
+            if (_imageId != null || _originalDicomBytes != null) {
               _exportDicom();
             } else {
               ScaffoldMessenger.of(context).showSnackBar(
@@ -2291,15 +2290,6 @@ class _HomeScreenState extends State<HomeScreen> with WidgetsBindingObserver {
         _currentFileName = result.files.single.name;
         _originalDicomBytes = result.files.single.bytes;
         
-        // Проверяем размер файла
-        if (result.files.single.bytes!.length > 100 * 1024 * 1024) { // 100MB
-          setState(() { 
-            _errorMessage = 'Файл слишком большой (${(result.files.single.bytes!.length / 1024 / 1024).toStringAsFixed(1)} MB). Максимальный размер: 100 MB'; 
-            _isLoading = false; 
-          });
-          return;
-        }
-        
         // Проверяем доступность встроенного сервера
         if (!EmbeddedServerService.isRunning) {
           setState(() { 
@@ -2310,7 +2300,14 @@ class _HomeScreenState extends State<HomeScreen> with WidgetsBindingObserver {
         }
         
         var request = http.MultipartRequest('POST', Uri.parse('${EmbeddedServerService.serverUrl}/process_dicom/'));
-        request.files.add(http.MultipartFile.fromBytes('file', result.files.single.bytes!, filename: result.files.single.name));
+        final localPath = result.files.single.path;
+        if (localPath != null) {
+          // Сервер работает на той же машине: передаём путь, и файл читается с диска
+          // через mmap без пересылки и копирования в памяти
+          request.fields['path'] = localPath;
+        } else {
+          request.files.add(http.MultipartFile.fromBytes('file', result.files.single.bytes!, filename: result.files.single.name));
+        }
         
         print("Отправляем запрос на сервер...");
         
@@ -2402,6 +2399,7 @@ class _HomeScreenState extends State<HomeScreen> with WidgetsBindingObserver {
                 _windowWidth = (data['window_width'] as num).toDouble();
                 _initialWC = _windowCenter;
                 _initialWW = _windowWidth;
+                _imageId = data['image_id']?.toString();
                 _isLoading = false;
                 
                 print("Все данные успешно установлены");
@@ -2411,6 +2409,8 @@ class _HomeScreenState extends State<HomeScreen> with WidgetsBindingObserver {
               // Загружаем метаданные и аннотации после установки изображения
               // Используем addPostFrameCallback, чтобы canvas успел отрендериться
               WidgetsBinding.instance.addPostFrameCallback((_) async {
+              // Изображение уже отрисовано: фиксируем time-to-first-image
+              EmbeddedServerService.recordFirstImage();
               await _loadMetadata();
               });
             } catch (decodeError) {
@@ -4142,12 +4142,15 @@ class _HomeScreenState extends State<HomeScreen> with WidgetsBindingObserver {
     final body = jsonEncode({
       "window_center": center, 
       "window_width": width,
-      "brightness": 1.0  // Яркость теперь обрабатывается во Flutter
+      "brightness": 1.0,  // Яркость теперь обрабатывается во Flutter
+      "image_id": _imageId,
+      "session_id": _sessionId,
+      "format": "png",  // Бинарный PNG с быстрым сжатием вместо base64 внутри JSON
     });
     try {
       final response = await http.post(url, headers: headers, body: body);
       if (response.statusCode == 200 && mounted) {
-        final newImageBytes = await compute(_decodeResponseInIsolate, response.body);
+        final newImageBytes = response.bodyBytes;
         
         // Декодируем изображение для лупы
         ui.Image? decodedImage;
@@ -4716,7 +4719,7 @@ class _HomeScreenState extends State<HomeScreen> with WidgetsBindingObserver {
   }
 
   Future<void> _exportDicom() async {
-    if (_originalDicomBytes == null) {
+    if (_imageId == null && _originalDicomBytes == null) {
       ScaffoldMessenger.of(context).showSnackBar(
         const SnackBar(content: Text('Исходный DICOM недоступен для экспорта'), backgroundColor: Colors.red),
       );
@@ -4729,12 +4732,21 @@ class _HomeScreenState extends State<HomeScreen> with WidgetsBindingObserver {
         );
         return;
       }
-      var request = http.MultipartRequest('POST', Uri.parse('${EmbeddedServerService.serverUrl}/export_dicom/'));
-      request.files.add(http.MultipartFile.fromBytes('file', _originalDicomBytes!, filename: _currentFileName ?? 'image.dcm'));
       // Обновляем теги из контроллеров перед экспортом
       final currentTags = Map.fromEntries(_tagControllers.entries.map((e) => MapEntry(e.key, e.value.text.trim())));
       final meta = jsonEncode({'tags': currentTags, 'report': _reportController.text.trim()});
-      request.fields['metadata'] = meta;
+      // MultipartRequest отправляется один раз, поэтому для повтора собирается заново
+      http.MultipartRequest buildRequest({required bool byImageId}) {
+        final request = http.MultipartRequest('POST', Uri.parse('${EmbeddedServerService.serverUrl}/export_dicom/'));
+        if (byImageId) {
+          // Исходный файл уже разобран сервером: отправляем только изменения
+          request.fields['image_id'] = _imageId!;
+        } else {
+          request.files.add(http.MultipartFile.fromBytes('file', _originalDicomBytes!, filename: _currentFileName ?? 'image.dcm'));
+        }
+        request.fields['metadata'] = meta;
+        return request;
+      }
 
       // Подготовка аннотаций для сервера (координаты уже в системе изображения)
       String _colorToHex(Color c) {
@@ -4866,24 +4878,27 @@ class _HomeScreenState extends State<HomeScreen> with WidgetsBindingObserver {
       // НЕ отправляем render с аннотациями - аннотации остаются отдельным редактируемым слоем
       // DICOM экспортируется БЕЗ аннотаций, аннотации загружаются отдельно из JSON при открытии файла
       
-      final streamed = await request.send();
-      final body = await streamed.stream.bytesToString();
+      var streamed = await buildRequest(byImageId: _imageId != null).send();
+      if (streamed.statusCode == 404 && _imageId != null && _originalDicomBytes != null) {
+        // Сервер вытеснил изображение из кэша или был перезапущен: повторяем с исходным файлом
+        await streamed.stream.drain<void>();
+        streamed = await buildRequest(byImageId: false).send();
+      }
       if (streamed.statusCode == 200) {
-        final resp = jsonDecode(body) as Map<String, dynamic>;
-        final base64Str = resp['dicom_base64'] as String;
-        final bytes = base64Decode(base64Str);
         final dir = await getApplicationDocumentsDirectory();
         final outDir = Directory('${dir.path}/dicom_exports');
         if (!await outDir.exists()) await outDir.create(recursive: true);
         final baseName = (_currentFileName ?? 'image').replaceAll(RegExp(r'[\\/:*?"<>|]'), '_');
         final file = File('${outDir.path}/${baseName.replaceAll('.dcm','')}_edited.dcm');
-        await file.writeAsBytes(bytes);
+        // Сервер отдаёт Part-10 файл (application/dicom) потоком — пишем его сразу на диск
+        await streamed.stream.pipe(file.openWrite());
         if (mounted) {
           ScaffoldMessenger.of(context).showSnackBar(
             SnackBar(content: Text('Сохранено: ${file.path}')), 
           );
         }
       } else {
+        final body = await streamed.stream.bytesToString();
         throw Exception('HTTP ${streamed.statusCode}: $body');
       }
     } catch (e) {
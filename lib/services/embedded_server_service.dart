@@ -2,11 +2,22 @@ import 'dart:io';
 import 'dart:convert';
 import 'package:path_provider/path_provider.dart';
 import 'package:flutter/foundation.dart';
+import 'package:flutter/services.dart';
 
 class EmbeddedServerService {
   static Process? _serverProcess;
   static bool _isRunning = false;
   static String? _serverUrl;
+  // Время от запуска приложения (main) до первого показанного изображения
+  static final Stopwatch _launchClock = Stopwatch();
+  static bool _firstImageRecorded = false;
+  
+  // Сколько ждать ответа сервера после запуска процесса и как часто его опрашивать
+  static const Duration _startupTimeout = Duration(seconds: 30);
+  static const Duration _healthPollInterval = Duration(milliseconds: 100);
+  
+  // Каталог ассетов с модулями Python backend'а (см. pubspec.yaml)
+  static const String _backendAssetDir = 'lib/backend/';
   
   // URL сервера
   static String get serverUrl => _serverUrl ?? 'http://127.0.0.1:8000';
@@ -14,6 +25,18 @@ class EmbeddedServerService {
   // Проверка, запущен ли сервер
   static bool get isRunning => _isRunning;
   
+  // Вызывается первым делом в main(): начало отсчёта time-to-first-image
+  static void markAppLaunch() {
+    if (!_launchClock.isRunning) _launchClock.start();
+  }
+  
+  // Вызывается после показа первого изображения; печатает метрику один раз
+  static void recordFirstImage() {
+    if (_firstImageRecorded || !_launchClock.isRunning) return;
+    _firstImageRecorded = true;
+    print('Time to first image: ${_launchClock.elapsedMilliseconds} мс от запуска приложения');
+  }
+  
   // Запуск встроенного сервера
   static Future<bool> startServer() async {
     if (_isRunning) return true;
@@ -31,18 +54,17 @@ class EmbeddedServerService {
         print('Создана директория сервера: ${serverDir.path}');
       }
       
-      // Путь к Python скрипту
-      final serverScript = File('${serverDir.path}/main.py');
-      
       // Всегда обновляем файлы сервера, чтобы гарантировать актуальные эндпоинты (например, /export_dicom/)
       await _createServerFiles(serverDir);
       // Устанавливаем зависимости Python (идемпотентно)
       await _installPythonDependencies(serverDir);
       
-      // Запускаем Python сервер
+      // Запускаем Python сервер через uvicorn, а не `python main.py`: процессы пула
+      // экспорта стартуют через spawn и заново импортируют главный модуль — так им
+      // достаётся uvicorn, а не весь backend с его пулами и кэшами
       _serverProcess = await Process.start(
         'python',
-        ['${serverDir.path}/main.py'],
+        ['-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', '8000'],
         workingDirectory: serverDir.path,
       );
       
@@ -71,19 +93,24 @@ class EmbeddedServerService {
         cancelOnError: false,
       );
       
-      // Ждем немного, чтобы сервер запустился
-      await Future.delayed(const Duration(seconds: 3));
-
+      // Опрашиваем health-check, пока сервер не ответит (вместо фиксированной паузы):
+      // сервер отвечает сразу после импортов, прогрев идёт у него в фоне
+      var processExited = false;
+      _serverProcess!.exitCode.then((_) => processExited = true);
+      final startClock = Stopwatch()..start();
       // Пробуем несколько портов (совместимость со старыми скриптами)
       final candidatePorts = [8000, 8010];
-      for (final port in candidatePorts) {
-        final url = 'http://127.0.0.1:$port';
-        if (await _checkServerHealth(urlOverride: url)) {
-          _isRunning = true;
-          _serverUrl = url;
-          print('Встроенный сервер успешно запущен на $_serverUrl');
-          return true;
+      while (startClock.elapsed < _startupTimeout && !processExited) {
+        for (final port in candidatePorts) {
+          final url = 'http://127.0.0.1:$port';
+          if (await _checkServerHealth(urlOverride: url, quiet: true)) {
+            _isRunning = true;
+            _serverUrl = url;
+            print('Встроенный сервер успешно запущен на $_serverUrl за ${startClock.elapsedMilliseconds} мс');
+            return true;
+          }
         }
+        await Future.delayed(_healthPollInterval);
       }
 
       print('Ошибка: сервер не отвечает');
@@ -109,286 +136,44 @@ class EmbeddedServerService {
     print('Встроенный сервер остановлен');
   }
   
-  // Проверка здоровья сервера
-  static Future<bool> _checkServerHealth({String? urlOverride}) async {
+  // Проверка здоровья сервера (quiet — без лога ошибок при опросе во время запуска)
+  static Future<bool> _checkServerHealth({String? urlOverride, bool quiet = false}) async {
     try {
-      final client = HttpClient();
+      final client = HttpClient()..connectionTimeout = const Duration(milliseconds: 500);
       final targetUrl = urlOverride ?? '$serverUrl/';
       final request = await client.getUrl(Uri.parse('$targetUrl/'));
       final response = await request.close();
+      await response.drain<void>();
       client.close();
       return response.statusCode == 200;
     } catch (e) {
-      print('Ошибка проверки здоровья сервера: $e');
+      if (!quiet) print('Ошибка проверки здоровья сервера: $e');
       return false;
     }
   }
   
-  // Создание файлов сервера
+  // Создание файлов сервера: модули backend'а (lib/backend) поставляются ассетами
+  // приложения — встроенный сервер выполняет тот же код, что и отдельный FastAPI-сервер
   static Future<void> _createServerFiles(Directory serverDir) async {
     print('Создание файлов встроенного сервера...');
     
-    // Создаем main.py
-    final mainPy = File('${serverDir.path}/main.py');
-    await mainPy.writeAsString('''
-import os
-import sys
-import base64
-import json
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-import pydicom
-import numpy as np
-from PIL import Image
-import io
-
-app = Flask(__name__)
-CORS(app)
-
-def _safe_str(value):
-    try:
-        return str(value)
-    except Exception:
-        try:
-            return value.decode('utf-8', errors='ignore')
-        except Exception:
-            return ''
-
-def extract_basic_tags(ds):
-    tags = {}
-    def put(key, attr, default=''):
-        tags[key] = _safe_str(getattr(ds, attr, default))
-    put('PatientName', 'PatientName')
-    put('PatientID', 'PatientID')
-    put('StudyDate', 'StudyDate')
-    put('StudyTime', 'StudyTime')
-    put('Modality', 'Modality')
-    put('StudyDescription', 'StudyDescription')
-    put('SeriesDescription', 'SeriesDescription')
-    put('InstitutionName', 'InstitutionName')
-    put('Manufacturer', 'Manufacturer')
-    put('BodyPartExamined', 'BodyPartExamined')
-    put('StudyInstanceUID', 'StudyInstanceUID')
-    put('SeriesInstanceUID', 'SeriesInstanceUID')
-    put('SOPInstanceUID', 'SOPInstanceUID')
-    # Dimensions
-    tags['Rows'] = _safe_str(getattr(ds, 'Rows', ''))
-    tags['Columns'] = _safe_str(getattr(ds, 'Columns', ''))
-    # Pixel spacing
-    ps = getattr(ds, 'PixelSpacing', None)
-    if ps is not None:
-        try:
-            tags['PixelSpacing'] = f"{float(ps[0])} \\ {float(ps[1])}"
-        except Exception:
-            tags['PixelSpacing'] = _safe_str(ps)
-    # Additional exposure info
-    for name in ['SliceThickness', 'KVP', 'ExposureTime', 'XRayTubeCurrent', 'Exposure']:
-        if hasattr(ds, name):
-            tags[name] = _safe_str(getattr(ds, name))
-    return tags
-
-def extract_report(ds):
-    # Try common text fields
-    for attr in [
-        'ImageComments',
-        'StudyComments',
-        'ClinicalInformation',
-        'AdditionalPatientHistory',
-        'ReasonForRequestedProcedure',
-        'RequestedProcedureDescription',
-        'AdmittingDiagnosesDescription',
-        'DiagnosisDescription',
-    ]:
-        if hasattr(ds, attr):
-            val = _safe_str(getattr(ds, attr))
-            if val:
-                return val
-    # Very simple SR traversal
-    try:
-        if hasattr(ds, 'ContentSequence'):
-            items = []
-            def walk(seq):
-                for item in seq:
-                    vt = _safe_str(getattr(item, 'ValueType', ''))
-                    if vt == 'TEXT' and hasattr(item, 'TextValue'):
-                        items.append(_safe_str(item.TextValue))
-                    if hasattr(item, 'ContentSequence'):
-                        walk(item.ContentSequence)
-            walk(ds.ContentSequence)
-            if items:
-                return "\n".join(items)
-    except Exception:
-        pass
-    return ''
-
-def process_dicom_file(file_bytes, filename):
-    """Обработка DICOM файла"""
-    try:
-        # Создаем временный файл
-        temp_path = f"temp_{filename}"
-        with open(temp_path, 'wb') as f:
-            f.write(file_bytes)
-        
-        # Читаем DICOM
-        ds = pydicom.dcmread(temp_path)
-        
-        # Извлекаем данные
-        pixel_array = ds.pixel_array
-        
-        # Нормализация для изображения
-        if hasattr(ds, 'WindowCenter') and hasattr(ds, 'WindowWidth'):
-            window_center = float(ds.WindowCenter) if isinstance(ds.WindowCenter, (int, float)) else float(ds.WindowCenter[0])
-            window_width = float(ds.WindowWidth) if isinstance(ds.WindowWidth, (int, float)) else float(ds.WindowWidth[0])
-        else:
-            window_center = pixel_array.mean()
-            window_width = pixel_array.std() * 4
-        
-        # Применяем window/level
-        min_val = window_center - window_width / 2
-        max_val = window_center + window_width / 2
-        pixel_array = np.clip(pixel_array, min_val, max_val)
-        pixel_array = ((pixel_array - min_val) / (max_val - min_val) * 255).astype(np.uint8)
-        
-        # Конвертируем в PIL Image
-        if len(pixel_array.shape) == 3:
-            image = Image.fromarray(pixel_array)
-        else:
-            image = Image.fromarray(pixel_array, mode='L')
-        
-        # Конвертируем в RGB если нужно
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Конвертируем в base64
-        buffer = io.BytesIO()
-        image.save(buffer, format='PNG')
-        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        
-        # Получаем метаданные и теги
-        patient_name = str(ds.get('PatientName', 'Unknown'))
-        pixel_spacing = ds.get('PixelSpacing', [1.0, 1.0])
-        pixel_spacing_row = float(pixel_spacing[0]) if pixel_spacing else 1.0
-        tags = extract_basic_tags(ds)
-        report = extract_report(ds)
-        
-        # Удаляем временный файл
-        os.remove(temp_path)
-        
-        return {
-            'image_base64': image_base64,
-            'patient_name': patient_name,
-            'pixel_spacing_row': pixel_spacing_row,
-            'window_center': window_center,
-            'window_width': window_width,
-            'tags': tags,
-            'report': report,
-        }
-        
-    except Exception as e:
-        print(f"Ошибка обработки DICOM: {e}")
-        return None
-
-@app.route('/')
-def health_check():
-    return jsonify({"status": "ok", "message": "Embedded DICOM Server"})
-
-@app.route('/process_dicom/', methods=['POST'])
-def process_dicom():
-    try:
-        if 'file' not in request.files:
-            return jsonify({"error": "No file provided"}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({"error": "No file selected"}), 400
-        
-        file_bytes = file.read()
-        result = process_dicom_file(file_bytes, file.filename)
-        
-        if result is None:
-            return jsonify({"error": "Failed to process DICOM file"}), 500
-        
-        return jsonify(result)
-        
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route('/update_wl/', methods=['POST'])
-def update_wl():
-    try:
-        data = request.get_json()
-        window_center = data.get('window_center', 0)
-        window_width = data.get('window_width', 0)
-        brightness = data.get('brightness', 1.0)
-        
-        # Здесь должна быть логика обновления W/L
-        # Для простоты возвращаем успех
-        return jsonify({"status": "ok"})
-        
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route('/export_dicom/', methods=['POST'])
-def export_dicom():
-    """Принимает исходный DICOM файл и metadata (tags/report), возвращает изменённый DICOM base64"""
-    try:
-        if 'file' not in request.files:
-            return jsonify({"error": "No file provided"}), 400
-        file = request.files['file']
-        file_bytes = file.read()
-        meta_json = request.form.get('metadata')
-        metadata = json.loads(meta_json) if meta_json else {}
-
-        # Загружаем как DICOM из bytes
-        ds = pydicom.dcmread(io.BytesIO(file_bytes), force=True)
-
-        # Применяем report
-        report = metadata.get('report', None)
-        if report is not None:
-            ds.ImageComments = str(report)
-
-        # Применяем теги по словарю {keyword: value}
-        from pydicom.datadict import tag_for_keyword
-        tags = metadata.get('tags', {}) or {}
-        for key, value in tags.items():
-            try:
-                # Пробуем по ключевому слову DICOM
-                tag = tag_for_keyword(key)
-                if tag is not None:
-                    setattr(ds, key, value)
-                else:
-                    # Если ключ не стандартный keyword — создаём/обновляем как приватный текстовый элемент в (0x0011,0x0010)-подобном стиле не делаем; просто игнорируем
-                    pass
-            except Exception:
-                pass
-
-        # Сохраняем в память новый DICOM
-        out_buf = io.BytesIO()
-        ds.save_as(out_buf, write_like_original=False)
-        out_bytes = out_buf.getvalue()
-        return jsonify({
-            'dicom_base64': base64.b64encode(out_bytes).decode('utf-8'),
-            'size': len(out_bytes)
-        })
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-if __name__ == '__main__':
-    print("Запуск встроенного DICOM сервера...")
-    app.run(host='127.0.0.1', port=8000, debug=False)
-''');
-    
-    // Создаем requirements.txt
-    final requirementsTxt = File('${serverDir.path}/requirements.txt');
-    await requirementsTxt.writeAsString('''
-Flask==2.3.3
-Flask-CORS==4.0.0
-pydicom==2.4.3
-numpy==1.24.3
-Pillow==10.0.0
-''');
+    final manifest = await AssetManifest.loadFromAssetBundle(rootBundle);
+    final assets = manifest.listAssets().where((asset) =>
+        asset.startsWith(_backendAssetDir) &&
+        (asset.endsWith('.py') || asset.endsWith('requirements.txt')));
+    var written = 0;
+    for (final asset in assets) {
+      final data = await rootBundle.load(asset);
+      final bytes = data.buffer.asUint8List(data.offsetInBytes, data.lengthInBytes);
+      final target = File('${serverDir.path}/${asset.substring(_backendAssetDir.length)}');
+      // Неизменённые файлы не перезаписываются: новое mtime заставило бы Python
+      // заново компилировать модули (__pycache__) при каждом запуске приложения
+      if (await target.exists() && listEquals(await target.readAsBytes(), bytes)) continue;
+      await target.writeAsBytes(bytes, flush: true);
+      written++;
+    }
     
-    print('Файлы сервера созданы');
+    print('Файлы сервера обновлены: $written');
   }
   
   // Установка Python зависимостей
@@ -398,6 +183,14 @@ Pillow==10.0.0
       
       final requirementsFile = File('${serverDir.path}/requirements.txt');
       if (await requirementsFile.exists()) {
+        // pip запускается только при изменении requirements.txt: даже «всё уже
+        // установлено» стоит нескольких секунд на каждом запуске приложения
+        final stampFile = File('${serverDir.path}/.requirements.installed');
+        final requirements = await requirementsFile.readAsString();
+        if (await stampFile.exists() && await stampFile.readAsString() == requirements) {
+          print('Python зависимости не изменились, установка пропущена');
+          return;
+        }
         final result = await Process.run(
           'pip',
           ['install', '-r', '${serverDir.path}/requirements.txt'],
@@ -405,6 +198,7 @@ Pillow==10.0.0
         );
         
         if (result.exitCode == 0) {
+          await stampFile.writeAsString(requirements);
           print('Python зависимости успешно установлены');
         } else {
           print('Ошибка установки Python зависимостей: ${result.stderr}');